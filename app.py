@@ -5,6 +5,7 @@ import os
 import waitress
 from flask import (
     Flask,
+    jsonify,
     redirect,
     render_template,
     request,
@@ -16,6 +17,7 @@ from config import IS_WINDOWS
 from config.logging import logging_setup
 from email_data.send_email import prepare_email_html, send_email
 from rightmove.database import (
+    check_database_health,
     get_email_addresses,
     set_email_addresses,
     get_property_reviews,
@@ -32,6 +34,7 @@ from rightmove.run import (
     download_properties,
     download_property_data,
 )
+from rightmove.statements import statement_stats
 
 app = Flask(__name__)
 
@@ -67,12 +70,11 @@ def email_template():
     review_id = data.get("id")
     match review_id:
         case "latest":
-            review_filter = "review_id is null"
+            properties = get_properties()
         case _:
-            review_filter = f"review_id = {review_id}"
+            properties = get_properties(int(review_id))
 
     new_properties = count_new_properties()
-    properties = get_properties(review_filter)
     graph = create_mapbox(properties) if properties else None
 
     return render_template(
@@ -118,7 +120,7 @@ def send():
 def delete_review():
     data = request.args.to_dict()
     review_id = data.get("id")
-    delete_property_review(review_id)
+    delete_property_review(int(review_id))
     return redirect(url_for("index"))
 
 
@@ -139,6 +141,13 @@ def update_settings():
     return redirect("/")
 
 
+@app.route("/health")
+def health():
+    status = check_database_health()
+    status["statements"] = statement_stats().to_dict("index")
+    return jsonify(status), 200 if status["healthy"] else 503
+
+
 def count_new_properties() -> str:
     count_props = get_new_property_count()
     new_properties = f" - {count_props} new" if count_props > 0 else ""
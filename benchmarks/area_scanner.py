@@ -0,0 +1,57 @@
+"""
+Benchmarks extract_internal_area over a corpus of OCR outputs, and checks the results against the regression corpus
+in benchmarks/data/ocr_corpus.json.
+
+By default the OCR text cached by FloorplanCache is used, falling back to the regression corpus if the cache is
+empty:
+
+    python -m benchmarks.area_scanner [--repeat 100]
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from rightmove.floorplan import extract_internal_area, extract_internal_areas
+from rightmove.floorplan_cache import FLOORPLAN_CACHE_DIR
+
+REGRESSION_CORPUS = Path(__file__).parent / "data" / "ocr_corpus.json"
+
+
+def load_cached_texts(cache_dir: str = FLOORPLAN_CACHE_DIR):
+    index = os.path.join(cache_dir, "index.sqlite")
+    if not os.path.exists(index):
+        return []
+
+    with sqlite3.connect(index) as conn:
+        return [text for (text,) in conn.execute("SELECT text FROM results WHERE text != ''")]
+
+
+def main(repeat: int = 100):
+    with open(REGRESSION_CORPUS) as f:
+        corpus = json.load(f)
+
+    failures = [item for item in corpus if extract_internal_area(item["text"]) != item["expected"]]
+    print(f"Regression corpus: {len(corpus) - len(failures)}/{len(corpus)} passed")
+    for item in failures:
+        print(f"    {item['text']!r}: expected {item['expected']}, got {extract_internal_area(item['text'])}")
+
+    texts = load_cached_texts() or [item["text"] for item in corpus]
+    start = time.perf_counter()
+    for _ in range(repeat):
+        extract_internal_areas(texts)
+    elapsed = time.perf_counter() - start
+
+    n = len(texts) * repeat
+    print(f"{n} texts in {elapsed:.2f}s ({elapsed / n * 1e6:.1f} us per text)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark floorplan area extraction.")
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    main(repeat=args.repeat)
@@ -0,0 +1,151 @@
+"""
+Compares the query plans and timings of looking up the current rows of property_data by the previous predicates
+(CURRENT_TIMESTAMP BETWEEN property_validfrom AND property_validto in properties_current, property_validto >= now in
+the loaders) and by the open row predicate (property_validto = '9999-12-31') which can use the property_data_open
+partial index:
+
+    properties_current      all current rows joined to their location, as read by the alert views
+    properties_current_ids  the current rows of a batch of properties, as read by refresh_alert_properties()
+    loader_existing_ids     the IDs with current data, read by load_property_data
+    loader_existing_record  the current row of one property, read by load_property_data for every property
+    id_list_update          the IDs due an update, read by get_id_list(update=True)
+
+Run against a copy of the database with views.sql applied:
+
+    python -m benchmarks.current_rows [--repeat 20] [--plans]
+"""
+
+import argparse
+import datetime as dt
+import statistics
+import time
+from typing import Dict, List, Tuple
+
+from rightmove.database import get_database_connection
+
+REPEAT = 20
+BATCH_SIZE = 500
+
+CURRENT_ROWS = """
+    SELECT COUNT(*)
+    FROM property_data AS pd
+    LEFT JOIN property_location AS pl USING (property_id)
+    WHERE {predicate}
+"""
+
+QUERIES: Dict[str, Tuple[str, str, str]] = {
+    "properties_current": (
+        CURRENT_ROWS,
+        "CURRENT_TIMESTAMP BETWEEN pd.property_validfrom AND pd.property_validto",
+        "pd.property_validto = '9999-12-31'",
+    ),
+    "properties_current_ids": (
+        CURRENT_ROWS + " AND pd.property_id = ANY(%(ids)s)",
+        "CURRENT_TIMESTAMP BETWEEN pd.property_validfrom AND pd.property_validto",
+        "pd.property_validto = '9999-12-31'",
+    ),
+    "loader_existing_ids": (
+        "SELECT property_id FROM property_data {predicate}",
+        "",
+        "WHERE property_validto = '9999-12-31'",
+    ),
+    "loader_existing_record": (
+        "SELECT * FROM property_data WHERE property_id = %(id)s AND {predicate}",
+        "property_validto >= %(now)s",
+        "property_validto = '9999-12-31'",
+    ),
+    "id_list_update": (
+        """
+        SELECT pl.property_id
+        FROM property_location pl
+        LEFT JOIN property_data pd ON pl.property_id = pd.property_id
+        WHERE pl.property_channel = 'BUY'
+          AND (
+              (pd.last_update < %(cutoff)s OR pd.last_update IS NULL)
+              AND {predicate}
+              OR pd.property_id IS NULL
+          )
+        """,
+        "pd.property_validto >= %(now)s",
+        "pd.property_validto = '9999-12-31'",
+    ),
+}
+
+
+def plan_nodes(plan: Dict) -> List[str]:
+    """
+    Flatten an EXPLAIN (FORMAT JSON) plan to a list of its nodes, e.g. ["Aggregate", "Index Scan on property_data"].
+    """
+    node = plan["Node Type"]
+    if "Index Name" in plan:
+        node += f" using {plan['Index Name']}"
+    elif "Relation Name" in plan:
+        node += f" on {plan['Relation Name']}"
+
+    return [node] + [child for subplan in plan.get("Plans", []) for child in plan_nodes(subplan)]
+
+
+def measure(cursor, sql: str, params: Dict, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+
+def main(repeat: int = REPEAT, plans: bool = False):
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT COUNT(*), COUNT(*) FILTER (WHERE property_validto = '9999-12-31') FROM property_data"
+            )
+            rows, open_rows = cursor.fetchone()
+            cursor.execute(
+                """
+                SELECT property_id FROM property_data
+                WHERE property_validto = '9999-12-31'
+                ORDER BY random() LIMIT %s
+                """,
+                (BATCH_SIZE,),
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                print("No current rows found in property_data")
+                return
+
+            now = dt.datetime.now()
+            params = {"ids": ids, "id": ids[0], "now": now, "cutoff": now - dt.timedelta(days=1)}
+            print(f"{rows} rows in property_data, {open_rows} open\n")
+            print(f"{'query':<24} {'previous ms':>12} {'open row ms':>12}")
+
+            reports = []
+            for name, (sql, previous, current) in QUERIES.items():
+                timings = []
+                for predicate in (previous, current):
+                    query = sql.format(predicate=predicate)
+                    timings.append(measure(cursor, query, params, repeat))
+
+                    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT {'TEXT' if plans else 'JSON'}) {query}", params)
+                    result = cursor.fetchall()
+                    if plans:
+                        reports.append((name, predicate, "\n".join(row[0] for row in result)))
+                    else:
+                        reports.append((name, predicate, " > ".join(plan_nodes(result[0][0][0]["Plan"]))))
+
+                print(f"{name:<24} {timings[0] * 1000:>12.2f} {timings[1] * 1000:>12.2f}")
+
+            print()
+            for name, predicate, report in reports:
+                print(f"{name}: {predicate or '(no filter)'}\n{report}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark current row lookups on property_data.")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--plans", action="store_true", help="Print the full EXPLAIN (ANALYZE, BUFFERS) plans")
+    args = parser.parse_args()
+
+    main(repeat=args.repeat, plans=args.plans)
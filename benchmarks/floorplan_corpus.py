@@ -0,0 +1,116 @@
+"""
+Generates the labelled corpus of floorplan images in benchmarks/data/floorplans, used by benchmarks.floorplan_ocr to
+measure the accuracy of the OCR modes from a clean checkout. The floorplans are drawn with the font bundled with
+Pillow, and cover the layouts and image formats the OCR has to handle: the area statement at the bottom, top or
+middle of the image, sq m only, per floor areas with a total, no area at all, large images which are downscaled,
+and greyscale with alpha (LA), 16-bit and transparent RGBA images. The expected areas (labels.json) are what
+extract_internal_area returns for the text drawn on each image.
+
+    python -m benchmarks.floorplan_corpus
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from rightmove.floorplan import extract_internal_area
+
+CORPUS_DIR = Path(__file__).parent / "data" / "floorplans"
+
+ROOMS = ["Kitchen/Diner", "Reception", "Bedroom 1", "Bedroom 2", "Bathroom", "Hall"]
+
+# name, size, font size, image mode, text above the plan, text below the plan, text across the middle of the plan:
+FLOORPLANS = [
+    ("bottom_total", (1200, 900), 28, "RGB", [], ["TOTAL FLOOR AREA : 850 sq.ft. (79.0 sq.m.) approx."], []),
+    ("top_gross", (1200, 900), 28, "RGB", ["Approximate Gross Internal Area 1,234 sq ft / 114.6 sq m"], [], []),
+    ("large_bottom", (3200, 2400), 64, "RGB", [], ["Total Area: 1,050 sq ft (97.5 sq m)"], []),
+    ("sqm_only", (1000, 800), 26, "RGB", [], ["Internal Area 65.0 sq m"], []),
+    (
+        "per_floor",
+        (1400, 1000),
+        26,
+        "RGB",
+        ["Ground Floor 540 sq ft (50.2 sq m)    First Floor 480 sq ft (44.6 sq m)"],
+        ["Approximate Floor Area 1,020 sq ft (94.8 sq m)"],
+        [],
+    ),
+    ("middle", (1200, 900), 28, "RGB", [], [], ["Total floor area 640 sq ft (59.5 sq m)"]),
+    (
+        "no_area",
+        (1000, 800),
+        26,
+        "RGB",
+        ["GROUND FLOOR"],
+        ["Whilst every attempt has been made to ensure accuracy"],
+        [],
+    ),
+    ("greyscale_alpha", (1100, 850), 28, "LA", [], ["Total floor area 720 sq ft (66.9 sq m)"], []),
+    ("greyscale_16bit", (1100, 850), 28, "I;16", ["Total Approx. Floor Area 910 sq ft (84.5 sq m)"], [], []),
+    ("transparent", (1100, 850), 28, "RGBA", [], ["Total internal area 1,480 sq ft (137.5 sq m)"], []),
+]
+
+
+def draw_floorplan(size, font_size: int, above: list, below: list, middle: list) -> Image.Image:
+    """
+    Draw a floorplan of a grid of rooms, with the lines of text above, below and across the middle of it, in black
+    on a transparent background.
+    """
+    width, height = size
+    font = ImageFont.load_default(size=font_size)
+    small = ImageFont.load_default(size=int(font_size * 0.7))
+    line = int(font_size * 1.6)
+    image = Image.new("LA", size, (255, 0))
+    draw = ImageDraw.Draw(image)
+
+    top = line * (len(above) + 1)
+    bottom = height - line * (len(below) + 1)
+    left, right = width // 10, width - width // 10
+    columns, rows = 3, 2
+    for i, room in enumerate(ROOMS):
+        x0 = left + (right - left) * (i % columns) // columns
+        y0 = top + (bottom - top) * (i // columns) // rows
+        x1 = left + (right - left) * (i % columns + 1) // columns
+        y1 = top + (bottom - top) * (i // columns + 1) // rows
+        draw.rectangle((x0, y0, x1, y1), outline=(0, 255), width=max(2, font_size // 6))
+        draw.text(((x0 + x1) // 2, (y0 + y1) // 2), room, font=small, fill=(0, 255), anchor="mm")
+
+    for i, text in enumerate(above):
+        draw.text((width // 2, line * (i + 1)), text, font=font, fill=(0, 255), anchor="mm")
+    for i, text in enumerate(below):
+        draw.text((width // 2, bottom + line * (i + 1)), text, font=font, fill=(0, 255), anchor="mm")
+    for i, text in enumerate(middle):
+        position = (width // 2, (top + bottom) // 2 + line * i)
+        box = draw.textbbox(position, text, font=font, anchor="mm")
+        draw.rectangle((box[0] - 8, box[1] - 8, box[2] + 8, box[3] + 8), fill=(255, 255))
+        draw.text(position, text, font=font, fill=(0, 255), anchor="mm")
+
+    return image
+
+
+def convert(image: Image.Image, mode: str) -> Image.Image:
+    if mode in ("LA", "RGBA"):
+        return image.convert(mode)
+
+    grey = Image.alpha_composite(Image.new("RGBA", image.size, "white"), image.convert("RGBA")).convert("L")
+    if mode == "I;16":
+        return Image.fromarray(np.asarray(grey).astype(np.uint16) * 257)
+    return grey.convert(mode)
+
+
+def main(corpus_dir: Path = CORPUS_DIR):
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    labels = {}
+    for name, size, font_size, mode, above, below, middle in FLOORPLANS:
+        image = convert(draw_floorplan(size, font_size, above, below, middle), mode)
+        image.save(corpus_dir / f"{name}.png", optimize=True)
+        labels[f"{name}.png"] = extract_internal_area("\n".join(above + ROOMS + middle + below))
+
+    with open(corpus_dir / "labels.json", "w") as f:
+        json.dump(labels, f, indent=2)
+    print(f"Wrote {len(labels)} floorplans to {corpus_dir}")
+
+
+if __name__ == "__main__":
+    main()
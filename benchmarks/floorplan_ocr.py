@@ -0,0 +1,103 @@
+"""
+Benchmarks the optimised ("fast") floorplan OCR mode against full page OCR of the original image ("full"),
+measuring the time per image, how often the fast mode extracts the same area, and the accuracy of both modes on
+labelled images.
+
+The corpus is a directory of floorplan images, searched recursively, with the expected area of each image in an
+optional labels.json ({file name: {"sqft": ..., "sqm": ...}}). By default the labelled corpus checked in to
+benchmarks/data/floorplans is used (see benchmarks.floorplan_corpus). Images stored by a FloorplanCache created with
+store_images=True (DATA/floorplan_cache/images) can be compared too, without labels. rightmove.floorplan.OCR_MODE
+stays "full" unless the fast mode is as accurate on the corpus.
+
+    python -m benchmarks.floorplan_ocr [corpus_dir]
+"""
+
+import json
+import sys
+import time
+from pathlib import Path
+
+from rightmove.floorplan import analyse_floorplan
+
+CORPUS_DIR = Path(__file__).parent / "data" / "floorplans"
+IMAGE_SUFFIXES = {"", ".gif", ".jpeg", ".jpg", ".png"}
+
+
+def time_mode(content: bytes, mode: str):
+    start = time.perf_counter()
+    try:
+        sqft = analyse_floorplan(content, mode=mode)["sqft"]
+    except Exception:
+        sqft = None
+    return sqft, time.perf_counter() - start
+
+
+def load_labels(corpus_dir: Path) -> dict:
+    path = corpus_dir / "labels.json"
+    if not path.exists():
+        return {}
+
+    with open(path) as f:
+        return {name: expected["sqft"] for name, expected in json.load(f).items()}
+
+
+def main(corpus_dir: str = CORPUS_DIR):
+    corpus_dir = Path(corpus_dir)
+    files = sorted(f for f in corpus_dir.rglob("*") if f.is_file() and f.suffix.lower() in IMAGE_SUFFIXES)
+    if not files:
+        print(f"No images found in {corpus_dir}")
+        return
+
+    labels = load_labels(corpus_dir)
+    totals = {"full": 0.0, "fast": 0.0}
+    counts = {"same": 0, "different": 0, "fast_missed": 0, "fast_extra": 0, "neither": 0}
+    correct = {"full": 0, "fast": 0}
+    labelled = 0
+
+    print(f"{'image':<40} {'expected':>10} {'full sqft':>10} {'full s':>8} {'fast sqft':>10} {'fast s':>8}")
+    for file in files:
+        content = file.read_bytes()
+        full_sqft, full_time = time_mode(content, "full")
+        fast_sqft, fast_time = time_mode(content, "fast")
+        totals["full"] += full_time
+        totals["fast"] += fast_time
+
+        if full_sqft is None and fast_sqft is None:
+            counts["neither"] += 1
+        elif full_sqft == fast_sqft:
+            counts["same"] += 1
+        elif fast_sqft is None:
+            counts["fast_missed"] += 1
+        elif full_sqft is None:
+            counts["fast_extra"] += 1
+        else:
+            counts["different"] += 1
+
+        expected = "-"
+        if file.name in labels:
+            expected = labels[file.name]
+            labelled += 1
+            correct["full"] += full_sqft == expected
+            correct["fast"] += fast_sqft == expected
+
+        print(
+            f"{file.name[:40]:<40} {expected or '-':>10} {full_sqft or '-':>10} {full_time:8.3f} "
+            f"{fast_sqft or '-':>10} {fast_time:8.3f}"
+        )
+
+    n = len(files)
+    print()
+    print(f"images:             {n}")
+    print(f"full mean time:     {totals['full'] / n:.3f}s")
+    print(f"fast mean time:     {totals['fast'] / n:.3f}s ({totals['full'] / max(totals['fast'], 1e-9):.1f}x faster)")
+    print(f"same area:          {counts['same'] + counts['neither']} ({counts['neither']} with no area in either)")
+    print(f"different area:     {counts['different']}")
+    print(f"missed by fast:     {counts['fast_missed']}")
+    print(f"only found by fast: {counts['fast_extra']}")
+    if labelled:
+        print(f"full accuracy:      {correct['full']}/{labelled}")
+        print(f"fast accuracy:      {correct['fast']}/{labelled}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
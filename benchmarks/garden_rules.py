@@ -0,0 +1,51 @@
+"""
+Reports how the rule-based garden classifier (rightmove.description.classify_gardens) performs on the summaries in
+property_summary, to tune RULE_CONFIDENCE_CUTOFF: the time per summary, the distribution of confidence, and at each
+cutoff the share of summaries the rules resolve without the model and how often they agree with the garden already
+stored from the model.
+
+    python -m benchmarks.garden_rules
+"""
+
+import time
+
+import pandas as pd
+
+from rightmove.database import get_database_connection
+from rightmove.description import classify_gardens
+
+CUTOFFS = [0.5, 0.8, 0.85, 0.9, 0.95]
+
+
+def load_summaries() -> pd.DataFrame:
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT summary, garden FROM property_summary WHERE summary IS NOT NULL AND summary <> ''")
+            return pd.DataFrame(cursor.fetchall(), columns=["summary", "garden"])
+
+
+def main():
+    df = load_summaries()
+    if df.empty:
+        print("No summaries found in property_summary")
+        return
+
+    start = time.perf_counter()
+    rules = classify_gardens(df["summary"].tolist())
+    elapsed = time.perf_counter() - start
+    print(f"{len(df)} summaries in {elapsed:.3f}s ({elapsed / len(df) * 1e6:.1f} us per summary)\n")
+
+    print("Confidence:")
+    print(rules["confidence"].value_counts().sort_index(ascending=False).to_string(), "\n")
+
+    labelled = df["garden"].notna()
+    print(f"{'cutoff':>8} {'hit rate':>10} {'agreement':>10}")
+    for cutoff in CUTOFFS:
+        hits = rules["confidence"] >= cutoff
+        compared = hits & labelled
+        agreement = (rules["garden"][compared] == df["garden"][compared]).mean() if compared.any() else float("nan")
+        print(f"{cutoff:>8.2f} {hits.mean():>10.1%} {agreement:>10.1%}")
+
+
+if __name__ == "__main__":
+    main()
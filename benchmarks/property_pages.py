@@ -0,0 +1,110 @@
+"""
+Benchmarks the property page parsers on saved pages, measuring the parse time and peak memory per page of:
+
+    soup        the previous BeautifulSoup html.parser tree walk
+    page_model  the embedded page model JSON (rightmove.property_page.parse_page_model)
+    lxml        the lxml fallback for pages without a page model (rightmove.property_page.parse_html)
+
+Peak memory is measured with tracemalloc, so it only covers Python allocations and not lxml's C tree. Pages are read
+from a directory of .html files, which can be filled by downloading some property pages first:
+
+    python -m benchmarks.property_pages --download 143206301 143206302
+    python -m benchmarks.property_pages [--pages-dir DATA/property_pages]
+"""
+
+import argparse
+import asyncio
+import os
+import re
+import time
+import tracemalloc
+from pathlib import Path
+from typing import List
+
+from bs4 import BeautifulSoup
+
+from config import DATA
+from rightmove.enhancements import PropertyPageClient
+from rightmove.property_page import get_page_model, parse_html, parse_page_model
+
+PAGES_DIR = os.path.join(DATA, "property_pages")
+REPEAT = 20
+
+
+def parse_soup(content: bytes):
+    soup = BeautifulSoup(content, "html.parser")
+    floorplans = [img["src"] for img in soup.find_all("img", attrs={"src": re.compile("_FLP_00_")})]
+    key_features = soup.find("ul", class_="_1uI3IvdF5sIuBtRIvKrreQ")
+    description = soup.find("div", class_="_1a8kqJPMw6HOD9SDZq61E8")
+    return floorplans, key_features, description
+
+
+def parse_model(content: bytes):
+    model = get_page_model(content)
+    return parse_page_model(model) if model is not None else None
+
+
+PARSERS = {"soup": parse_soup, "page_model": parse_model, "lxml": parse_html}
+
+
+async def download_pages(ids: List[int], pages_dir: str = PAGES_DIR):
+    os.makedirs(pages_dir, exist_ok=True)
+    async with PropertyPageClient() as client:
+        pages = await asyncio.gather(*[
+            client.get(f"https://www.rightmove.co.uk/properties/{property_id}#/") for property_id in ids
+        ])
+
+    for property_id, content in zip(ids, pages):
+        if content is None:
+            print(f"Failed to download {property_id}")
+            continue
+        Path(pages_dir, f"{property_id}.html").write_bytes(content)
+
+
+def measure(parser, content: bytes, repeat: int = REPEAT):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parser(content)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    parser(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+
+def main(pages_dir: str = PAGES_DIR, repeat: int = REPEAT):
+    files = sorted(Path(pages_dir).glob("*.html"))
+    if not files:
+        print(f"No pages found in {pages_dir}")
+        return
+
+    totals = {name: [0.0, 0] for name in PARSERS}
+    with_model = 0
+    for file in files:
+        content = file.read_bytes()
+        with_model += get_page_model(content) is not None
+        for name, parser in PARSERS.items():
+            elapsed, peak = measure(parser, content, repeat)
+            totals[name][0] += elapsed
+            totals[name][1] = max(totals[name][1], peak)
+
+    print(f"{len(files)} pages, {with_model} with a page model")
+    print(f"{'parser':<12} {'ms/page':>10} {'peak MB':>10}")
+    for name, (elapsed, peak) in totals.items():
+        print(f"{name:<12} {elapsed / len(files) * 1000:>10.2f} {peak / 1024 ** 2:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark property page parsing.")
+    parser.add_argument("--pages-dir", default=PAGES_DIR)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--download", type=int, nargs="+", help="Property IDs to download to the pages directory")
+    args = parser.parse_args()
+
+    if args.download:
+        asyncio.run(download_pages(args.download, args.pages_dir))
+    else:
+        main(pages_dir=args.pages_dir, repeat=args.repeat)
@@ -0,0 +1,242 @@
+"""
+Captures EXPLAIN (ANALYZE, BUFFERS) for the hot statements of the catalogue in rightmove.statements (prepared as
+they are in the pipeline, and explained with EXPLAIN EXECUTE) and the alert views, and compares them with the plans
+recorded in benchmarks/data/query_plans.json. A query regresses if its plan scans a table sequentially which the
+recorded plan didn't, or if it touches more than BUFFER_TOLERANCE times the recorded shared buffers. Timings are
+reported but aren't compared, as they depend too much on the machine.
+
+Statements which write (e.g. enqueue_enhancement_alerts) are rolled back after they are explained. The plans
+depend on the size of the data, so the check should be run against a local database seeded with the same number of
+properties as the recorded plans:
+
+    python -m benchmarks.query_plans --seed 20000      # migrate and seed an empty database, then check
+    python -m benchmarks.query_plans [--plans]         # check, optionally printing the full plans
+    python -m benchmarks.query_plans --update          # record the current plans as the new baseline
+"""
+
+import argparse
+import datetime as dt
+import json
+import os
+import sys
+from typing import Dict, List
+
+from benchmarks.current_rows import plan_nodes
+from rightmove import statements
+from rightmove.database import get_database_connection
+from rightmove.migrations import migrate
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "data", "query_plans.json")
+BUFFER_TOLERANCE = 1.5
+BUFFER_SLACK = 50
+VERSIONS = 3
+
+# The catalogue statements which are checked, with a function of the cutoff and IDs giving their arguments:
+STATEMENTS = {
+    "new_property_ids": lambda cutoff, ids: ["BUY"],
+    "outdated_property_ids": lambda cutoff, ids: ["BUY", cutoff],
+    "current_property_data": lambda cutoff, ids: [ids],
+    "enqueue_enhancement_alerts": lambda cutoff, ids: [],
+    "unreviewed_alert_locations": lambda cutoff, ids: [],
+    "new_alert_properties": lambda cutoff, ids: [],
+    "new_property_count": lambda cutoff, ids: [],
+    "delete_reviewed_properties": lambda cutoff, ids: [2],
+    "reduced_properties": lambda cutoff, ids: [7],
+    "price_trajectories": lambda cutoff, ids: [ids],
+}
+
+# Queries run inside the views and functions of views.sql, rather than from the catalogue:
+VIEW_QUERIES = {
+    "alert_properties": "SELECT * FROM alert_properties",
+    "refresh_alert_properties": "SELECT * FROM alert_candidates WHERE property_id = ANY(%(ids)s)",
+}
+
+SEED_SQL = """
+    SELECT setseed(0.5);
+
+    INSERT INTO property_location
+    SELECT i, now(), CASE WHEN i %% 5 = 0 THEN 'RENT' ELSE 'BUY' END, -0.4 + random() * 0.8, 51.1 + random() * 0.7
+    FROM generate_series(1, %(properties)s) AS i;
+
+    INSERT INTO property_data
+    SELECT
+        i,
+        now() - (%(versions)s - v + 1) * INTERVAL '1 day',
+        CASE
+            WHEN v = %(versions)s - 1 THEN '9999-12-31'::timestamp
+            ELSE now() - (%(versions)s - v) * INTERVAL '1 day' END,
+        2 + i %% 3,
+        1 + i %% 2,
+        CASE WHEN i %% 3 = 0 THEN NULL ELSE 500 + i %% 700 END,
+        CASE WHEN i %% 2 = 0 THEN 'Flat with a private garden and patio' ELSE 'Top floor flat with a lift' END,
+        i || ' Some Road, London',
+        'Flat',
+        'Flat for sale',
+        FALSE,
+        500000 + (i * 7919) %% 400000 + v * 1000,
+        'not specified',
+        NULL,
+        'Agent',
+        'Branch',
+        FALSE,
+        FALSE,
+        FALSE,
+        FALSE,
+        FALSE,
+        now() - (i %% 60) * INTERVAL '1 day',
+        now(),
+        NULL
+    FROM generate_series(1, %(properties)s) AS i, generate_series(0, %(versions)s - 1) AS v;
+
+    INSERT INTO price_history
+    SELECT property_id, property_validfrom, price_amount, price_qualifier
+    FROM property_data;
+
+    INSERT INTO property_images
+    SELECT i, 'https://media.rightmove.co.uk/' || i || '_IMG_0' || k || '_0000.jpeg', NULL
+    FROM generate_series(1, %(properties)s) AS i, generate_series(0, 2) AS k;
+
+    INSERT INTO travel_time_precise
+    SELECT i, 10 + i %% 50
+    FROM generate_series(1, %(properties)s, 2) AS i;
+
+    INSERT INTO review_dates
+    SELECT DATE_TRUNC('day', now()) - d * INTERVAL '7 days', 3 - d, TO_CHAR(now() - d * INTERVAL '7 days', 'YYYY-MM-DD')
+    FROM generate_series(1, 2) AS d;
+
+    INSERT INTO reviewed_properties
+    SELECT i, DATE_TRUNC('day', now()) - (1 + i %% 2) * INTERVAL '7 days', TRUE
+    FROM generate_series(4, %(properties)s, 4) AS i;
+"""
+
+
+def seed(properties: int, versions: int = VERSIONS) -> None:
+    """
+    Migrate an empty database and fill it with synthetic properties, each with a number of versions in property_data.
+
+    Args:
+        properties (int): The number of properties.
+        versions (int): The number of rows of each property in property_data, the last of which is open.
+    """
+    migrate(apply_views=False)
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM property_data) OR EXISTS (SELECT 1 FROM property_location)")
+            if cursor.fetchone()[0]:
+                raise RuntimeError("The database already has property data, only an empty database can be seeded")
+            cursor.execute(SEED_SQL, {"properties": properties, "versions": versions})
+
+    # Rebuild the alert snapshot from the seeded data:
+    migrate()
+    with get_database_connection() as conn:
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("VACUUM ANALYZE")
+
+
+def capture_plans(print_plans: bool = False) -> Dict[str, Dict]:
+    """
+    Run EXPLAIN (ANALYZE, BUFFERS) on each query, rolling back anything it writes.
+
+    Returns:
+        Dict[str, Dict]: The plan nodes, shared buffers and execution time of each query.
+    """
+    cutoff, ids = dt.datetime.now() - dt.timedelta(days=1), list(range(1, 501))
+    queries = {name: (sql, {"cutoff": cutoff, "ids": ids}) for name, sql in VIEW_QUERIES.items()}
+
+    plans = {}
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            for name, get_args in STATEMENTS.items():
+                queries[name] = (statements.prepare(cursor, name).execute_sql, get_args(cutoff, ids))
+
+            for name, (sql, params) in queries.items():
+                cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", params)
+                result = cursor.fetchone()[0][0]
+                conn.rollback()
+
+                plan = result["Plan"]
+                plans[name] = {
+                    "nodes": plan_nodes(plan),
+                    "buffers": plan.get("Shared Hit Blocks", 0) + plan.get("Shared Read Blocks", 0),
+                    "ms": round(result["Execution Time"], 2),
+                }
+
+                if print_plans:
+                    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {sql}", params)
+                    print(f"{name}:\n" + "\n".join(row[0] for row in cursor.fetchall()) + "\n")
+                    conn.rollback()
+
+    return plans
+
+
+def find_regressions(baseline: Dict[str, Dict], plans: Dict[str, Dict]) -> List[str]:
+    """
+    Compare captured plans with the baseline.
+
+    Returns:
+        List[str]: A description of each regression.
+    """
+    regressions = []
+    for name, plan in plans.items():
+        if name not in baseline:
+            continue
+
+        expected = baseline[name]
+        new_scans = {node for node in plan["nodes"] if node.startswith("Seq Scan")} - set(expected["nodes"])
+        for node in sorted(new_scans):
+            regressions.append(f"{name}: new {node}")
+
+        if plan["buffers"] > expected["buffers"] * BUFFER_TOLERANCE + BUFFER_SLACK:
+            regressions.append(f"{name}: shared buffers {expected['buffers']} -> {plan['buffers']}")
+
+    return regressions
+
+
+def main(print_plans: bool = False, update: bool = False) -> int:
+    plans = capture_plans(print_plans)
+
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM property_data WHERE property_validto = '9999-12-31'")
+            properties = cursor.fetchone()[0]
+
+    if update:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump({"properties": properties, "queries": plans}, f, indent=2)
+        print(f"Recorded the plans of {len(plans)} queries with {properties} properties")
+        return 0
+
+    with open(BASELINE_FILE) as f:
+        baseline = json.load(f)
+    if baseline["properties"] != properties:
+        print(f"The baseline was recorded with {baseline['properties']} properties, this database has {properties}\n")
+
+    print(f"{'query':<32} {'buffers':>16} {'ms':>18}  plan")
+    for name, plan in plans.items():
+        expected = baseline["queries"].get(name, {"buffers": "-", "ms": "-", "nodes": None})
+        changed = "changed" if expected["nodes"] not in (None, plan["nodes"]) else ""
+        print(
+            f"{name:<32} {expected['buffers']:>7} -> {plan['buffers']:<6} {expected['ms']:>8} -> {plan['ms']:<8} "
+            f"{changed or ('new' if expected['nodes'] is None else '')}"
+        )
+
+    regressions = find_regressions(baseline["queries"], plans)
+    if regressions:
+        print("\nPlan regressions:\n" + "\n".join(regressions))
+        return 1
+
+    print("\nNo plan regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the query plans of the hot queries for regressions.")
+    parser.add_argument("--seed", type=int, help="Migrate and seed an empty database with this many properties")
+    parser.add_argument("--plans", action="store_true", help="Print the full EXPLAIN (ANALYZE, BUFFERS) plans")
+    parser.add_argument("--update", action="store_true", help="Record the current plans as the baseline")
+    args = parser.parse_args()
+
+    if args.seed:
+        seed(args.seed)
+    sys.exit(main(print_plans=args.plans, update=args.update))
@@ -0,0 +1,68 @@
+"""
+Benchmarks writing geolocation results back to the database, comparing the per-row pydantic / executemany
+path with the COPY based upsert used by update_locations.
+
+All writes are rolled back, so this can be run against the live database:
+
+    python -m benchmarks.update_locations
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from rightmove.database import get_database_connection, model_executemany
+from rightmove.geolocation import NO_TRAVEL_TIME, save_locations
+from rightmove.models import PropertyLocationExcluded, TravelTimePrecise
+
+N_POINTS = 100_000
+# Offset the IDs so that rolled back rows can never clash with real properties:
+ID_OFFSET = 2_000_000_000
+
+
+def make_results(n: int = N_POINTS) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "property_id": np.arange(ID_OFFSET, ID_OFFSET + n, dtype=np.int64),
+        "travel_time": rng.choice([10, 20, 30, 40, NO_TRAVEL_TIME], size=n).astype(np.int32),
+        "excluded": rng.random(n) < 0.05,
+    })
+
+
+def executemany_write(conn, df: pd.DataFrame) -> None:
+    travel_time_values = []
+    excluded_values = []
+    for index, row in df.iterrows():
+        travel_time_values.append(TravelTimePrecise(**row.to_dict()))
+        excluded_values.append(PropertyLocationExcluded(**row.to_dict()))
+
+    with conn.cursor() as cursor:
+        model_executemany(cursor, "travel_time_precise", travel_time_values)
+        model_executemany(cursor, "property_location_excluded", excluded_values)
+
+
+def copy_write(conn, df: pd.DataFrame) -> None:
+    save_locations(df, conn)
+    # Rerunning must update in place rather than fail on the primary key:
+    save_locations(df, conn)
+
+
+def timed(name: str, func, df: pd.DataFrame) -> None:
+    with get_database_connection() as conn:
+        start = time.perf_counter()
+        func(conn, df)
+        elapsed = time.perf_counter() - start
+        conn.rollback()
+
+    print(f"{name:<20} {len(df):>8,} rows  {elapsed:8.3f}s  {len(df) / elapsed:>12,.0f} rows/s")
+
+
+def main():
+    df = make_results()
+    timed("copy upsert (x2)", copy_write, df)
+    timed("executemany", executemany_write, df)
+
+
+if __name__ == "__main__":
+    main()
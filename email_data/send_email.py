@@ -14,7 +14,7 @@ from requests import HTTPError
 
 from config import BASE_DIR, BOOTSTRAP_UTIL, DATA, TEMPLATES
 from config.logging import logging_setup
-from rightmove.database import get_email_addresses, get_properties
+from rightmove.database import get_email_addresses, iter_properties
 
 # Setting up logger
 logger = logging.getLogger(__name__)
@@ -72,10 +72,7 @@ def prepare_email_html(review_id) -> bool:
     Returns:
         bool: True if successful, False otherwise
     """
-    review_filter = f"review_id = {review_id}"
-    properties = get_properties(review_filter)
-
-    # Render jinja2 template:
+    # Render jinja2 template, streaming the properties into the file:
     logger.info("Rendering template")
 
     env = Environment(loader=FileSystemLoader(TEMPLATES))
@@ -83,7 +80,7 @@ def prepare_email_html(review_id) -> bool:
 
     template = env.get_template("send_email_template.html")
     with open(JINJA_TEMPLATE, "w", encoding="utf-8") as f:
-        f.write(template.render(properties=properties))
+        f.writelines(template.generate(properties=iter_properties(int(review_id))))
 
     if bootstrap_email_path:
         logger.info(f"Creating output file: {BOOTSTRAP_TEMPLATE}")
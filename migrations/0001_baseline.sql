@@ -0,0 +1,134 @@
+-- Tables as they were before versioned migrations, every statement is idempotent so this can be applied to an existing
+-- database created from views.sql.
+
+CREATE TABLE IF NOT EXISTS email_details
+(
+    email_address varchar(100) NOT NULL PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS property_floorplan
+(
+    property_id   integer NOT NULL PRIMARY KEY,
+    floorplan_url varchar(1000),
+    area_sqft     double precision,
+    area_sqm      double precision,
+    area_source   varchar(20)
+);
+
+ALTER TABLE property_floorplan ADD COLUMN IF NOT EXISTS area_source varchar(20);
+
+CREATE TABLE IF NOT EXISTS property_summary
+(
+    property_id integer NOT NULL PRIMARY KEY,
+    summary     varchar(10000),
+    garden      varchar(50)
+);
+
+CREATE TABLE IF NOT EXISTS enhancement_queue
+(
+    property_id  integer     NOT NULL PRIMARY KEY,
+    status       varchar(12) NOT NULL DEFAULT 'pending',
+    attempts     smallint    NOT NULL DEFAULT 0,
+    next_attempt timestamp   NOT NULL DEFAULT now(),
+    locked_at    timestamp,
+    last_error   varchar(1000)
+);
+
+CREATE INDEX IF NOT EXISTS enhancement_queue_ready
+    ON enhancement_queue (next_attempt) WHERE status <> 'done';
+
+CREATE TABLE IF NOT EXISTS property_location_excluded
+(
+    property_id integer NOT NULL PRIMARY KEY,
+    excluded    boolean
+);
+
+CREATE TABLE IF NOT EXISTS property_data
+(
+    property_id           integer          NOT NULL,
+    property_validfrom    timestamp        NOT NULL,
+    property_validto      timestamp        NOT NULL,
+    bedrooms              integer,
+    bathrooms             integer,
+    area                  double precision,
+    summary               varchar          NOT NULL,
+    address               varchar          NOT NULL,
+    property_subtype      varchar,
+    property_description  varchar          NOT NULL,
+    premium_listing       boolean          NOT NULL,
+    price_amount          double precision NOT NULL,
+    price_frequency       varchar          NOT NULL,
+    price_qualifier       varchar,
+    lettings_agent        varchar          NOT NULL,
+    lettings_agent_branch varchar          NOT NULL,
+    development           boolean          NOT NULL,
+    commercial            boolean          NOT NULL,
+    enhanced_listing      boolean          NOT NULL,
+    students              boolean          NOT NULL,
+    auction               boolean          NOT NULL,
+    first_visible         timestamp,
+    last_update           timestamp,
+    last_displayed_update timestamp,
+    PRIMARY KEY (property_id, property_validfrom)
+);
+
+CREATE TABLE IF NOT EXISTS property_images
+(
+    property_id   integer NOT NULL,
+    image_url     varchar NOT NULL,
+    image_caption varchar,
+    PRIMARY KEY (property_id, image_url)
+);
+
+CREATE TABLE IF NOT EXISTS property_location
+(
+    property_id        serial
+        PRIMARY KEY,
+    property_asatdt    timestamp,
+    property_channel   varchar          NOT NULL,
+    property_longitude double precision NOT NULL,
+    property_latitude  double precision NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS review_dates
+(
+    reviewed_date timestamp NOT NULL
+        PRIMARY KEY,
+    email_id      integer,
+    str_date      varchar
+);
+
+CREATE TABLE IF NOT EXISTS reviewed_properties
+(
+    property_id   serial
+        PRIMARY KEY,
+    reviewed_date timestamp NOT NULL,
+    emailed       boolean   NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS travel_time_precise
+(
+    property_id serial
+        PRIMARY KEY,
+    travel_time integer
+);
+
+CREATE TABLE IF NOT EXISTS commute_destinations
+(
+    destination_id   smallserial
+        PRIMARY KEY,
+    destination_name varchar(100) NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS travel_time_matrix
+(
+    property_id    integer  NOT NULL,
+    destination_id smallint NOT NULL,
+    travel_time    smallint NOT NULL,
+    PRIMARY KEY (property_id, destination_id)
+);
+
+CREATE TABLE IF NOT EXISTS alert_properties_dirty
+(
+    property_id integer NOT NULL PRIMARY KEY
+);
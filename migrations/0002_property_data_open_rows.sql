@@ -0,0 +1,31 @@
+-- The current row of each property is its open row, with property_validto = '9999-12-31'. Rows which were loaded
+-- before this was enforced and are still valid (CURRENT_TIMESTAMP BETWEEN property_validfrom AND property_validto)
+-- are reopened, or closed when the next row of the same property starts, so each property has at most one open row:
+UPDATE property_data AS pd
+SET
+    property_validto = COALESCE(nr.next_validfrom, '9999-12-31')
+FROM
+    (
+        SELECT
+            property_id,
+            property_validfrom,
+            LEAD(property_validfrom) OVER (PARTITION BY property_id ORDER BY property_validfrom) AS next_validfrom
+        FROM
+            property_data
+        WHERE
+            property_id IN (
+                SELECT property_id
+                FROM property_data
+                WHERE property_validto > CURRENT_TIMESTAMP
+                GROUP BY property_id
+                HAVING COUNT(*) > 1 OR MAX(property_validto) <> '9999-12-31'
+            )
+    ) AS nr
+WHERE
+      pd.property_id = nr.property_id
+  AND pd.property_validfrom = nr.property_validfrom
+  AND pd.property_validto > CURRENT_TIMESTAMP
+  AND pd.property_validto <> COALESCE(nr.next_validfrom, '9999-12-31');
+
+CREATE UNIQUE INDEX IF NOT EXISTS property_data_open
+    ON property_data (property_id) WHERE property_validto = '9999-12-31';
@@ -0,0 +1,14 @@
+-- get_id_list and get_id_len filter the locations by channel and join them to property_data by ID:
+CREATE INDEX IF NOT EXISTS property_location_channel
+    ON property_location (property_channel, property_id);
+
+-- alert_properties reads the latest review date (MAX(reviewed_date)) on every query, and delete_property_review
+-- deletes the properties of a review by its date:
+CREATE INDEX IF NOT EXISTS reviewed_properties_reviewed_date
+    ON reviewed_properties (reviewed_date);
+
+-- start_date (MAX(property_validfrom)) is read by properties_current for every snapshot refresh:
+CREATE INDEX IF NOT EXISTS property_data_validfrom
+    ON property_data (property_validfrom);
+
+-- property_images needs no index on property_id, the (property_id, image_url) primary key already covers it.
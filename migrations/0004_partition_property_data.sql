@@ -0,0 +1,37 @@
+-- property_data is range partitioned on property_validto, so the open rows (property_validto = '9999-12-31') are in
+-- their own hot partition whatever the length of the history. Closed rows go to monthly partitions, created by
+-- rightmove.archive, which also archives old months to Parquet files. The default partition holds closed rows of
+-- months which don't have a partition yet.
+--
+-- The views on property_data are dropped here and recreated from views.sql after the migrations.
+DROP VIEW IF EXISTS start_date, properties_current CASCADE;
+
+ALTER TABLE property_data RENAME TO property_data_unpartitioned;
+ALTER INDEX property_data_pkey RENAME TO property_data_unpartitioned_pkey;
+DROP INDEX IF EXISTS property_data_open;
+DROP INDEX IF EXISTS property_data_validfrom;
+
+-- The primary key of a partitioned table must include the partition key:
+CREATE TABLE property_data
+(
+    LIKE property_data_unpartitioned INCLUDING DEFAULTS,
+    PRIMARY KEY (property_id, property_validfrom, property_validto)
+) PARTITION BY RANGE (property_validto);
+
+CREATE TABLE property_data_hot PARTITION OF property_data
+    FOR VALUES FROM ('9999-12-31') TO (MAXVALUE);
+
+CREATE TABLE property_data_history PARTITION OF property_data DEFAULT;
+
+CREATE UNIQUE INDEX property_data_open
+    ON property_data (property_id, property_validto) WHERE property_validto = '9999-12-31';
+
+CREATE INDEX property_data_validfrom
+    ON property_data (property_validfrom);
+
+INSERT INTO property_data
+SELECT * FROM property_data_unpartitioned;
+
+DROP TABLE property_data_unpartitioned;
+
+ANALYZE property_data;
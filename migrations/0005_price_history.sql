@@ -0,0 +1,41 @@
+-- The price of each property over time, one row per price change (and one for the first price), so price movements
+-- can be read without the wide versions of property_data. Rows are added by RightmoveDatabase.load_property_data.
+CREATE TABLE IF NOT EXISTS price_history
+(
+    property_id     integer          NOT NULL,
+    ts              timestamp        NOT NULL,
+    price_amount    double precision NOT NULL,
+    price_qualifier varchar,
+    PRIMARY KEY (property_id, ts)
+);
+
+-- "Reduced in the last N days" reads the recent changes of every property:
+CREATE INDEX IF NOT EXISTS price_history_ts
+    ON price_history (ts);
+
+-- Backfill from the existing versions, keeping the first version of each property and those where the price changed:
+INSERT INTO price_history
+SELECT
+    property_id,
+    property_validfrom,
+    price_amount,
+    price_qualifier
+FROM
+    (
+        SELECT
+            property_id,
+            property_validfrom,
+            price_amount,
+            price_qualifier,
+            LAG(property_validfrom) OVER w AS previous_validfrom,
+            LAG(price_amount) OVER w AS previous_amount,
+            LAG(price_qualifier) OVER w AS previous_qualifier
+        FROM
+            property_data
+        WINDOW w AS (PARTITION BY property_id ORDER BY property_validfrom)
+    ) AS versions
+WHERE
+     previous_validfrom IS NULL
+  OR previous_amount IS DISTINCT FROM price_amount
+  OR previous_qualifier IS DISTINCT FROM price_qualifier
+ON CONFLICT DO NOTHING;
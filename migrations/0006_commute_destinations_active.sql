@@ -0,0 +1,5 @@
+-- Destinations which are no longer in the shapes directory are kept (their IDs may be reused if they come back) but
+-- marked inactive, so commute_summary only aggregates the travel times of the current destinations. The flag is
+-- maintained by geolocation.get_destination_ids.
+ALTER TABLE commute_destinations
+    ADD COLUMN IF NOT EXISTS active boolean NOT NULL DEFAULT TRUE;
@@ -205,7 +205,7 @@ class Rightmove:
 
         try:
             data = r.json()["properties"]
-            await self.database.load_property_data(data, ids)
+            await self.database.load_property_data(data)
         except JSONDecodeError:
             data = None
 
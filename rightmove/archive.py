@@ -0,0 +1,190 @@
+import argparse
+import datetime as dt
+import logging
+import os
+import re
+from pathlib import Path
+from typing import List
+
+import pandas as pd
+from psycopg2 import sql
+
+from config import DATA
+from config.logging import logging_setup
+from rightmove.database import get_database_connection
+
+logger = logging.getLogger(__name__)
+logger = logging_setup(logger)
+
+ARCHIVE_DIR = os.path.join(DATA, "archive")
+HISTORY_RETENTION_DAYS = 365
+HISTORY_PARTITION_REGEX = re.compile(r"^property_data_(\d{4})_(\d{2})$")
+
+# Arbitrary key of the advisory lock held while the history partitions are changed:
+ARCHIVE_LOCK_KEY = 7_294_302
+
+
+def month_start(date: dt.datetime) -> dt.datetime:
+    return dt.datetime(date.year, date.month, 1)
+
+
+def next_month(date: dt.datetime) -> dt.datetime:
+    return dt.datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+
+
+def get_history_partitions(cursor) -> List[dt.datetime]:
+    """
+    The months which have a partition of closed rows in property_data (property_data_<year>_<month>).
+    """
+    cursor.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'property_data'::regclass
+        """)
+    months = []
+    for (name,) in cursor.fetchall():
+        match = HISTORY_PARTITION_REGEX.match(name)
+        if match:
+            months.append(dt.datetime(int(match.group(1)), int(match.group(2)), 1))
+
+    return sorted(months)
+
+
+def create_history_partitions(until: dt.datetime = None) -> List[str]:
+    """
+    Create the monthly partitions of closed property_data rows up to the month after `until`, so that rows closed in
+    the meantime don't go to the default partition. Rows which are in the default partition already are moved to
+    the partition of their month, which keeps the default partition small.
+
+    Args:
+        until (dt.datetime): Partitions are created up to the month after this date, by default now.
+
+    Returns:
+        List[str]: The names of the partitions which were created.
+    """
+    until = until or dt.datetime.now()
+    created = []
+
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (ARCHIVE_LOCK_KEY,))
+            existing = set(get_history_partitions(cursor))
+
+            cursor.execute("SELECT DISTINCT DATE_TRUNC('month', property_validto) FROM property_data_history")
+            months = {row[0] for row in cursor.fetchall()} | {month_start(until), next_month(month_start(until))}
+
+            for month in sorted(months - existing):
+                name = f"property_data_{month:%Y_%m}"
+                partition = sql.Identifier(name)
+                cursor.execute(sql.SQL("CREATE TABLE {} (LIKE property_data INCLUDING DEFAULTS)").format(partition))
+                cursor.execute(
+                    sql.SQL("""
+                        WITH moved AS (
+                            DELETE FROM property_data_history
+                            WHERE property_validto >= %(start)s AND property_validto < %(end)s
+                            RETURNING *
+                        )
+                        INSERT INTO {} SELECT * FROM moved
+                        """).format(partition),
+                    {"start": month, "end": next_month(month)},
+                )
+                cursor.execute(
+                    sql.SQL("ALTER TABLE property_data ATTACH PARTITION {} FOR VALUES FROM (%s) TO (%s)").format(
+                        partition
+                    ),
+                    (month, next_month(month)),
+                )
+                created.append(name)
+
+    if created:
+        logger.info(f"Created {len(created)} property_data history partitions: {', '.join(created)}")
+    return created
+
+
+def archive_history(retention_days: int = HISTORY_RETENTION_DAYS, directory: str = ARCHIVE_DIR) -> List[str]:
+    """
+    Archive the monthly partitions of closed property_data rows which ended more than retention_days ago. Each
+    partition is written to a compressed Parquet file (property_data_<year>_<month>.parquet) and then detached and
+    dropped, so the history kept in the database doesn't grow with time.
+
+    Args:
+        retention_days (int): Number of days closed rows are kept in the database.
+        directory (str): The directory of the Parquet files.
+
+    Returns:
+        List[str]: The paths of the Parquet files which were written.
+    """
+    cutoff = dt.datetime.now() - dt.timedelta(days=retention_days)
+    os.makedirs(directory, exist_ok=True)
+    files = []
+
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (ARCHIVE_LOCK_KEY,))
+            months = [month for month in get_history_partitions(cursor) if next_month(month) <= cutoff]
+
+        for month in months:
+            name = f"property_data_{month:%Y_%m}"
+            partition = sql.Identifier(name)
+            path = os.path.join(directory, f"{name}.parquet")
+            # Rows closed in a month which was archived already go to a new file rather than replacing the archive:
+            version = 1
+            while os.path.exists(path):
+                path = os.path.join(directory, f"{name}.{version}.parquet")
+                version += 1
+
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (ARCHIVE_LOCK_KEY,))
+                cursor.execute(sql.SQL("SELECT * FROM {} ORDER BY property_id, property_validfrom").format(partition))
+                df = pd.DataFrame.from_records(cursor.fetchall(), columns=[col.name for col in cursor.description])
+
+                # Written to a temporary file first, so an interrupted archive never leaves a partial file:
+                if len(df):
+                    df.to_parquet(f"{path}.tmp", compression="zstd", index=False)
+                    os.replace(f"{path}.tmp", path)
+
+                cursor.execute(sql.SQL("ALTER TABLE property_data DETACH PARTITION {}").format(partition))
+                cursor.execute(sql.SQL("DROP TABLE {}").format(partition))
+            conn.commit()
+
+            if len(df):
+                logger.info(f"Archived {len(df)} rows of {name} to {path}")
+                files.append(path)
+
+    return files
+
+
+def read_archive(directory: str = ARCHIVE_DIR) -> pd.DataFrame:
+    """
+    Read the archived property_data rows.
+
+    Args:
+        directory (str): The directory of the Parquet files.
+
+    Returns:
+        pd.DataFrame: The archived rows, with the columns of property_data.
+    """
+    files = sorted(Path(directory).glob("property_data_*.parquet"))
+    if not files:
+        return pd.DataFrame()
+
+    return pd.concat([pd.read_parquet(file) for file in files], ignore_index=True)
+
+
+def maintain_history(retention_days: int = HISTORY_RETENTION_DAYS, directory: str = ARCHIVE_DIR) -> None:
+    """
+    Create the upcoming history partitions, moving rows out of the default partition, and archive the partitions
+    which are past retention.
+    """
+    create_history_partitions()
+    archive_history(retention_days=retention_days, directory=directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Partition and archive the closed rows of property_data.")
+    parser.add_argument("--retention-days", type=int, default=HISTORY_RETENTION_DAYS)
+    parser.add_argument("--directory", default=ARCHIVE_DIR, help="Directory of the Parquet archive")
+    args = parser.parse_args()
+
+    maintain_history(retention_days=args.retention_days, directory=args.directory)
@@ -1,91 +1,286 @@
 import datetime as dt
-from typing import AsyncIterable, List, Set
+import logging
+import re
+from typing import AsyncIterable, Callable, Dict, List, Optional, Tuple, Type, TypeVar
 
 import asyncpg
+import numpy as np
 import pandas as pd
 from asyncpg.pool import Pool
 from pydantic import BaseModel
 
 from config import DATABASE_URI
-from rightmove.database import parse_added_or_reduced, parse_area
+from config.logging import logging_setup
+from rightmove import statements
 from rightmove.models import PropertyData
 
+logger = logging.getLogger(__name__)
+logger = logging_setup(logger)
 
-async def get_database_pool() -> Pool:
-    return await asyncpg.create_pool(DATABASE_URI, min_size=50, max_size=50)
+POOL_MIN_SIZE = 5
+POOL_MAX_SIZE = 50
+STATEMENT_CACHE_SIZE = 256
+ID_BATCH_SIZE = 25
 
+# Columns of property_data which aren't compared when deciding whether a property has changed:
+UNCOMPARED_COLUMNS = {"property_validfrom", "first_visible", "last_update"}
 
-async def async_model_executemany(conn, table_name: str, values: List[BaseModel]):
+Model = TypeVar("Model", bound=BaseModel)
+
+# Binary COPY layout of a (property_id int4, latitude float8, longitude float8) row:
+PGCOPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+PGCOPY_TRAILER = b"\xff\xff"
+LOCATION_RECORD = np.dtype([
+    ("field_count", ">i2"),
+    ("property_id_len", ">i4"),
+    ("property_id", ">i4"),
+    ("latitude_len", ">i4"),
+    ("latitude", ">f8"),
+    ("longitude_len", ">i4"),
+    ("longitude", ">f8"),
+])
+
+
+class LocationChunker:
     """
-    Insert a list of pydantic models into a database table using executemany.
+    Output sink for a binary COPY of property locations. The raw COPY buffers are viewed as a NumPy record array
+    and copied into preallocated arrays, with on_chunk(property_ids, points) called every time chunk_size rows
+    have been read, so memory use does not depend on the number of rows.
+    """
+
+    def __init__(self, on_chunk: Callable[[np.ndarray, np.ndarray], None], chunk_size: int = 100_000):
+        self.on_chunk = on_chunk
+        self.chunk_size = chunk_size
+        self.property_ids = np.empty(chunk_size, dtype=np.int64)
+        self.points = np.empty((chunk_size, 2), dtype=np.float64)
+        self.size = 0
+        self.rows = 0
+        self.pending = b""
+        self.header_read = False
+
+    async def __call__(self, data: bytes) -> None:
+        if self.pending:
+            data = self.pending + data
+            self.pending = b""
+
+        offset = 0
+        if not self.header_read:
+            if len(data) < 19:
+                self.pending = data
+                return
+            if data[:11] != PGCOPY_SIGNATURE:
+                raise ValueError("Unexpected binary COPY header.")
+            offset = 19 + int.from_bytes(data[15:19], "big")
+            self.header_read = True
+
+        count = (len(data) - offset) // LOCATION_RECORD.itemsize
+        records = np.frombuffer(data, dtype=LOCATION_RECORD, count=count, offset=offset)
+        offset += count * LOCATION_RECORD.itemsize
+
+        remainder = data[offset:]
+        if remainder != PGCOPY_TRAILER:
+            self.pending = remainder
+
+        if count and (records["field_count"] != 3).any():
+            raise ValueError("Unexpected field count in binary COPY data.")
+
+        start = 0
+        while start < count:
+            n = min(count - start, self.chunk_size - self.size)
+            rows = records[start : start + n]
+            self.property_ids[self.size : self.size + n] = rows["property_id"]
+            self.points[self.size : self.size + n, 0] = rows["latitude"]
+            self.points[self.size : self.size + n, 1] = rows["longitude"]
+            self.size += n
+            start += n
+            if self.size == self.chunk_size:
+                self.flush()
+
+    def flush(self) -> None:
+        """
+        Pass any buffered rows to on_chunk.
+        """
+        if self.size == 0:
+            return
+
+        self.on_chunk(self.property_ids[: self.size], self.points[: self.size])
+        self.rows += self.size
+        self.size = 0
+
+
+async def stream_locations(
+    on_chunk: Callable[[np.ndarray, np.ndarray], None],
+    ids: List[int] = None,
+    chunk_size: int = 100_000,
+) -> int:
+    """
+    Stream the locations of properties which require a travel time calculation (or the given property IDs) in
+    chunks, using a binary COPY so that no Python objects are created per row.
+
+    The arrays passed to on_chunk are reused for the next chunk, so they must be copied if they are kept.
 
     Args:
-        conn: The database connection.
-        table_name (str): The name of the table in the database.
-        values (List[BaseModel]): The list of pydantic models to be inserted into the database.
+        on_chunk (Callable): Function called with an array of property IDs and an (n, 2) array of latitude,
+            longitude points for every chunk.
+        ids (List[int]): Optional list of property IDs to load instead of those not yet reviewed.
+        chunk_size (int): Maximum number of rows passed to on_chunk at a time.
+
+    Returns:
+        int: The number of locations read.
+    """
+    name, args = ("unreviewed_alert_locations", []) if ids is None else ("alert_locations", [list(ids)])
+
+    chunker = LocationChunker(on_chunk, chunk_size=chunk_size)
+    conn = await asyncpg.connect(DATABASE_URI)
+    try:
+        with statements.timed(name):
+            await conn.copy_from_query(statements.STATEMENTS[name].sql, *args, output=chunker, format="binary")
+    finally:
+        await conn.close()
+
+    chunker.flush()
+    return chunker.rows
+
+
+def parse_area(area_str: Optional[str]) -> Optional[float]:
     """
-    if len(values) == 0:
-        return
+    Parse the area from a string.
 
-    # Get the model fields
-    model_field_names = [field for field in values[0].model_fields]
+    Args:
+        area_str (str): The string containing the area.
 
-    # Construct the insert query
-    placeholders = ",".join([f"${i + 1}" for i in range(len(model_field_names))])
-    insert_query = f"""
-        INSERT INTO {table_name} ({','.join(model_field_names)})
-        VALUES ({placeholders})
+    Returns:
+        float: The parsed area as a float, or None if the area could not be parsed.
     """
 
-    # Insert the values using executemany
-    await conn.executemany(insert_query, [tuple(model.model_dump().values()) for model in values])
+    if area_str and "sq" in area_str:
+        return float(re.match(r"\d{1,3}(,\d{3})*(\.\d+)?", area_str).group(0).replace(",", ""))
+    else:
+        return None
 
 
-async def insert_property_images(conn, property_images):
+def parse_added_or_reduced(added_or_reduced_str):
     """
-    Insert property images into the database using executemany.
+    Parse the added or reduced date from a string.
 
     Args:
-        cursor: The database cursor.
-        property_images: The property images to be inserted into the database.
+        added_or_reduced_str (str): The string containing the added or reduced date.
+
+    Returns:
+        dt.datetime: The parsed date as a datetime object, or None if the date could not be parsed.
     """
+    try:
+        added_or_reduced = pd.to_datetime(added_or_reduced_str.split(" ")[-1], dayfirst=True)
+        if str(added_or_reduced) == "NaT":
+            added_or_reduced = None
 
-    # Insert property images into the database using executemany
-    insert_query = """
-        INSERT INTO property_images (property_id, image_url, image_caption)
-        VALUES ($1, $2, $3)
-        ON CONFLICT (property_id, image_url) DO NOTHING
+    except Exception:
+        added_or_reduced = None
+
+    return added_or_reduced
+
+
+def make_property_data(prop: Dict, current_time: dt.datetime) -> PropertyData:
+    """
+    Convert a property from the Rightmove searchByIds API to a property_data row which is valid from current_time.
     """
-    await conn.executemany(insert_query, property_images)
+    return PropertyData(
+        property_id=prop["id"],
+        property_validfrom=current_time,
+        bedrooms=prop["bedrooms"],
+        bathrooms=prop.get("bathrooms"),
+        area=parse_area(prop.get("displaySize")),
+        summary=prop.get("summary"),
+        address=prop["displayAddress"],
+        property_subtype=prop["propertySubType"],
+        property_description=prop["propertyTypeFullDescription"],
+        premium_listing=prop["premiumListing"],
+        price_amount=prop["price"]["amount"],
+        price_frequency=prop["price"]["frequency"],
+        price_qualifier=prop["price"]["displayPrices"][0].get("displayPriceQualifier"),
+        lettings_agent=prop["customer"]["brandTradingName"],
+        lettings_agent_branch=prop["customer"]["branchName"],
+        development=prop["development"],
+        commercial=prop["commercial"],
+        enhanced_listing=prop["enhancedListing"],
+        students=prop["students"],
+        auction=prop["auction"],
+        last_update=current_time,
+        first_visible=pd.to_datetime(prop["firstVisibleDate"]).tz_localize(None),
+        last_displayed_update=parse_added_or_reduced(prop.get("addedOrReduced")),
+    )
+
+
+def has_changes(existing: PropertyData, new: PropertyData) -> bool:
+    """
+    Check if a property has changed since its existing row, ignoring the columns in UNCOMPARED_COLUMNS.
+    """
+    return existing.model_dump(exclude=UNCOMPARED_COLUMNS) != new.model_dump(exclude=UNCOMPARED_COLUMNS)
+
+
+def has_price_change(existing: PropertyData, new: PropertyData) -> bool:
+    """
+    Check if the price of a property has changed since its existing row.
+    """
+    return (existing.price_amount, existing.price_qualifier) != (new.price_amount, new.price_qualifier)
+
+
+async def fetch_models(conn, model: Type[Model], name: str, *args) -> List[Model]:
+    """
+    Run a statement from the catalogue and decode each row into a pydantic model, e.g. the rows of property_data
+    into PropertyData.
+
+    Args:
+        conn: The database connection.
+        model (Type[BaseModel]): The model of the rows, with a field for each column.
+        name (str): The name of the statement.
+        *args: The statement arguments.
+
+    Returns:
+        List[BaseModel]: The rows as models.
+    """
+    return [model.model_validate(dict(record)) for record in await statements.fetch(conn, name, *args)]
+
+
+def id_list_query(update: bool, update_cutoff: dt.datetime = None) -> Tuple[str, List]:
+    """
+    The statement name and extra arguments (after the channel) of the property IDs which need data from the
+    searchByIds API.
+    """
+    if not update:
+        return "new_property_ids", []
+    if update_cutoff:
+        return "outdated_property_ids", [update_cutoff]
+    return "all_property_ids", []
 
 
 class RightmoveDatabase:
-    def __init__(self):
-        return
+    """
+    Data access for the Rightmove search and property data, on an asyncpg connection pool. Every query is a named
+    statement from rightmove.statements with bound arguments, so asyncpg prepares it once per connection and reuses
+    it from the statement cache. The pool is created on entering the async context manager, see rightmove.database.RightmoveDatabase for
+    the synchronous facade.
+    """
+
+    def __init__(self, dsn: str = DATABASE_URI, min_size: int = POOL_MIN_SIZE, max_size: int = POOL_MAX_SIZE):
+        self.dsn = dsn
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.pool: Pool = None
 
     async def __aenter__(self):
-        self.pool: Pool = await get_database_pool()
+        self.pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            statement_cache_size=STATEMENT_CACHE_SIZE,
+        )
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.pool.close()
 
-    async def _close_missing_properties(self, missing_ids: Set[int]) -> None:
-        """
-        Closes the validto variable for properties which are no longer on the Rightmove website.
-
-        Args:
-            missing_ids (Set[int]): A set of IDs for the properties which are no longer on the Rightmove website.
-        """
-        async with self.pool.acquire() as conn:
-            current_time: dt.datetime = dt.datetime.now()
-            await conn.execute(f"""
-                UPDATE property_data
-                SET property_validto = '{current_time}'
-                WHERE property_id IN ({','.join([str(id) for id in missing_ids])})
-            """)
-
-    async def get_id_len(self, update, channel, update_cutoff=None):
+    async def get_id_len(self, update: bool, channel: str, update_cutoff: dt.datetime = None) -> int:
         """
         Returns the number of property IDs that would be returned in the get_id_list() function.
 
@@ -97,32 +292,12 @@ class RightmoveDatabase:
         Returns:
             int: Number of properties which would be in the list.
         """
+        name, args = id_list_query(update, update_cutoff)
+        return await statements.fetchval(self.pool, f"count_{name}", channel, *args)
 
-        async with self.pool.acquire() as conn:
-            current_time = dt.datetime.now()
-            sql = f"""
-                    SELECT COUNT(DISTINCT pl.property_id)
-                    FROM property_location pl
-                    LEFT JOIN property_data pd ON pl.property_id = pd.property_id
-                    WHERE pl.property_channel = '{channel}'
-                """
-            if update:
-                if update_cutoff:
-                    sql += f"""
-                                    AND (
-                                        (pd.last_update < '{update_cutoff}' OR pd.last_update IS NULL)
-                                        AND pd.property_validto >= '{current_time}'
-                                        OR pd.property_id IS NULL
-                                    )
-                                """
-            else:
-                sql += "AND pd.property_id IS NULL"
-
-            result = await conn.fetchrow(sql)
-
-            return result[0]
-
-    async def get_id_list(self, update: bool, channel: str, update_cutoff=None) -> AsyncIterable[List[int]]:
+    async def get_id_list(
+        self, update: bool, channel: str, update_cutoff: dt.datetime = None
+    ) -> AsyncIterable[List[int]]:
         """
         Generator for a list of IDs which can be used to search the Rightmove API, this list will be a
         maximum size of 25, and the generator will stop once all IDs have been yielded.
@@ -135,204 +310,93 @@ class RightmoveDatabase:
         Returns:
             List[List[int]]: A list of Property ID integers.
         """
+        name, args = id_list_query(update, update_cutoff)
+        ids = [record[0] for record in await statements.fetch(self.pool, name, channel, *args)]
 
-        async with self.pool.acquire() as conn:
-            current_time = dt.datetime.now()
-
-            sql = f"""
-                SELECT pl.property_id
-                FROM property_location pl
-                LEFT JOIN property_data pd ON pl.property_id = pd.property_id
-                WHERE pl.property_channel = '{channel}'
-            """
-
-            if update:
-                if update_cutoff:
-                    sql += f"""
-                        AND (
-                            (pd.last_update < '{update_cutoff}' OR pd.last_update IS NULL)
-                            AND pd.property_validto >= '{current_time}'
-                            OR pd.property_id IS NULL
-                        )
-                    """
-
-            else:
-                sql += "AND pd.property_id IS NULL"
+        for start in range(0, len(ids), ID_BATCH_SIZE):
+            yield ids[start : start + ID_BATCH_SIZE]
 
-            ids = []
-            results_raw = await conn.fetch(sql)
-            results = set([x[0] for x in results_raw])
-
-        for result in results:
-            ids.append(result)
-            if len(ids) == 25:
-                yield ids
-                ids = []
-        if len(ids) > 0:
-            yield ids
+    async def load_map_properties(self, properties: Dict, channel: str) -> None:
+        """
+        Loads the locations of the properties from the Rightmove map search API into the database, properties which
+        already have a location are left as they are.
 
-    async def load_map_properties(self, properties: dict, channel: str) -> None:
+        Args:
+            properties (Dict): The properties from the map search API, by property ID.
+            channel (str): The channel which was searched (RENT/BUY).
         """
-        Loads the data obtained from the Rightmove API into the database.
-        :param properties:      Dictionary      JSON response from the Rightmove API.
-        :param channel          String          The channel which searched for in the API.
+        if len(properties) == 0:
+            return
+
+        values = list(properties.values())
+        await statements.execute_async(
+            self.pool,
+            "insert_locations",
+            [prop["id"] for prop in values],
+            [prop["location"]["latitude"] for prop in values],
+            [prop["location"]["longitude"] for prop in values],
+            dt.datetime.now(),
+            channel.upper(),
+        )
+
+    async def load_property_data(self, data: List[Dict]) -> None:
         """
-        async with self.pool.acquire() as conn:
-            current_time = dt.datetime.now()
-            channel = channel.upper()
-
-            # Check for existing IDs in the database:
-            if len(properties) == 0:
-                return
+        Loads the data of properties from the Rightmove searchByIds API into the database in one transaction. A
+        property which has changed has its current row closed and a new row inserted, a new property has a row
+        inserted, and the images of every property are added. New prices are added to price_history.
 
-            await conn.execute(f"""
-                SELECT property_id 
-                FROM property_location 
-                WHERE property_id IN ({','.join([str(p) for p in properties.keys()])})""")
-
-            ids_raw = await conn.fetch()
-            existing_ids: set = {r[0] for r in ids_raw}
-
-            insert_values = []
-            for property_data in properties.values():
-                if property_data["id"] in existing_ids:
-                    continue
-
-                insert_values.append((
-                    property_data["id"],
-                    current_time,
-                    channel,
-                    property_data["location"]["latitude"],
-                    property_data["location"]["longitude"],
-                ))
-
-            if len(insert_values) > 0:
-                sql = """
-                    INSERT INTO property_location (
-                        property_id,
-                        property_asatdt,
-                        property_channel,
-                        property_latitude,
-                        property_longitude
-                    ) VALUES ($1, $2, $3, $4, $5)
-                    """
-                await conn.executemany(sql, insert_values)
-
-    async def load_property_data(self, data: dict, ids: list[int]) -> None:
-
-        async with self.pool.acquire() as conn:
-            try:
-                # Retrieve existing property IDs from the database
-                ids_raw = await conn.fetch("SELECT property_id FROM property_data")
-                existing_ids = {row["property_id"] for row in ids_raw}
-
-                # Set validto for properties which are no longer on the Rightmove website:
-                missing_ids = set(ids) - existing_ids
-                if missing_ids:
-                    await self._close_missing_properties(missing_ids)
-
-                current_time = dt.datetime.now()
-
-                for prop in data:
-                    property_id = prop["id"]
-
-                    # Check for an existing record which is currently valid:
-                    existing_record = await conn.fetchrow(
-                        """
-                        SELECT * FROM property_data
-                        WHERE property_id = $1 AND property_validto >= $2
-                        """,
-                        property_id,
-                        current_time,
-                    )
-
-                    # Parse the Area of the property:
-                    area_str = prop.get("displaySize")
-                    area = parse_area(area_str)
-
-                    # Get the 'display update date':
-                    added_or_reduced = parse_added_or_reduced(prop.get("addedOrReduced"))
-
-                    # Construct the property data dictionary
-                    property_data = PropertyData(
-                        property_id=property_id,
-                        property_validfrom=current_time,
-                        bedrooms=prop["bedrooms"],
-                        bathrooms=prop.get("bathrooms"),
-                        area=area,
-                        summary=prop.get("summary"),
-                        address=prop["displayAddress"],
-                        property_subtype=prop["propertySubType"],
-                        property_description=prop["propertyTypeFullDescription"],
-                        premium_listing=prop["premiumListing"],
-                        price_amount=prop["price"]["amount"],
-                        price_frequency=prop["price"]["frequency"],
-                        price_qualifier=prop["price"]["displayPrices"][0].get("displayPriceQualifier"),
-                        lettings_agent=prop["customer"]["brandTradingName"],
-                        lettings_agent_branch=prop["customer"]["branchName"],
-                        development=prop["development"],
-                        commercial=prop["commercial"],
-                        enhanced_listing=prop["enhancedListing"],
-                        students=prop["students"],
-                        auction=prop["auction"],
-                        last_update=current_time,
-                        first_visible=pd.to_datetime(prop["firstVisibleDate"]).tz_localize(None),
-                        last_displayed_update=added_or_reduced,
-                    )
-
-                    insert_list = []
-                    # Check for changes in property data
-                    if existing_record and self.has_changes(existing_record, property_data):
-                        # Mark the existing record as no longer valid
-                        await conn.execute(
-                            """
-                            UPDATE property_data
-                            SET property_validto = $1
-                            WHERE property_id = $2 AND property_validto >= $3
-                            """,
-                            current_time,
-                            property_id,
-                            current_time,
+        Args:
+            data (List[Dict]): The properties from the searchByIds API.
+        """
+        if not data:
+            return
+
+        current_time = dt.datetime.now()
+        try:
+            rows = list({prop["id"]: make_property_data(prop, current_time) for prop in data}.values())
+            images = [
+                (prop["id"], image["srcUrl"], image["caption"])
+                for prop in data
+                for image in prop["propertyImages"]["images"]
+            ]
+
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    existing = {
+                        row.property_id: row
+                        for row in await fetch_models(
+                            conn, PropertyData, "current_property_data", [row.property_id for row in rows]
                         )
-                        # Insert a new record with updated data
-                        insert_list.append(property_data)
-                    elif not existing_record:
-                        # Insert a new record if no existing record is found
-                        insert_list.append(property_data)
-
-                    if insert_list:
-                        await async_model_executemany(conn, "property_data", insert_list)
-
-                    # Insert property images using executemany
-                    property_images = [
-                        (property_id, img_data["srcUrl"], img_data["caption"])
-                        for img_data in prop["propertyImages"]["images"]
+                    }
+                    changed = [
+                        row
+                        for row in rows
+                        if row.property_id not in existing or has_changes(existing[row.property_id], row)
                     ]
-                    if property_images:
-                        await insert_property_images(conn, property_images)
-
-            except Exception as e:
-                # Handle exceptions and log if needed
-                print(f"Error: {e}")
-
-    def has_changes(self, existing_record, data):
-        """
-        Check if there are changes between the existing record and new data.
 
-        Parameters:
-        - existing_record: Dictionary representing the existing record in the database.
-        - new_data: Dictionary representing the new data to be compared.
-
-        Returns:
-        - True if there are changes, False otherwise.
-        """
-        new_data = data.model_dump()
-        for key, value in new_data.items():
-            if key in ["property_validfrom", "first_visible", "last_update"]:
-                continue  # Skip these keys as they are not considered for changes
+                    closed = [row.property_id for row in changed if row.property_id in existing]
+                    if closed:
+                        await statements.execute_async(conn, "close_property_data", closed, current_time)
+
+                    if changed:
+                        columns = list(PropertyData.model_fields)
+                        with statements.timed("copy_property_data"):
+                            await conn.copy_records_to_table(
+                                "property_data",
+                                records=[tuple(row.model_dump().values()) for row in changed],
+                                columns=columns,
+                            )
+
+                    prices = [
+                        (row.property_id, current_time, row.price_amount, row.price_qualifier)
+                        for row in changed
+                        if row.property_id not in existing or has_price_change(existing[row.property_id], row)
+                    ]
+                    if prices:
+                        await statements.execute_async(conn, "insert_price_history", *map(list, zip(*prices)))
 
-            existing_value = existing_record.get(key)
-            if existing_value != value:
-                return True  # Changes found
+                    if images:
+                        await statements.execute_async(conn, "insert_property_images", *map(list, zip(*images)))
 
-        return False  # No changes
+        except Exception as e:
+            logger.error(f"Failed to load property data for {len(data)} properties: {e}")
@@ -1,25 +1,248 @@
+import asyncio
 import datetime as dt
-import re
-from typing import List, Set
+import io
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
 
 import pandas as pd
 import psycopg2
-from psycopg2 import extras
+from psycopg2 import extensions, pool
 from pydantic import BaseModel
 
 from config import DATABASE_URI
-from rightmove.models import EmailAddress, PropertyData, ReviewDates, ReviewedProperties
+from rightmove import statements
+from rightmove.async_database import RightmoveDatabase as AsyncRightmoveDatabase
+from rightmove.models import EmailAddress, ReviewDates, ReviewedProperties
+
+ENHANCEMENT_MAX_ATTEMPTS = 5
+ENHANCEMENT_STALE_AFTER = dt.timedelta(minutes=30)
+ENHANCEMENT_RETRY_BASE = dt.timedelta(minutes=15)
+ENHANCEMENT_RETRY_MAX = dt.timedelta(days=1)
+
+POOL_MIN_CONNECTIONS = 4
+POOL_MAX_CONNECTIONS = 10
+POOL_TIMEOUT = 30
+POOL_HEALTH_CHECK_AFTER = 60
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of database connections, shared by every helper in the process (see get_connection_pool).
+
+    Connections are borrowed with the connection() context manager. When every connection is in use, callers wait
+    up to timeout seconds for one to be returned, rather than failing like psycopg2's ThreadedConnectionPool. A
+    connection which has been idle for longer than health_check_after seconds is checked with SELECT 1 before it is
+    handed out, and replaced if it's broken, e.g. after the database has restarted.
+    """
+
+    def __init__(
+        self,
+        dsn: str = DATABASE_URI,
+        min_connections: int = POOL_MIN_CONNECTIONS,
+        max_connections: int = POOL_MAX_CONNECTIONS,
+        timeout: float = POOL_TIMEOUT,
+        health_check_after: float = POOL_HEALTH_CHECK_AFTER,
+    ):
+        """
+        Args:
+            dsn (str): The database URI.
+            min_connections (int): Number of connections opened up front, which is also the number of idle
+                connections kept open, any more are closed when they are returned.
+            max_connections (int): Maximum number of open connections.
+            timeout (float): Seconds to wait for a free connection before raising a PoolError.
+            health_check_after (float): Seconds a connection can be idle before it's checked when borrowed.
+        """
+        self.pool = pool.ThreadedConnectionPool(min_connections, max_connections, dsn)
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.pid = os.getpid()
+
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.last_used: Dict[int, float] = {}
+
+        self.checkouts = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+        self.health_checks = 0
+        self.health_check_failures = 0
+
+    def is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+
+        with self.lock:
+            idle = time.monotonic() - self.last_used.get(id(conn), 0.0)
+        if idle < self.health_check_after:
+            return True
+
+        with self.lock:
+            self.health_checks += 1
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            with self.lock:
+                self.health_check_failures += 1
+            return False
+
+    def getconn(self):
+        """
+        Borrow a healthy connection, which must be returned with putconn.
+        """
+        start = time.monotonic()
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.timeouts += 1
+            raise pool.PoolError(f"No database connection became free within {self.timeout} seconds")
+        waited = time.monotonic() - start
+
+        try:
+            conn = self.pool.getconn()
+            while not self.is_healthy(conn):
+                self.pool.putconn(conn, close=True)
+                conn = self.pool.getconn()
+        except BaseException:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+
+        return conn
+
+    def putconn(self, conn) -> None:
+        """
+        Return a borrowed connection to the pool, rolling back anything left uncommitted.
+        """
+        try:
+            broken = bool(conn.closed)
+            if not broken:
+                try:
+                    if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                    conn.autocommit = False
+                except psycopg2.Error:
+                    broken = True
+
+            self.pool.putconn(conn, close=broken)
+            with self.lock:
+                self.in_use -= 1
+                if conn.closed:
+                    self.last_used.pop(id(conn), None)
+                else:
+                    self.last_used[id(conn)] = time.monotonic()
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator:
+        """
+        Borrow a connection for the duration of a with block, which is committed if the block succeeds and rolled
+        back if it raises.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+            if not conn.closed:
+                conn.commit()
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.putconn(conn)
+
+    def metrics(self) -> Dict:
+        """
+        Counters of the pool since it was created.
+
+        Returns:
+            Dict: The maximum and in use number of connections, the number of checkouts, the total and maximum time
+                spent waiting for a free connection, the number of waits which timed out, and the number of health
+                checks and how many of them failed.
+        """
+        with self.lock:
+            return {
+                "max_connections": self.max_connections,
+                "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use,
+                "checkouts": self.checkouts,
+                "wait_seconds": round(self.wait_time, 3),
+                "max_wait_seconds": round(self.max_wait_time, 3),
+                "timeouts": self.timeouts,
+                "health_checks": self.health_checks,
+                "health_check_failures": self.health_check_failures,
+            }
+
+    def close(self) -> None:
+        self.pool.closeall()
+
+
+_connection_pool: ConnectionPool = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool() -> ConnectionPool:
+    """
+    Get the connection pool of this process, which is created on first use, and again in a forked child process
+    since connections can't be shared between processes.
+
+    Returns:
+        ConnectionPool: The connection pool.
+    """
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None or _connection_pool.pid != os.getpid():
+            _connection_pool = ConnectionPool()
+        return _connection_pool
 
 
 def get_database_connection():
     """
-    Establish a connection to the database.
+    Borrow a connection to the database from the connection pool, for use as a context manager:
+
+        with get_database_connection() as conn:
+            ...
+
+    The connection is committed at the end of the with block, or rolled back if it raises, and then returned to
+    the pool.
 
     Returns:
-        conn: A connection object to the database.
+        A context manager of a connection object to the database.
     """
-    conn = psycopg2.connect(DATABASE_URI)
-    return conn
+    return get_connection_pool().connection()
+
+
+def check_database_health() -> Dict:
+    """
+    Check that the database can be queried through the connection pool.
+
+    Returns:
+        Dict: "healthy" and, if the check failed, "error", along with the metrics of the connection pool.
+    """
+    try:
+        with get_database_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        health = {"healthy": True}
+    except (psycopg2.Error, pool.PoolError) as e:
+        health = {"healthy": False, "error": str(e)}
+
+    return {**health, "pool": get_connection_pool().metrics()}
 
 
 def get_email_addresses() -> List[str]:
@@ -31,8 +254,7 @@ def get_email_addresses() -> List[str]:
     """
     with get_database_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("SELECT email_address FROM email_details")
-            return [row[0] for row in cursor.fetchall()]
+            return [row[0] for row in statements.execute(cursor, "email_addresses").fetchall()]
 
 
 def set_email_addresses(email_addresses: List[EmailAddress]) -> None:
@@ -45,7 +267,7 @@ def set_email_addresses(email_addresses: List[EmailAddress]) -> None:
     """
     with get_database_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("DELETE FROM email_details")
+            statements.execute(cursor, "delete_email_addresses")
             model_executemany(cursor, "email_details", email_addresses)
 
 
@@ -56,99 +278,187 @@ def get_property_reviews() -> List[dict]:
     Returns:
         List[dict]: A list of dictionaries where each dictionary represents a property review.
     """
-    # Get review dates:
-    sql = "select distinct email_id, str_date from review_dates order by email_id desc"
     with get_database_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(sql)
-            return [{"email_id": row[0], "str_date": row[1]} for row in cursor.fetchall()]
+            rows = statements.execute(cursor, "property_reviews").fetchall()
+            return [{"email_id": row[0], "str_date": row[1]} for row in rows]
 
 
-def delete_property_review(review_id: str) -> None:
+def delete_property_review(review_id: int) -> None:
     """
     Delete a property review from the database.
 
     Args:
-        review_id (str): The ID of the review to be deleted.
+        review_id (int): The ID of the review to be deleted.
     """
     with get_database_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(f"select reviewed_date from review_dates where email_id={review_id}")
-            date = cursor.fetchone()[0]
+            statements.execute(cursor, "delete_reviewed_properties", int(review_id))
+            statements.execute(cursor, "delete_review", int(review_id))
+            statements.execute(cursor, "refresh_alert_properties")
 
-            cursor.execute(f"delete from review_dates where email_id={review_id}")
-            cursor.execute(f"delete from reviewed_properties where reviewed_date='{date}'")
 
-            conn.commit()
+def refresh_alert_properties() -> int:
+    """
+    Refresh the alert_properties snapshot for the properties which have changed since the last refresh, this is
+    called at the end of each stage which writes property data.
+
+    Returns:
+        int: The number of properties refreshed.
+    """
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            return statements.execute(cursor, "refresh_alert_properties").fetchone()[0]
 
 
 def get_new_property_count() -> int:
     """
     Get the count of new properties from the database.
 
-    This function queries the 'alert_properties' table in the database and counts the number of properties
-    where the 'review_id' is NULL, indicating that these properties are new and have not been reviewed yet.
+    This is the number of properties in 'alert_properties' where the 'review_id' is NULL, indicating that these
+    properties are new and have not been reviewed yet. It's read from the 'alert_new_counts' table, which triggers
+    on the alert snapshot keep up to date, rather than from the view.
 
     Returns:
         int: The count of new properties.
     """
     with get_database_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("SELECT COUNT(*) FROM alert_properties WHERE review_id IS NULL")
-            return cursor.fetchone()[0]
+            return statements.execute(cursor, "new_property_count").fetchone()[0]
 
 
-def get_enhancement_properties() -> List[int]:
+def get_reduced_properties(days: int = 7) -> pd.DataFrame:
     """
-    Function to get a list of property IDs which require enhanced data from the Rightmove property page.
+    Get the price reductions of the last N days from price_history, without reading the versions of property_data.
+
+    Args:
+        days (int): Number of days to look back.
 
     Returns:
-        List[int]: A list of property IDs.
+        pd.DataFrame: property_id, ts, previous_price, price and reduction of each reduction, most recent first.
     """
     with get_database_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT DISTINCT ap.property_id
-                FROM alert_properties ap
-                LEFT JOIN property_floorplan pf using (property_id)
-                WHERE pf.property_id IS NULL and ap.area is null
-                """)
-            return [row[0] for row in cursor.fetchall()]
+            statements.execute(cursor, "reduced_properties", int(days))
+            return pd.DataFrame.from_records(cursor.fetchall(), columns=[col.name for col in cursor.description])
 
 
-def insert_models(models: List[BaseModel], table: str) -> None:
+def get_price_trajectories(property_ids: List[int]) -> Dict[int, pd.DataFrame]:
     """
-    Function to insert a list of floorplans into the database.
+    Get the price of each property over time from price_history.
 
     Args:
-        models (List[BaseModel]): A list of BaseModel objects to be inserted into the database.
-        table (str): The name of the table in the database.
+        property_ids (List[int]): The IDs of the properties.
+
+    Returns:
+        Dict[int, pd.DataFrame]: The ts, price_amount and price_qualifier of each price of a property, in time order,
+            by property ID. Properties without a price are left out.
     """
     with get_database_connection() as conn:
         with conn.cursor() as cursor:
-            model_executemany(cursor, table, models)
+            statements.execute(cursor, "price_trajectories", list(property_ids))
+            df = pd.DataFrame.from_records(cursor.fetchall(), columns=[col.name for col in cursor.description])
 
+    return {
+        property_id: prices.drop(columns="property_id").reset_index(drop=True)
+        for property_id, prices in df.groupby("property_id")
+    }
 
-def get_location_dataframe(ids: List[int] = None) -> pd.DataFrame:
+
+def enqueue_enhancement_properties(ids: List[int] = None) -> int:
     """
-    Function to get the details of properties which require a travel time calculation.
+    Add properties which require enhanced data from the Rightmove property page to the enhancement queue. Explicit
+    property IDs which are already queued are reset to be retried straight away (unless they are in progress), while
+    alert properties which are already queued are left as they are.
+
+    Args:
+        ids (List[int]): Property IDs to queue, by default every alert property without an area or floorplan.
 
     Returns:
-        pd.DataFrame: A DataFrame containing the details of properties which require a travel time calculation.
+        int: The number of properties added to or reset in the queue.
     """
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            if ids is not None:
+                statements.execute(cursor, "enqueue_enhancement_ids", list(ids))
+            else:
+                statements.execute(cursor, "enqueue_enhancement_alerts")
+            return cursor.rowcount
 
-    if ids is None:
-        sql = "SELECT property_id, longitude, latitude FROM alert_properties where travel_reviewed = 0"
 
-    else:
-        sql = (
-            "SELECT property_id, longitude, latitude FROM alert_properties where"
-            f" property_id in ({','.join([str(id) for id in ids])})"
-        )
+def claim_enhancement_properties(
+    limit: int,
+    ids: List[int] = None,
+    max_attempts: int = ENHANCEMENT_MAX_ATTEMPTS,
+    stale_after: dt.timedelta = ENHANCEMENT_STALE_AFTER,
+) -> List[int]:
+    """
+    Claim a batch of properties from the enhancement queue for this worker, marking them as in progress. Rows locked
+    by other workers are skipped, so several worker processes can share the queue, and properties left in progress
+    for longer than stale_after (e.g. by a crashed worker) are claimed again.
+
+    Args:
+        limit (int): The maximum number of properties to claim.
+        ids (List[int]): Optionally only claim these property IDs.
+        max_attempts (int): Properties which have failed this many times are no longer claimed.
+        stale_after (dt.timedelta): Time after which an in progress property is considered abandoned.
+
+    Returns:
+        List[int]: The claimed property IDs.
+    """
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            statements.execute(cursor, "claim_enhancements", limit, ids, max_attempts, stale_after)
+            return [row[0] for row in cursor.fetchall()]
+
+
+def complete_enhancements(floorplans: List[BaseModel], summaries: List[BaseModel]) -> None:
+    """
+    Store the enhanced data of a batch of properties and mark them as done in the enhancement queue, in a single
+    transaction.
+
+    Args:
+        floorplans (List[BaseModel]): PropertyFloorplan models to upsert into property_floorplan.
+        summaries (List[BaseModel]): PropertyDescription models to upsert into property_summary.
+    """
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            model_upsertmany(cursor, "property_floorplan", floorplans, ["property_id"])
+            model_upsertmany(cursor, "property_summary", summaries, ["property_id"])
+            statements.execute(cursor, "complete_enhancements", [floorplan.property_id for floorplan in floorplans])
+
+
+def fail_enhancements(
+    errors: Dict[int, str],
+    retry_base: dt.timedelta = ENHANCEMENT_RETRY_BASE,
+    retry_max: dt.timedelta = ENHANCEMENT_RETRY_MAX,
+) -> None:
+    """
+    Mark a batch of properties as failed in the enhancement queue, to be retried with exponential backoff.
 
-    df = pd.read_sql(sql, DATABASE_URI)
+    Args:
+        errors (Dict[int, str]): The error message of each failed property ID.
+        retry_base (dt.timedelta): Delay before the first retry, doubled after each attempt.
+        retry_max (dt.timedelta): Maximum delay between retries.
+    """
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            statements.execute(
+                cursor, "fail_enhancements", list(errors.keys()), list(errors.values()), retry_base, retry_max
+            )
 
-    return df
+
+def insert_models(models: List[BaseModel], table: str) -> None:
+    """
+    Function to insert a list of floorplans into the database.
+
+    Args:
+        models (List[BaseModel]): A list of BaseModel objects to be inserted into the database.
+        table (str): The name of the table in the database.
+    """
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            model_executemany(cursor, table, models)
 
 
 def model_execute(cursor, table_name: str, value: BaseModel):
@@ -198,343 +508,118 @@ def model_executemany(cursor, table_name: str, values: List[BaseModel]):
     cursor.executemany(insert_query, [tuple(model.model_dump().values()) for model in values])
 
 
-def parse_area(area_str):
+def model_upsertmany(cursor, table_name: str, values: List[BaseModel], key_columns: List[str]):
     """
-    Parse the area from a string.
+    Upsert a list of pydantic models into a database table using executemany, rows which already exist are updated.
 
     Args:
-        area_str (str): The string containing the area.
-
-    Returns:
-        float: The parsed area as a float, or None if the area could not be parsed.
-    """
-
-    if "sq" in area_str:
-        return float(re.match(r"\d{1,3}(,\d{3})*(\.\d+)?", area_str).group(0).replace(",", ""))
-    else:
-        return None
-
-
-def parse_added_or_reduced(added_or_reduced_str):
+        cursor: The database cursor.
+        table_name (str): The name of the table in the database.
+        values (List[BaseModel]): The list of pydantic models to be upserted into the database.
+        key_columns (List[str]): The columns of the table's primary key / unique constraint.
     """
-    Parse the added or reduced date from a string.
+    if len(values) == 0:
+        return
 
-    Args:
-        added_or_reduced_str (str): The string containing the added or reduced date.
+    # Get the model fields
+    model_field_names = [field for field in values[0].model_fields]
+    update_columns = [field for field in model_field_names if field not in key_columns]
 
-    Returns:
-        dt.datetime: The parsed date as a datetime object, or None if the date could not be parsed.
+    # Construct the upsert query
+    insert_query = f"""
+        INSERT INTO {table_name} ({','.join(model_field_names)})
+        VALUES ({','.join(['%s' for _ in model_field_names])})
+        ON CONFLICT ({','.join(key_columns)})
+        DO UPDATE SET {','.join([f"{field} = EXCLUDED.{field}" for field in update_columns])}
     """
-    try:
-        added_or_reduced = pd.to_datetime(added_or_reduced_str.split(" ")[-1], dayfirst=True)
-        if str(added_or_reduced) == "NaT":
-            added_or_reduced = None
 
-    except Exception:
-        added_or_reduced = None
-
-    return added_or_reduced
+    # Upsert the values using executemany
+    cursor.executemany(insert_query, [tuple(model.model_dump().values()) for model in values])
 
 
-def insert_property_images(cursor, property_images):
+def copy_upsert_dataframe(cursor, table_name: str, df: pd.DataFrame, key_columns: List[str]) -> None:
     """
-    Insert property images into the database using executemany.
+    Upsert a DataFrame into a database table in bulk. The DataFrame is streamed into a temporary staging table
+    using COPY and then merged with a single INSERT ... ON CONFLICT, so no Python objects are created per row and
+    rerunning with the same keys updates the existing rows rather than failing.
 
     Args:
         cursor: The database cursor.
-        property_images: The property images to be inserted into the database.
-    """
-
-    # Insert property images into the database using executemany
-    insert_query = """
-        INSERT INTO property_images (property_id, image_url, image_caption)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (property_id, image_url) DO NOTHING
+        table_name (str): The name of the table in the database.
+        df (pd.DataFrame): The data to upsert, the column names must match the table columns.
+        key_columns (List[str]): The columns of the table's primary key / unique constraint.
     """
-    cursor.executemany(insert_query, property_images)
-
-
-class RightmoveDatabase:
-    def __init__(self):
-        self.conn = psycopg2.connect(DATABASE_URI)
-        self.conn.autocommit = False
-
-    def _close_missing_properties(self, missing_ids: Set[int]) -> None:
-        """
-        Closes the validto variable for properties which are no longer on the Rightmove website.
-
-        Args:
-            missing_ids (Set[int]): A set of IDs for the properties which are no longer on the Rightmove website.
-        """
-        with self.conn:
-            with self.conn.cursor() as cursor:
-                current_time = dt.datetime.now()
-                cursor.execute(f"""
-                    UPDATE property_data
-                    SET property_validto = '{current_time}'
-                    WHERE property_id IN ({','.join([str(id) for id in missing_ids])})
-                """)
-
-    def get_id_len(self, update, channel, update_cutoff=None):
-        """
-        Returns the number of property IDs that would be returned in the get_id_list() function.
+    if len(df) == 0:
+        return
 
-        Args:
-            update (bool): If True then the list will not filter for only those properties with no existing data.
-            update_cutoff (dt.datetime): If update=True then a cutoff for last update can be used.
-            channel (str): The channel which should be searched (RENT/BUY).
+    columns = ",".join(df.columns)
+    staging_table = f"{table_name}_staging"
+    update_columns = [col for col in df.columns if col not in key_columns]
+    if update_columns:
+        on_conflict = "DO UPDATE SET " + ",".join([f"{col} = EXCLUDED.{col}" for col in update_columns])
+    else:
+        on_conflict = "DO NOTHING"
 
-        Returns:
-            int: Number of properties which would be in the list.
-        """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
 
-        with self.conn:
-            with self.conn.cursor() as cursor:
-                current_time = dt.datetime.now()
-                sql = f"""
-                        SELECT COUNT(DISTINCT pl.property_id)
-                        FROM property_location pl
-                        LEFT JOIN property_data pd ON pl.property_id = pd.property_id
-                        WHERE pl.property_channel = '{channel}'
-                    """
-                if update:
-                    if update_cutoff:
-                        sql += f"""
-                                        AND (
-                                            (pd.last_update < '{update_cutoff}' OR pd.last_update IS NULL)
-                                            AND pd.property_validto >= '{current_time}'
-                                            OR pd.property_id IS NULL
-                                        )
-                                    """
-                else:
-                    sql += "AND pd.property_id IS NULL"
+    cursor.execute(f"DROP TABLE IF EXISTS {staging_table}")
+    cursor.execute(f"CREATE TEMP TABLE {staging_table} (LIKE {table_name}) ON COMMIT DROP")
+    cursor.copy_expert(f"COPY {staging_table} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+    cursor.execute(f"""
+        INSERT INTO {table_name} ({columns})
+        SELECT {columns} FROM {staging_table}
+        ON CONFLICT ({','.join(key_columns)}) {on_conflict}
+    """)
 
-                cursor.execute(sql)
-                result = cursor.fetchone()[0]
 
-                return result
+class RightmoveDatabase:
+    """
+    Synchronous facade of rightmove.async_database.RightmoveDatabase for callers which don't run an event loop. The
+    async database and its connection pool run on an event loop in a background thread, which each method call
+    waits on, so there is only one implementation of each query.
+    """
 
-    def get_id_list(self, update: bool, channel: str, update_cutoff=None) -> List[List[int]]:
+    def __init__(self, **pool_args):
         """
-        Generator for a list of IDs which can be used to search the Rightmove API, this list will be a
-        maximum size of 25, and the generator will stop once all IDs have been yielded.
-
         Args:
-            update (bool): If True then the list will not filter for only those properties with no existing data.
-            update_cutoff (dt.datetime): If update=True then a cutoff for last update can be used.
-            channel (str): The channel which should be searched (RENT/BUY).
-
-        Returns:
-            List[List[int]]: A list of Property ID integers.
+            **pool_args: Arguments of the async RightmoveDatabase, e.g. max_size.
         """
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="RightmoveDatabase", daemon=True)
+        self.thread.start()
+        self.database = self.run(AsyncRightmoveDatabase(**pool_args).__aenter__())
 
-        with self.conn:
-            with self.conn.cursor() as cursor:
-                current_time = dt.datetime.now()
-
-                sql = f"""
-                    SELECT pl.property_id
-                    FROM property_location pl
-                    LEFT JOIN property_data pd ON pl.property_id = pd.property_id
-                    WHERE pl.property_channel = '{channel}'
-                """
-
-                if update:
-                    if update_cutoff:
-                        sql += f"""
-                            AND (
-                                (pd.last_update < '{update_cutoff}' OR pd.last_update IS NULL)
-                                AND pd.property_validto >= '{current_time}'
-                                OR pd.property_id IS NULL
-                            )
-                        """
-
-                else:
-                    sql += "AND pd.property_id IS NULL"
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
 
-                cursor.execute(sql)
-                ids = []
+    def close(self) -> None:
+        self.run(self.database.__aexit__(None, None, None))
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
 
-                results = set([x[0] for x in cursor.fetchall()])
+    def __enter__(self):
+        return self
 
-        for result in results:
-            ids.append(result)
-            if len(ids) == 25:
-                yield ids
-                ids = []
-        if len(ids) > 0:
-            yield ids
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
-    def load_map_properties(self, properties: dict, channel: str) -> None:
-        """
-        Loads the data obtained from the Rightmove API into the database.
-        :param properties:      Dictionary      JSON response from the Rightmove API.
-        :param channel          String          The channel which searched for in the API.
-        """
-        with self.conn:
-            with self.conn.cursor() as cursor:
-                current_time = dt.datetime.now()
-                channel = channel.upper()
-
-                # Check for existing IDs in the database:
-                if len(properties) == 0:
-                    cursor.close()
-                    return
-
-                cursor.execute(f"""
-                    SELECT property_id 
-                    FROM property_location 
-                    WHERE property_id IN ({','.join([str(p) for p in properties.keys()])})""")
-                existing_ids: set = {r[0] for r in cursor.fetchall()}
-
-                insert_values = []
-                for property_data in properties.values():
-                    if property_data["id"] in existing_ids:
-                        continue
-
-                    insert_values.append((
-                        property_data["id"],
-                        current_time,
-                        channel,
-                        property_data["location"]["latitude"],
-                        property_data["location"]["longitude"],
-                    ))
-
-                if len(insert_values) > 0:
-                    sql = """
-                        INSERT INTO property_location (
-                            property_id,
-                            property_asatdt,
-                            property_channel,
-                            property_latitude,
-                            property_longitude
-                        ) VALUES (%s, %s, %s, %s, %s)
-                        """
-                    extras.execute_batch(cursor, sql, insert_values)
-
-    def load_property_data(self, data: dict, ids: list[int]) -> None:
-        cursor = self.conn.cursor(cursor_factory=extras.DictCursor)
-        try:
-            # Retrieve existing property IDs from the database
-            cursor.execute("SELECT property_id FROM property_data")
-            existing_ids = {row["property_id"] for row in cursor.fetchall()}
-
-            # Set validto for properties which are no longer on the Rightmove website:
-            missing_ids = set(ids) - existing_ids
-            if missing_ids:
-                self._close_missing_properties(missing_ids)
-
-            current_time = dt.datetime.now()
-
-            for prop in data:
-                property_id = prop["id"]
-
-                # Check for an existing record which is currently valid:
-                cursor.execute(
-                    """
-                    SELECT * FROM property_data
-                    WHERE property_id = %s AND property_validto >= %s
-                    """,
-                    (property_id, current_time),
-                )
-                existing_record = cursor.fetchone()
-
-                # Parse the Area of the property:
-                area_str = prop.get("displaySize")
-                area = parse_area(area_str)
-
-                # Get the 'display update date':
-                added_or_reduced = parse_added_or_reduced(prop.get("addedOrReduced"))
-
-                # Construct the property data dictionary
-                property_data = PropertyData(
-                    property_id=property_id,
-                    property_validfrom=current_time,
-                    bedrooms=prop["bedrooms"],
-                    bathrooms=prop.get("bathrooms"),
-                    area=area,
-                    summary=prop.get("summary"),
-                    address=prop["displayAddress"],
-                    property_subtype=prop["propertySubType"],
-                    property_description=prop["propertyTypeFullDescription"],
-                    premium_listing=prop["premiumListing"],
-                    price_amount=prop["price"]["amount"],
-                    price_frequency=prop["price"]["frequency"],
-                    price_qualifier=prop["price"]["displayPrices"][0].get("displayPriceQualifier"),
-                    lettings_agent=prop["customer"]["brandTradingName"],
-                    lettings_agent_branch=prop["customer"]["branchName"],
-                    development=prop["development"],
-                    commercial=prop["commercial"],
-                    enhanced_listing=prop["enhancedListing"],
-                    students=prop["students"],
-                    auction=prop["auction"],
-                    last_update=current_time,
-                    first_visible=pd.to_datetime(prop["firstVisibleDate"]),
-                    last_displayed_update=added_or_reduced,
-                )
-
-                insert_list = []
-                # Check for changes in property data
-                if existing_record and self.has_changes(existing_record, property_data):
-                    # Mark the existing record as no longer valid
-                    cursor.execute(
-                        """
-                        UPDATE property_data
-                        SET property_validto = %s
-                        WHERE property_id = %s AND property_validto >= %s
-                        """,
-                        (current_time, property_id, current_time),
-                    )
-                    # Insert a new record with updated data
-                    insert_list.append(property_data)
-                elif not existing_record:
-                    # Insert a new record if no existing record is found
-                    insert_list.append(property_data)
-
-                if insert_list:
-                    model_executemany(cursor, "property_data", insert_list)
-
-                # Insert property images using executemany
-                property_images = [
-                    (property_id, img_data["srcUrl"], img_data["caption"])
-                    for img_data in prop["propertyImages"]["images"]
-                ]
-                if property_images:
-                    insert_property_images(cursor, property_images)
-
-            # Commit the transaction
-            self.conn.commit()
-
-        except Exception as e:
-            # Handle exceptions and log if needed
-            print(f"Error: {e}")
+    def get_id_len(self, update: bool, channel: str, update_cutoff: dt.datetime = None) -> int:
+        return self.run(self.database.get_id_len(update, channel, update_cutoff))
 
-        finally:
-            # Close the database connection
-            if cursor:
-                cursor.close()
+    def get_id_list(self, update: bool, channel: str, update_cutoff: dt.datetime = None) -> List[List[int]]:
+        async def collect():
+            return [ids async for ids in self.database.get_id_list(update, channel, update_cutoff)]
 
-    def has_changes(self, existing_record, data):
-        """
-        Check if there are changes between the existing record and new data.
+        return self.run(collect())
 
-        Parameters:
-        - existing_record: Dictionary representing the existing record in the database.
-        - new_data: Dictionary representing the new data to be compared.
+    def load_map_properties(self, properties: Dict, channel: str) -> None:
+        self.run(self.database.load_map_properties(properties, channel))
 
-        Returns:
-        - True if there are changes, False otherwise.
-        """
-        new_data = data.model_dump()
-        for key, value in new_data.items():
-            if key in ["property_validfrom", "first_visible", "last_update"]:
-                continue  # Skip these keys as they are not considered for changes
-
-            existing_value = existing_record.get(key)
-            if existing_value != value:
-                return True  # Changes found
-
-        return False  # No changes
+    def load_property_data(self, data: List[Dict]) -> None:
+        self.run(self.database.load_property_data(data))
 
 
 def mark_properties_reviewed() -> int | None:
@@ -547,11 +632,8 @@ def mark_properties_reviewed() -> int | None:
     """
     with get_database_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("select distinct property_id from alert_properties where property_reviewed = 0")
-            property_ids = cursor.fetchall()
-
-            cursor.execute("select coalesce(max(email_id), 0) as last_id from review_dates")
-            review_id = cursor.fetchone()[0] + 1
+            property_ids = statements.execute(cursor, "unreviewed_property_ids").fetchall()
+            review_id = statements.execute(cursor, "last_review_id").fetchone()[0] + 1
 
             if len(property_ids) == 0:
                 return None
@@ -569,58 +651,44 @@ def mark_properties_reviewed() -> int | None:
                 for property_id in property_ids
             ]
             model_executemany(cursor, table_name="reviewed_properties", values=values)
+            statements.execute(cursor, "refresh_alert_properties")
 
             return review_id
 
 
-def get_properties(sql_filter: str) -> List[dict]:
+def iter_properties(review_id: int | None = None) -> Iterator[dict]:
+    """
+    Iterate over the alert properties of a review, or the new properties which haven't been reviewed yet, formatted
+    for the web view and the email templates. The formatting is done by the alert property statements, so each row is
+    a dict of the fetched columns. The result is buffered by the client when the statement is executed, only the
+    dicts are created as the generator is consumed.
+
+    Args:
+        review_id (int | None): The ID of the review, or None for the properties which haven't been reviewed.
+
+    Returns:
+        Iterator[dict]: A dictionary for each property.
+    """
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            if review_id is None:
+                statements.execute(cursor, "new_alert_properties")
+            else:
+                statements.execute(cursor, "reviewed_alert_properties", int(review_id))
+
+            columns = [col.name for col in cursor.description]
+            for row in cursor:
+                yield dict(zip(columns, row))
+
+
+def get_properties(review_id: int | None = None) -> List[dict]:
     """
-    Get property data from the database based on a provided SQL filter.
+    Get the alert properties of a review, or the new properties which haven't been reviewed yet.
 
     Args:
-        sql_filter (str): The SQL filter to apply when retrieving the properties.
+        review_id (int | None): The ID of the review, or None for the properties which haven't been reviewed.
 
     Returns:
         List[dict]: A list of dictionaries where each dictionary represents a property.
     """
-    sql = f"""
-    select * from alert_properties
-    where {sql_filter}
-    """
-
-    # Reading data from CSV
-    df = pd.read_sql(sql, DATABASE_URI)
-
-    # Formatting changes:
-    df["garden"] = df["garden"].apply(lambda x: "Private" if x == "private" else "Unknown")
-    df["area"] = df["area"].fillna(0).apply(lambda x: f"{x:,.0f} ft\u00b2" if x != 0 else "Unavailable")
-
-    properties = []
-    for index, property in df.iterrows():
-        travel_time = f"About {property.travel_time} minutes"
-
-        data = {
-            "link": f"https://www.rightmove.co.uk/properties/{property.property_id}",
-            "title": property.property_description,
-            "address": property.address,
-            "status": f"Last update {property.last_update}",
-            "description": property.summary,
-            "garden": property.garden,
-            "area": property.area,
-            "price": f"£{property.price_amount:,.0f}",
-            "travel_time": travel_time,
-            "longitude": property.longitude,
-            "latitude": property.latitude,
-        }
-
-        if type(property["images"]) == str:
-            data["images"] = [
-                {"url": img.strip().replace("171x162", "476x317"), "alt": "Property"}
-                for img in property["images"].split(",")
-            ][:2]
-        else:
-            data["images"] = []
-
-        properties.append(data)
-
-    return properties
+    return list(iter_properties(review_id))
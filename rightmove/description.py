@@ -1,70 +1,353 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
-from typing import Dict
+import re
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
 
 import openai
+import pandas as pd
 
 from config import DATA
 from config.logging import logging_setup
 
-with open(os.path.join(DATA, "secrets.json"), "r") as f:
-    secrets = json.load(f)
-
-key = secrets.get("openai").get("api_key")
-openai.api_key = key
-
 logger = logging.getLogger(__name__)
 logger = logging_setup(logger)
 
+MODEL = "gpt-3.5-turbo-1106"
+GARDEN_OPTIONS = ["private", "communal", "balcony", "unknown"]
+SUMMARY_CACHE_FILE = os.path.join(DATA, "summary_cache.sqlite")
+BATCH_SIZE = 10
+MAX_CONCURRENCY = 4
+
+GARDEN_DESCRIPTION = (
+    "The type of garden the property has, if known. For example"
+    " - If the property has a private garden or patio, the value would be 'private'."
+    " - If the property has a communal garden, the value would be 'communal'."
+    " - If the property has a private balcony, the value would be 'balcony'."
+)
+
 TOOLS = [{
     "type": "function",
     "function": {
         "name": "property_assessment",
-        "description": "Record structured data about a property.",
+        "description": "Record structured data about each property.",
         "parameters": {
             "type": "object",
             "properties": {
-                "garden": {
-                    "type": "string",
-                    "enum": ["private", "communal", "balcony", "unknown"],
-                    "description": (
-                        "The type of garden the property has, if known. For example"
-                        " - If the property has a private garden or patio, the value would be 'private'."
-                        " - If the property has a communal garden, the value would be 'communal'."
-                        " - If the property has a private balcony, the value would be 'balcony'."
-                    ),
+                "properties": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "integer", "description": "The number of the property summary."},
+                            "garden": {"type": "string", "enum": GARDEN_OPTIONS, "description": GARDEN_DESCRIPTION},
+                        },
+                        "required": ["id", "garden"],
+                    },
                 }
             },
-            "required": ["garden"],
+            "required": ["properties"],
         },
     },
 }]
 
+# Phrase rules of the local garden classifier, matched against the lowercased summary. A summary matching the rules
+# of exactly one type is classified as that type with the type's confidence, one matching several types is ambiguous:
+GARDEN_RULES = {
+    "private": [
+        r"\bprivate (?:[\w-]+ ){0,3}?(?:garden|patio|courtyard|roof terrace|terrace)",
+        r"(?<!shared )(?<!communal )\b(?:own|rear|front|back|side|enclosed|walled|landscaped|lawned) gardens?\b",
+        r"\b(?:south|west|east|north)[- ]facing (?:rear |front |back )?gardens?\b",
+        r"\bgarden (?:flat|apartment|maisonette)\b",
+    ],
+    "communal": [
+        r"\b(?:communal|shared|residents'?) (?:[\w-]+ ){0,2}?(?:gardens?|grounds|roof terrace|courtyard)",
+    ],
+    "balcony": [
+        r"(?<!juliet )\bbalcon(?:y|ies)\b",
+    ],
+}
+GARDEN_RULE_CONFIDENCE = {"private": 0.9, "communal": 0.9, "balcony": 0.85}
+GARDEN_PATTERNS = {garden: re.compile("|".join(rules)) for garden, rules in GARDEN_RULES.items()}
 
-def analyse_summary(summary: str) -> Dict:
+# Summaries which don't mention any outside space at all are 'unknown' without asking the model:
+OUTSIDE_SPACE_PATTERN = re.compile(r"garden|patio|terrace|yard|balcon|outside space|outdoor space")
+NO_OUTSIDE_SPACE_CONFIDENCE = 0.95
 
-    prompt = f"""
-    # PROMPT:
-    Please review the following property summary and determine the additional metadata using the included tool.
-    
-    ```
-    {summary}
-    ```
-    """
-
-    messages = [
-        {
-            "role": "system",
-            "content": (
-                "You are a property analyst and your job is to review property summaries and provide structured data."
-            ),
-        },
-        {"role": "user", "content": prompt},
-    ]
+# Rule results with at least this confidence are used, the rest are sent to the model:
+RULE_CONFIDENCE_CUTOFF = 0.8
+
+SYSTEM_PROMPT = "You are a property analyst and your job is to review property summaries and provide structured data."
+
+
+def load_api_key() -> str:
+    """
+    Load the OpenAI API key from the secrets file.
+    """
+    with open(os.path.join(DATA, "secrets.json"), "r") as f:
+        secrets = json.load(f)
+
+    return secrets.get("openai").get("api_key")
+
+
+def hash_summary(summary: str, model: str = MODEL) -> str:
+    """
+    Cache key of a summary, whitespace is normalised and the model is included so changing it invalidates the cache.
+    """
+    normalised = " ".join(summary.split())
+    return hashlib.sha256(f"{model}\n{normalised}".encode()).hexdigest()
+
+
+def classify_gardens(summaries: List[str]) -> pd.DataFrame:
+    """
+    Classify the garden of many summaries with the phrase rules in GARDEN_RULES, which resolves the clear cases
+    without the model.
+
+    Args:
+        summaries (List[str]): The summaries.
+
+    Returns:
+        pd.DataFrame: The 'garden' (one of GARDEN_OPTIONS, or None if the rules are ambiguous) and 'confidence' of
+            each summary, in the same order.
+    """
+    text = pd.Series(summaries, dtype="object").fillna("").str.lower()
+    matches = pd.DataFrame({garden: text.str.contains(pattern) for garden, pattern in GARDEN_PATTERNS.items()})
+
+    single = matches.sum(axis=1) == 1
+    garden = matches.idxmax(axis=1).where(single)
+    confidence = matches.mul(pd.Series(GARDEN_RULE_CONFIDENCE)).max(axis=1).where(single, 0.0)
+
+    no_outside_space = ~text.str.contains(OUTSIDE_SPACE_PATTERN)
+    garden[no_outside_space] = "unknown"
+    confidence[no_outside_space] = NO_OUTSIDE_SPACE_CONFIDENCE
+
+    return pd.DataFrame({"garden": garden.astype(object).where(garden.notna(), None), "confidence": confidence})
+
+
+def make_prompt(summaries: List[str]) -> str:
+    """
+    Prompt for a batch of summaries, each is numbered so the tool call can refer to it.
+    """
+    prompt = (
+        "# PROMPT:\n"
+        "Please review each of the following property summaries and determine the additional metadata using the "
+        "included tool, with one entry per summary.\n"
+    )
+    for i, summary in enumerate(summaries):
+        prompt += f"\n## SUMMARY {i}:\n```\n{summary}\n```\n"
+
+    return prompt
+
+
+class SummaryCache:
+    """
+    On-disk cache of summary classifications keyed by hash_summary, so text which has been seen before is never
+    sent to the API again.
+    """
+
+    def __init__(self, filepath: str = SUMMARY_CACHE_FILE):
+        Path(filepath).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(filepath)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results (hash TEXT PRIMARY KEY, result TEXT NOT NULL)")
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
 
-    chat_response = openai.ChatCompletion.create(model="gpt-3.5-turbo-1106", messages=messages, tools=TOOLS)
+    def get_many(self, hashes: Iterable[str]) -> Dict[str, Dict]:
+        hashes = list(hashes)
+        results = {}
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i : i + 500]
+            rows = self.conn.execute(
+                f"SELECT hash, result FROM results WHERE hash IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            results.update({content_hash: json.loads(result) for content_hash, result in rows})
 
-    output = json.loads(chat_response.choices[0].message.tool_calls[0].function.to_dict()["arguments"])
+        return results
 
-    return output
+    def put_many(self, results: Dict[str, Dict]) -> None:
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO results (hash, result) VALUES (?, ?)",
+            [(content_hash, json.dumps(result)) for content_hash, result in results.items()],
+        )
+        self.conn.commit()
+
+
+class SummaryClassifier:
+    """
+    Classifies property summaries. The clear cases are resolved locally by classify_gardens, and the ambiguous ones
+    are classified with the OpenAI API: they are de-duplicated and looked up in the cache first, and the rest are
+    sent in batches of batch_size per request, with up to max_concurrency requests in flight.
+    """
+
+    def __init__(
+        self,
+        cache: SummaryCache = None,
+        batch_size: int = BATCH_SIZE,
+        max_concurrency: int = MAX_CONCURRENCY,
+        model: str = MODEL,
+        rule_cutoff: Optional[float] = RULE_CONFIDENCE_CUTOFF,
+        **client_args,
+    ):
+        """
+        Args:
+            cache (SummaryCache): Cache of classifications, defaults to the cache in the data directory.
+            batch_size (int): Number of summaries per request.
+            max_concurrency (int): Maximum number of requests in flight at once.
+            model (str): The chat completion model.
+            rule_cutoff (float): Minimum confidence of a local rule result for it to be used, if None every summary
+                is sent to the model.
+            **client_args: Arguments passed to openai.AsyncOpenAI, e.g. base_url to use a local stub endpoint. The
+                API key is loaded from the secrets file if not given.
+        """
+        self.cache = cache
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.model = model
+        self.rule_cutoff = rule_cutoff
+        self.client_args = client_args
+        self.requests = 0
+        self.cache_hits = 0
+        self.rule_hits = 0
+
+    async def __aenter__(self):
+        """
+        Asynchronous enter function which assigns the async OpenAI client
+        """
+        if "api_key" not in self.client_args:
+            self.client_args["api_key"] = load_api_key()
+        if self.cache is None:
+            self.cache = SummaryCache()
+
+        self.client = openai.AsyncOpenAI(**self.client_args)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """
+        Asynchronous exit function which closes the async OpenAI client
+        """
+        await self.client.close()
+
+    async def classify_batch(self, summaries: List[str]) -> List[Optional[Dict]]:
+        """
+        Classify a batch of summaries in a single request.
+
+        Args:
+            summaries (List[str]): The summaries.
+
+        Returns:
+            List[Dict]: A dictionary with a 'garden' key for each summary, or None where the response didn't include
+                the summary or the request failed.
+        """
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": make_prompt(summaries)},
+        ]
+
+        async with self.semaphore:
+            self.requests += 1
+            try:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    tools=TOOLS,
+                    tool_choice={"type": "function", "function": {"name": "property_assessment"}},
+                )
+                arguments = json.loads(response.choices[0].message.tool_calls[0].function.arguments)
+            except Exception as e:
+                logger.warning(f"Summary classification failed for a batch of {len(summaries)}: {e!r}")
+                return [None] * len(summaries)
+
+        results = [None] * len(summaries)
+        for item in arguments.get("properties", []):
+            i = item.get("id")
+            if isinstance(i, int) and 0 <= i < len(summaries):
+                garden = item.get("garden")
+                results[i] = {"garden": garden if garden in GARDEN_OPTIONS else "unknown"}
+
+        return results
+
+    async def classify(self, summaries: List[str]) -> List[Optional[Dict]]:
+        """
+        Classify many summaries, with the local rules where they are confident enough and otherwise with the model.
+
+        Args:
+            summaries (List[str]): The summaries.
+
+        Returns:
+            List[Dict]: A dictionary with a 'garden' key for each summary, or None if the summary is empty or it
+                couldn't be classified.
+        """
+        if self.rule_cutoff is None:
+            return await self.classify_remote(summaries)
+
+        rules = classify_gardens(summaries)
+        resolved = [
+            bool(summary) and confidence >= self.rule_cutoff
+            for summary, confidence in zip(summaries, rules["confidence"])
+        ]
+        self.rule_hits += sum(resolved)
+
+        remote = await self.classify_remote([summary for summary, hit in zip(summaries, resolved) if not hit])
+        remote = iter(remote)
+        return [{"garden": garden} if hit else next(remote) for garden, hit in zip(rules["garden"], resolved)]
+
+    async def classify_remote(self, summaries: List[str]) -> List[Optional[Dict]]:
+        """
+        Classify many summaries with the model, or from the cache if they have been classified before.
+
+        Args:
+            summaries (List[str]): The summaries.
+
+        Returns:
+            List[Dict]: A dictionary with a 'garden' key for each summary, or None if the summary is empty or it
+                couldn't be classified.
+        """
+        hashes = {summary: hash_summary(summary, self.model) for summary in summaries if summary}
+        cached = self.cache.get_many(set(hashes.values()))
+        self.cache_hits += sum(1 for summary in summaries if summary and hashes[summary] in cached)
+
+        missing = {}
+        for summary, content_hash in hashes.items():
+            if content_hash not in cached:
+                missing.setdefault(content_hash, summary)
+        missing = list(missing.values())
+        batches = [missing[i : i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        batch_results = await asyncio.gather(*[self.classify_batch(batch) for batch in batches])
+
+        new_results = {}
+        for batch, results in zip(batches, batch_results):
+            for summary, result in zip(batch, results):
+                if result is not None:
+                    new_results[hashes[summary]] = result
+        self.cache.put_many(new_results)
+
+        results = {**cached, **new_results}
+        return [results.get(hashes[summary]) if summary else None for summary in summaries]
+
+
+async def classify_summaries(summaries: List[str], **classifier_args) -> List[Optional[Dict]]:
+    """
+    Classify many summaries, see SummaryClassifier.
+    """
+    async with SummaryClassifier(**classifier_args) as classifier:
+        return await classifier.classify(summaries)
+
+
+def analyse_summary(summary: str) -> Dict:
+    """
+    Classify a single property summary.
+
+    Args:
+        summary (str): The summary of the property.
+
+    Returns:
+        Dict: A dictionary with the type of garden under 'garden', one of GARDEN_OPTIONS.
+    """
+    return asyncio.run(classify_summaries([summary]))[0] or {"garden": "unknown"}
@@ -1,147 +1,478 @@
+import asyncio
 import logging
+import os
 import random
-import re
-from concurrent.futures import as_completed, ThreadPoolExecutor
-from typing import Dict, List, Tuple
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
-import requests
-from bs4 import BeautifulSoup
-from pydantic import BaseModel
+import httpx
 from tqdm import tqdm
 
 from config.logging import logging_setup
-from rightmove.database import get_enhancement_properties, insert_models
-from rightmove.floorplan import download_img, extract_internal_area, extract_text
+from rightmove.database import (
+    claim_enhancement_properties,
+    complete_enhancements,
+    enqueue_enhancement_properties,
+    fail_enhancements,
+    refresh_alert_properties,
+)
+from rightmove.description import SummaryClassifier
+from rightmove.floorplan import analyse_floorplan, extract_internal_area, extract_sizings_area
+from rightmove.floorplan_cache import FloorplanCache, hash_content
 from rightmove.models import PropertyDescription, PropertyFloorplan
-from rightmove.utils import USER_AGENTS
+from rightmove.property_page import parse_property_page
+from rightmove.utils import USER_AGENTS, AsyncRateLimiter
 
 logger = logging.getLogger(__name__)
 logger = logging_setup(logger)
 
-FLOORPAN_REGEX = re.compile("_FLP_00_")
-
-
-def get_data(property_id: int) -> Dict:
+MAX_CONCURRENCY = 16
+REQUESTS_PER_SECOND = 10
+BATCH_SIZE = 50
+MAX_SUMMARY_LENGTH = 10000
+
+# Tiers of the area resolver, in the order they are tried:
+AREA_SOURCES = ("sizings", "summary", "ocr")
+
+
+class PropertyPageClient:
+    def __init__(
+        self,
+        max_concurrency: int = MAX_CONCURRENCY,
+        rate_limiter: AsyncRateLimiter = None,
+        transport: httpx.AsyncBaseTransport = None,
+    ):
+        """
+        Args:
+            max_concurrency (int): Maximum number of requests in flight at once.
+            rate_limiter (AsyncRateLimiter): Rate limiter shared by page and image downloads, defaults to
+                REQUESTS_PER_SECOND.
+            transport (httpx.AsyncBaseTransport): Optional httpx transport, e.g. httpx.MockTransport.
+        """
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.rate_limiter = rate_limiter or AsyncRateLimiter(REQUESTS_PER_SECOND)
+        self.transport = transport
+
+    async def __aenter__(self):
+        """
+        Asynchronous enter function which assigns the async httpx client, connections are kept alive and reused
+        across requests.
+        """
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        self.client = httpx.AsyncClient(limits=limits, timeout=30, follow_redirects=True, transport=self.transport)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """
+        Asynchronous exit function which closes the async httpx client
+        """
+        await self.client.aclose()
+
+    async def get(self, url: str) -> Optional[bytes]:
+        """
+        Download a URL, within the concurrency and rate limits.
+
+        Args:
+            url (str): The URL to download.
+
+        Returns:
+            bytes: The response content, or None if the download failed.
+        """
+        async with self.semaphore:
+            await self.rate_limiter.acquire()
+            try:
+                r = await self.client.get(url, headers={"User-Agent": random.choice(USER_AGENTS)})
+            except httpx.HTTPError as e:
+                logger.debug(f"Download failed for URL {url}: {e}")
+                return None
+
+        if r.status_code != 200:
+            logger.debug(f"Download failed for URL {url} with status {r.status_code}.")
+            return None
+
+        return r.content
+
+    async def get_data(self, property_id: int) -> Optional[Dict]:
+        """
+        Get a list of URLs for the floorplans and the summary text of a given property ID.
+
+        Args:
+            property_id (int): The ID of the property.
+
+        Returns:
+            Dict: The output of parse_property_page, or None if the page could not be downloaded.
+        """
+        content = await self.get(f"https://www.rightmove.co.uk/properties/{property_id}#/")
+        if content is None:
+            return None
+
+        return parse_property_page(content)
+
+
+def resolve_text_area(data: Dict) -> Tuple[Optional[Dict], Optional[str]]:
     """
-    Get a list of URLs for the floorplans of a given property ID.
+    Get the internal area of a property from its page, without OCR: first from the structured sizes, then from the
+    summary text.
 
     Args:
-        property_id (int): The ID of the property.
+        data (Dict): The output of parse_property_page.
 
     Returns:
-        List[str]: A list of URLs of the floorplans.
+        Tuple[Dict, str]: A dictionary with 'sqft' and 'sqm' keys and the tier which found it ("sizings" or
+            "summary"), or (None, None) if the floorplan needs to be OCR'd.
     """
-    url = f"https://www.rightmove.co.uk/properties/{property_id}#/"
-    r = requests.get(url, headers={"User-Agent": random.choice(USER_AGENTS)})
+    area = extract_sizings_area(data.get("sizings") or [])
+    if area["sqft"]:
+        return area, "sizings"
 
-    if r.status_code != 200:
-        logger.debug(f"Floorplan download failed for property {property_id}.")
-        return None
+    area = extract_internal_area(data.get("summary") or "")
+    if area["sqft"]:
+        return area, "summary"
 
-    soup = BeautifulSoup(r.content, "html.parser")
+    return None, None
 
-    floorplans = []
-    for img in soup.find_all("img", attrs={"src": FLOORPAN_REGEX}):
-        img = re.sub(r"(_\d{2}_\d{4})(.+)(.gif|.jpeg|.png)", r"\1\3", img["src"])
-        floorplans.append(img)
 
-    key_features_element = soup.find("ul", class_="_1uI3IvdF5sIuBtRIvKrreQ")
-    if key_features_element:
-        key_features = "\n".join(key_features_element.stripped_strings)
-    else:
-        key_features = ""
+def make_floorplan(property_id: int, floorplan_url: str, result: Dict, source: str = "ocr") -> PropertyFloorplan:
+    """
+    Create the PropertyFloorplan of a property from the output of analyse_floorplan or resolve_text_area.
+    """
+    return PropertyFloorplan(
+        property_id=property_id,
+        floorplan_url=floorplan_url,
+        area_sqft=result.get("sqft"),
+        area_sqm=result.get("sqm"),
+        area_source=source if result.get("sqft") else None,
+    )
 
-    description_element = soup.find("div", class_="_1a8kqJPMw6HOD9SDZq61E8")
-    if description_element:
-        description = "\n".join(description_element.stripped_strings)
-    else:
-        description = ""
 
-    summary = ""
-    if key_features:
-        summary += f"## KEY FEATURES:\n{key_features}\n"
-    if description:
-        summary += f"## DESCRIPTION:\n{description}"
+class StageMetrics:
+    """
+    Throughput of one stage of the enhancement pipeline.
+    """
 
-    return {"floorplans": floorplans, "summary": summary}
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.start = time.perf_counter()
+
+    def record(self, seconds: float, items: int = 1) -> None:
+        """
+        Record items processed by a worker of the stage, and the time the worker spent on them.
+        """
+        self.items += items
+        self.busy += seconds
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        rate = self.items / elapsed if elapsed else 0.0
+        utilisation = self.busy / (elapsed * self.workers) if elapsed else 0.0
+        return (
+            f"{self.name:<8} {self.items:>6} items  {rate:8.2f} items/s  {utilisation:6.1%} busy"
+            f" ({self.workers} workers)"
+        )
 
 
-def get_additional_data(id: int) -> Tuple[BaseModel, BaseModel]:
+class EnhancementResult(NamedTuple):
     """
-    Get the floorplan data of a given property ID.
-
-    Args:
-        id (int): The ID of the property.
-
-    Returns:
-        PropertyFloorplan: An instance of the PropertyFloorplan class.
+    Outcome of one property in the enhancement pipeline, either its floorplan and page data or the error which
+    stopped it, in which case it is retried later.
     """
 
-    data = get_data(id)
-    if not data:
-        return None
-
-    # Floorplan analysis:
-    try:
-        floorplan_url = data.get("floorplans")[0]
-        img = download_img(floorplan_url)
-        text = extract_text(img)
-        area = extract_internal_area(text)
-        floorplan = PropertyFloorplan(
-            property_id=id,
-            floorplan_url=floorplan_url,
-            area_sqft=area.get("sqft"),
-            area_sqm=area.get("sqm"),
-        )
-    except Exception:
-        floorplan = PropertyFloorplan(property_id=id)
-
-    # Description analysis:
-    # try:
-    #     summary_text = data.get("summary")
-    #     if summary_text:
-    #         analysis = analyse_summary(summary_text)
-    #         summary = PropertyDescription(
-    #             property_id=id,
-    #             summary=summary_text,
-    #             garden=analysis.get("garden"),
-    #         )
-    #     else:
-    #         summary = PropertyDescription(property_id=id)
-    # except Exception:
-    summary = PropertyDescription(property_id=id)
-
-    return floorplan, summary
+    property_id: int
+    floorplan: Optional[PropertyFloorplan] = None
+    data: Optional[Dict] = None
+    error: Optional[str] = None
 
 
-def update_enhanced_data(ids: List = None) -> None:
-    """
-    Updates the floorplan images in the database.
+class EnhancementPipeline:
     """
-    if not ids:
-        ids = get_enhancement_properties()
+    Staged pipeline which gets the enhanced data of the properties in the enhancement queue table:
 
-    progress = tqdm(
-        total=len(ids),
-        desc="Getting floorplans",
-        bar_format="{desc:<20} {percentage:3.0f}%|{bar}| remaining: {remaining_s:.1f}",
-    )
+        claim (batches from the queue) -> id_queue -> fetch (async downloads) -> ocr_queue -> OCR (process pool)
+            -> write_queue -> writer (batched commits)
 
-    futures = {}
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        for property_id in ids:
-            futures[executor.submit(get_additional_data, property_id)] = property_id
+    The queues are bounded, so downloads only run ahead of OCR by a fixed number of images and stages are
+    throttled by the slowest one, while OCR uses every core. Properties are claimed from the queue table a batch at a
+    time and results are committed as each batch completes, so an interrupted run loses at most a few batches, and
+    several pipelines (e.g. in different processes) can work through the same queue. Transient failures are put
+    back in the queue to be retried with backoff.
+    """
 
-        results = []
-        for future in as_completed(futures):
-            progress.update(1)
-            results.append(future.result())
+    def __init__(
+        self,
+        fetch_workers: int = MAX_CONCURRENCY,
+        ocr_workers: int = None,
+        batch_size: int = BATCH_SIZE,
+        cache: FloorplanCache = None,
+        classifier: SummaryClassifier = None,
+        **client_args,
+    ):
+        """
+        Args:
+            fetch_workers (int): Number of properties downloaded concurrently.
+            ocr_workers (int): Number of OCR processes, defaults to the number of cores.
+            batch_size (int): Number of properties claimed from the queue and committed to the database at a time.
+            cache (FloorplanCache): Cache of floorplan OCR results, defaults to the cache in the data directory.
+            classifier (SummaryClassifier): Classifier of the property summaries, defaults to a SummaryClassifier
+                with the API key from the secrets file.
+            **client_args: Arguments passed to PropertyPageClient.
+        """
+        self.fetch_workers = fetch_workers
+        self.ocr_workers = ocr_workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.cache = cache
+        self.classifier = classifier
+        self.client_args = client_args
+        self.metrics = {}
+        self.cache_hits = 0
+        self.failures = 0
+        self.area_sources = dict.fromkeys(AREA_SOURCES, 0)
+        # Properties claimed by the current run which haven't been written yet:
+        self.pending = set()
+
+    async def run(self, ids: List[int] = None) -> None:
+        """
+        Get and store the enhanced data of the properties in the enhancement queue, until there are none left which
+        are ready.
+
+        Args:
+            ids (List[int]): Optionally only process these property IDs, they must already be queued.
+        """
+        self.metrics = {
+            "fetch": StageMetrics("fetch", self.fetch_workers),
+            "ocr": StageMetrics("ocr", self.ocr_workers),
+            "write": StageMetrics("write", 1),
+        }
+
+        if self.cache is None:
+            self.cache = FloorplanCache()
+        if self.classifier is None:
+            self.classifier = SummaryClassifier()
+
+        id_queue = asyncio.Queue(maxsize=self.batch_size)
+        ocr_queue = asyncio.Queue(maxsize=self.ocr_workers * 2)
+        write_queue = asyncio.Queue(maxsize=self.batch_size * 2)
+        self.progress = tqdm(
+            total=0,
+            desc="Getting floorplans",
+            bar_format="{desc:<20} {percentage:3.0f}%|{bar}| remaining: {remaining_s:.1f}",
+        )
+
+        self.pending = set()
+
+        try:
+            with ProcessPoolExecutor(max_workers=self.ocr_workers) as pool:
+                async with (
+                    PropertyPageClient(max_concurrency=self.fetch_workers, **self.client_args) as client,
+                    self.classifier,
+                ):
+                    # If any stage fails the task group cancels the others, so the run fails rather than blocking on
+                    # a full queue:
+                    async with asyncio.TaskGroup() as tasks:
+                        writer = tasks.create_task(self.write(write_queue))
+                        ocr = [
+                            tasks.create_task(self.ocr(pool, ocr_queue, write_queue)) for _ in range(self.ocr_workers)
+                        ]
+                        fetch = [
+                            tasks.create_task(self.fetch(client, id_queue, ocr_queue, write_queue))
+                            for _ in range(self.fetch_workers)
+                        ]
+
+                        await self.claim(id_queue, ids)
+                        await asyncio.gather(*fetch)
+                        for _ in ocr:
+                            await ocr_queue.put(None)
+                        await asyncio.gather(*ocr)
+                        await write_queue.put(None)
+                        await writer
+
+        except ExceptionGroup as e:
+            # Put the properties claimed by this run back in the queue, rather than leaving them in progress until
+            # they are stale:
+            error = f"Enhancement run failed: {e.exceptions[0]!r}"
+            logger.error(error)
+            if self.pending:
+                await asyncio.to_thread(fail_enhancements, dict.fromkeys(self.pending, error))
+            raise e.exceptions[0] from e
+
+        finally:
+            self.progress.close()
+
+        for metrics in self.metrics.values():
+            logger.info(metrics.summary())
+        logger.info(f"Floorplan cache hits: {self.cache_hits}")
+        logger.info(
+            f"Summary rule hits: {self.classifier.rule_hits}, requests: {self.classifier.requests}, "
+            f"cache hits: {self.classifier.cache_hits}"
+        )
+        logger.info("Areas found by tier: " + ", ".join(f"{k}={v}" for k, v in self.area_sources.items()))
+        logger.info(f"Failed, to be retried: {self.failures}")
+
+    async def claim(self, id_queue: asyncio.Queue, ids: List[int] = None) -> None:
+        """
+        Claim stage: claim batches of properties from the enhancement queue table and pass them on to the fetch
+        stage, until no more are ready.
+        """
+        while claimed := await asyncio.to_thread(claim_enhancement_properties, self.batch_size, ids):
+            self.pending.update(claimed)
+            self.progress.total += len(claimed)
+            self.progress.refresh()
+            for property_id in claimed:
+                await id_queue.put(property_id)
+
+        for _ in range(self.fetch_workers):
+            await id_queue.put(None)
+
+    async def fetch(
+        self,
+        client: PropertyPageClient,
+        id_queue: asyncio.Queue,
+        ocr_queue: asyncio.Queue,
+        write_queue: asyncio.Queue,
+    ) -> None:
+        """
+        Fetch stage: download the property page, and pass the floorplan image on to the OCR stage if the area isn't
+        stated on the page. Areas from the page, floorplans already in the cache by URL or by image content, and
+        failed downloads go straight to the writer.
+        """
+        while (property_id := await id_queue.get()) is not None:
+            start = time.perf_counter()
+
+            try:
+                data = await client.get_data(property_id)
+                content = None
+                floorplan_url = None
+                cached = None
+                area, source = resolve_text_area(data) if data else (None, None)
+                if data and data.get("floorplans"):
+                    floorplan_url = data["floorplans"][0]
+                    if area is None:
+                        cached = self.cache.get(floorplan_url)
+                    if area is None and cached is None:
+                        content = await client.get(floorplan_url)
+                        if content is not None:
+                            cached = self.cache.get_by_hash(hash_content(content), url=floorplan_url)
+            except Exception as e:
+                self.metrics["fetch"].record(time.perf_counter() - start)
+                await write_queue.put(EnhancementResult(property_id, error=f"Fetch failed: {e!r}"))
+                continue
+
+            self.metrics["fetch"].record(time.perf_counter() - start)
+
+            if data is None:
+                await write_queue.put(EnhancementResult(property_id, error="Property page download failed"))
+            elif area is not None:
+                self.area_sources[source] += 1
+                floorplan = make_floorplan(property_id, floorplan_url, area, source)
+                await write_queue.put(EnhancementResult(property_id, floorplan, data))
+            elif floorplan_url is None:
+                await write_queue.put(EnhancementResult(property_id, PropertyFloorplan(property_id=property_id), data))
+            elif cached is not None:
+                self.cache_hits += 1
+                if cached.get("sqft"):
+                    self.area_sources["ocr"] += 1
+                floorplan = make_floorplan(property_id, floorplan_url, cached)
+                await write_queue.put(EnhancementResult(property_id, floorplan, data))
+            elif content is None:
+                error = f"Floorplan download failed: {floorplan_url}"
+                await write_queue.put(EnhancementResult(property_id, error=error))
+            else:
+                await ocr_queue.put((property_id, floorplan_url, content, data))
+
+    async def ocr(self, pool: ProcessPoolExecutor, ocr_queue: asyncio.Queue, write_queue: asyncio.Queue) -> None:
+        """
+        OCR stage: extract the floorplan area in the process pool, and pass the result on to the writer.
+        """
+        loop = asyncio.get_running_loop()
+        while (item := await ocr_queue.get()) is not None:
+            property_id, floorplan_url, content, data = item
+            start = time.perf_counter()
+            try:
+                result = await loop.run_in_executor(pool, analyse_floorplan, content)
+                self.cache.put(floorplan_url, content, result)
+                if result.get("sqft"):
+                    self.area_sources["ocr"] += 1
+                outcome = EnhancementResult(property_id, make_floorplan(property_id, floorplan_url, result), data)
+            except Exception as e:
+                outcome = EnhancementResult(property_id, error=f"OCR failed: {e!r}")
+
+            self.metrics["ocr"].record(time.perf_counter() - start)
+            await write_queue.put(outcome)
+
+    async def write(self, write_queue: asyncio.Queue) -> None:
+        """
+        Writer stage: commit the results to the database in batches as they arrive.
+        """
+        batch = []
+        while True:
+            item = await write_queue.get()
+            if item is not None:
+                batch.append(item)
+                self.progress.update(1)
+
+            if batch and (item is None or len(batch) >= self.batch_size):
+                start = time.perf_counter()
+                summaries = [
+                    (result.data.get("summary") or "")[:MAX_SUMMARY_LENGTH] if result.error is None else ""
+                    for result in batch
+                ]
+                gardens = await self.classifier.classify(summaries)
+                await asyncio.to_thread(self.insert_batch, batch, summaries, gardens)
+                self.metrics["write"].record(time.perf_counter() - start, items=len(batch))
+                batch = []
+
+            if item is None:
+                return
+
+    def insert_batch(self, batch: List[EnhancementResult], summaries: List[str], gardens: List[Dict]) -> None:
+        """
+        Store the successful results of a batch and mark them as done, and put the failures back in the queue. Results
+        with a summary which couldn't be classified count as failures.
+        """
+        floorplans = []
+        descriptions = []
+        errors = {}
+        for result, summary, garden in zip(batch, summaries, gardens):
+            if result.error is not None:
+                errors[result.property_id] = result.error
+                continue
+            # Kept in the queue to be retried, rather than stored without a garden classification:
+            if summary and garden is None:
+                errors[result.property_id] = "summary classification failed"
+                continue
+
+            floorplans.append(result.floorplan)
+            descriptions.append(
+                PropertyDescription(
+                    property_id=result.property_id,
+                    summary=summary or None,
+                    garden=garden.get("garden") if garden else None,
+                )
+            )
+
+        # Properties leave pending only once their write has returned, so a failed write is put back in the queue by
+        # the run:
+        if floorplans:
+            complete_enhancements(floorplans=floorplans, summaries=descriptions)
+            self.pending.difference_update(floorplan.property_id for floorplan in floorplans)
+        if errors:
+            fail_enhancements(errors)
+            self.pending.difference_update(errors)
+        self.failures += len(errors)
 
-    # Insert floorplans:
-    insert_models(models=[x[0] for x in results if x is not None], table="property_floorplan")
 
-    # Insert descriptions:
-    insert_models(models=[x[1] for x in results if x is not None], table="property_summary")
+def update_enhanced_data(ids: List = None) -> None:
+    """
+    Updates the floorplan images in the database. The given property IDs, or by default every alert property without
+    an area or floorplan, are added to the enhancement queue and then the queue is processed.
+    """
+    enqueue_enhancement_properties(ids)
+    asyncio.run(EnhancementPipeline().run(ids))
+    refresh_alert_properties()
 
 
 if __name__ == "__main__":
@@ -1,11 +1,13 @@
 import logging
 import random
 import re
+from typing import Iterable, List
 
 import numpy as np
 import pytesseract
 import requests
 from imageio.v2 import imread
+from PIL import Image
 
 from config.logging import logging_setup
 from rightmove.utils import USER_AGENTS
@@ -13,6 +15,17 @@ from rightmove.utils import USER_AGENTS
 logger = logging.getLogger(__name__)
 logger = logging_setup(logger)
 
+# Optimised OCR mode: images are scaled so their longest side is at most OCR_MAX_SIDE pixels, tesseract looks for
+# sparse text (page segmentation mode 11) using only the characters an area statement needs, and the top and bottom
+# MARGIN_FRACTION of the image, where the total area is usually printed, are read before the full image. Full page
+# OCR stays the default until the fast mode has been checked against a corpus of images (benchmarks.floorplan_ocr).
+OCR_MODES = ["full", "fast"]
+OCR_MODE = "full"
+OCR_MAX_SIDE = 1600
+OCR_WHITELIST = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.,/()^:-"
+OCR_CONFIG = f"--psm 11 -c tessedit_char_whitelist={OCR_WHITELIST}"
+MARGIN_FRACTION = 0.25
+
 
 def download_img(url: str) -> np.ndarray:
     """
@@ -30,9 +43,20 @@ def download_img(url: str) -> np.ndarray:
         logger.debug(f"Image download failed for URL {url}.")
         return None
 
-    img = imread(r.content)
+    return decode_img(r.content)
+
+
+def decode_img(content: bytes) -> np.ndarray:
+    """
+    Decode a downloaded image.
+
+    Args:
+        content (bytes): The raw image file.
 
-    return img
+    Returns:
+        np.ndarray: The image as a NumPy array.
+    """
+    return imread(content)
 
 
 def extract_text(img: np.ndarray) -> str:
@@ -50,86 +74,260 @@ def extract_text(img: np.ndarray) -> str:
     return text
 
 
+def otsu_threshold(img: np.ndarray) -> int:
+    """
+    Find the threshold which best separates the dark and light pixels of a greyscale image (Otsu's method).
+
+    Args:
+        img (np.ndarray): 8-bit greyscale image.
+
+    Returns:
+        int: The threshold.
+    """
+    hist = np.bincount(img.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight_dark = np.cumsum(hist)
+    weight_light = weight_dark[-1] - weight_dark
+    sum_dark = np.cumsum(hist * levels)
+    mean_dark = sum_dark / np.maximum(weight_dark, 1)
+    mean_light = (sum_dark[-1] - sum_dark) / np.maximum(weight_light, 1)
+    between_variance = weight_dark * weight_light * (mean_dark - mean_light) ** 2
+
+    return int(np.argmax(between_variance))
+
+
+def preprocess_img(img: np.ndarray, max_side: int = OCR_MAX_SIDE) -> np.ndarray:
+    """
+    Prepare an image for OCR: convert to greyscale, downscale so the longest side is at most max_side and binarise.
+
+    Args:
+        img (np.ndarray): The image.
+        max_side (int): Maximum length in pixels of the longest side of the output.
+
+    Returns:
+        np.ndarray: 8-bit black and white image.
+    """
+    if img.dtype == np.uint16:
+        img = (img >> 8).astype(np.uint8)
+    elif img.dtype != np.uint8:
+        img = np.clip(img, 0, 255).astype(np.uint8)
+
+    # PIL does the greyscale conversion of every channel layout (L, LA, RGB, RGBA), transparent areas are drawn on
+    # white as they are when the floorplan is shown:
+    image = Image.fromarray(img)
+    if image.mode in ("LA", "RGBA"):
+        image = Image.alpha_composite(Image.new("RGBA", image.size, "white"), image.convert("RGBA"))
+    img = np.asarray(image.convert("L"))
+
+    scale = max_side / max(img.shape)
+    if scale < 1:
+        size = (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale)))
+        img = np.asarray(Image.fromarray(img).resize(size, Image.LANCZOS))
+
+    return np.where(img > otsu_threshold(img), 255, 0).astype(np.uint8)
+
+
+def extract_text_fast(img: np.ndarray) -> str:
+    """
+    Extract the area text from a floorplan using the optimised OCR mode. The top and bottom margins of the
+    preprocessed image are read first, and the full image is only read if neither contains an area.
+
+    Args:
+        img (np.ndarray): The image to extract text from.
+
+    Returns:
+        str: The extracted text.
+    """
+    img = preprocess_img(img)
+    margin = max(1, int(img.shape[0] * MARGIN_FRACTION))
+
+    for region in (img[-margin:], img[:margin]):
+        text = pytesseract.image_to_string(region, config=OCR_CONFIG)
+        if extract_internal_area(text)["sqft"]:
+            return text
+
+    return pytesseract.image_to_string(img, config=OCR_CONFIG)
+
+
+AREA_KEYWORDS = [
+    "total",
+    "internal area",
+    "internal floor area",
+    "approximate floor area",
+    "approximate area",
+]
+SQFT_OPTIONS = ["sq ft", "sqft", "sq. ft", "sq. ft.", "sq.ft.", "ft2", "ft^2"]
+SQM_OPTIONS = ["sq m", "sqm", "sq. m", "sq. m.", "sq.m.", "m2", "m^2"]
+AREA_NUMBER = r"(?:\d+(?:,\d{3})*\.\d+|\d+(?:,\d{3})*|\d+)"
+SQM_TO_SQFT = 10.7639
+
+# Single pattern which finds keywords and measurements in one sweep over the whole text. The measurements are
+# lookaheads, so matches don't consume any text and the sqft and sqm of a line can overlap (e.g. "850 ft275 sq m"),
+# and both are tried at every number followed by something like a unit, as the unit options are regular expressions
+# and e.g. "14 sqmft^2" is both:
+AREA_SCANNER = re.compile(
+    rf"(?P<keyword>{'|'.join(re.escape(k) for k in AREA_KEYWORDS)})"
+    rf"|(?=\d[\d,.]* [sfm])(?:(?=(?P<sqft>{AREA_NUMBER}) (?:{'|'.join(SQFT_OPTIONS)})))?"
+    rf"(?:(?=(?P<sqm>{AREA_NUMBER}) (?:{'|'.join(SQM_OPTIONS)})))?",
+    re.IGNORECASE,
+)
+
+
 def extract_internal_area(text):
     """
     Extract the internal area from the text extracted from an image.
 
+    Lines are read in order, the first sqft and sqm measurement of each line are used. Areas below 150 sq ft or
+    14 sq m are ignored, as are lines where the sqft and sqm don't agree, and sq m is converted to sq ft where there
+    is no sq ft. The first line with a measurement after a line containing one of AREA_KEYWORDS is returned,
+    otherwise the last measurement found.
+
     Args:
         text (str): The text to extract the internal area from.
 
     Returns:
         dict: A dictionary with keys 'sqft' and 'sqm' and their corresponding values.
     """
-
-    # Preprocessing
     cleaned_text = text.lower()
     sqm_out = None
     sqft_out = None
-
-    # Text Analysis
     total_check = False
-    for line in cleaned_text.split("\n"):
-        sqft = None
-        sqm = None
 
-        for string in [
-            "total",
-            "internal area",
-            "internal floor area",
-            "approximate floor area",
-            "approximate area",
-        ]:
-            if string in line:
-                total_check = True
-                break
-
-        # Regular Expressions
-        sqft_options = ["sq ft", "sqft", "sq. ft", "sq. ft.", "sq.ft.", "ft2", "ft^2"]
-        sqft_pattern = re.compile(
-            rf"(\d+(,\d{{3}})*\.\d+|\d+(,\d{{3}})*|\d+) ({'|'.join(sqft_options)})",
-            re.IGNORECASE,
-        )
-
-        sqm_options = ["sq m", "sqm", "sq. m", "sq. m.", "sq.m.", "m2", "m^2"]
-        sqm_pattern = re.compile(
-            rf"(\d+(,\d{{3}})*\.\d+|\d+(,\d{{3}})*|\d+) ({'|'.join(sqm_options)})",
-            re.IGNORECASE,
-        )
-
-        # Extracting data
-        sqft_match = sqft_pattern.search(line)
-        sqm_match = sqm_pattern.search(line)
-
-        sqft = float(sqft_match.group(1).replace(",", "")) if sqft_match else None
-        sqm = float(sqm_match.group(1).replace(",", "")) if sqm_match else None
-
-        # Break loop if no data:
-        if sqft is None and sqm is None:
-            continue
-
-        # Remove outliers:
-        if sqft and sqft < 150:
+    line_end = -1
+    sqft = None
+    sqm = None
+
+    matches = AREA_SCANNER.finditer(cleaned_text)
+    for match in matches:
+        if match.start() > line_end:
+            # Finish the previous line:
+            if sqft is not None or sqm is not None:
+                sqft, sqm = check_area(sqft, sqm)
+                if sqft and total_check:
+                    return {"sqft": sqft, "sqm": sqm}
+                if sqft:
+                    sqft_out = sqft
+                if sqm:
+                    sqm_out = sqm
+
+            line_end = cleaned_text.find("\n", match.start())
+            if line_end == -1:
+                line_end = len(cleaned_text)
             sqft = None
-        if sqm and sqm < 14:
             sqm = None
 
-        # Remove inconsistent conversions:
-        if sqft and sqm:
-            if abs((sqft / sqm) - 10.7639) > 1:
-                continue
-
-        # Convert sqm to sqft:
-        if sqft is None and sqm:
-            sqft = round(sqm * 10.7639, 0)
+        keyword, match_sqft, match_sqm = match.group("keyword", "sqft", "sqm")
+        if keyword:
+            total_check = True
+        if match_sqft and sqft is None:
+            sqft = float(match_sqft.replace(",", ""))
+        if match_sqm and sqm is None:
+            sqm = float(match_sqm.replace(",", ""))
 
+    if sqft is not None or sqm is not None:
+        sqft, sqm = check_area(sqft, sqm)
         if sqft and total_check:
-            sqft_out = sqft
-            sqm_out = sqm
-            break
-
+            return {"sqft": sqft, "sqm": sqm}
         if sqft:
             sqft_out = sqft
         if sqm:
             sqm_out = sqm
 
     return {"sqft": sqft_out, "sqm": sqm_out}
+
+
+def check_area(sqft, sqm):
+    """
+    Apply the outlier and conversion rules to the sqft and sqm measurements of a line.
+
+    Returns:
+        Tuple: the sqft and sqm to use, sqft is None if the line should be ignored.
+    """
+    # Remove outliers:
+    if sqft and sqft < 150:
+        sqft = None
+    if sqm and sqm < 14:
+        sqm = None
+
+    # Remove inconsistent conversions:
+    if sqft and sqm:
+        if abs((sqft / sqm) - SQM_TO_SQFT) > 1:
+            return None, None
+
+    # Convert sqm to sqft:
+    if sqft is None and sqm:
+        sqft = round(sqm * SQM_TO_SQFT, 0)
+
+    return sqft, sqm
+
+
+def extract_sizings_area(sizings: List[dict]) -> dict:
+    """
+    Extract the internal area from the structured sizes of a property page, using the same outlier and conversion
+    rules as extract_internal_area. Size ranges (e.g. for developments) are ignored.
+
+    Args:
+        sizings (List[dict]): The "sizings" of parse_property_page, e.g. {"unit": "sqft", "minimumSize": 850,
+            "maximumSize": 850}.
+
+    Returns:
+        dict: A dictionary with keys 'sqft' and 'sqm' and their corresponding values.
+    """
+    sizes = {}
+    for sizing in sizings:
+        unit = sizing.get("unit")
+        minimum, maximum = sizing.get("minimumSize"), sizing.get("maximumSize")
+        if unit in ("sqft", "sqm") and maximum and minimum in (None, maximum):
+            sizes[unit] = float(maximum)
+
+    sqft, sqm = check_area(sizes.get("sqft"), sizes.get("sqm"))
+    return {"sqft": sqft, "sqm": sqm}
+
+
+def extract_internal_areas(texts: Iterable[str]) -> List[dict]:
+    """
+    Extract the internal area from many texts, see extract_internal_area.
+
+    Args:
+        texts (Iterable[str]): The texts to extract the internal area from.
+
+    Returns:
+        List[dict]: A dictionary with keys 'sqft' and 'sqm' for each text.
+    """
+    return [extract_internal_area(text) for text in texts]
+
+
+def ocr_extractor(mode: str = OCR_MODE) -> str:
+    """
+    Identify the OCR mode and the settings it depends on, so that results cached with other settings are not reused.
+
+    Args:
+        mode (str): The OCR mode, one of OCR_MODES.
+
+    Returns:
+        str: The mode and its settings.
+    """
+    if mode == "fast":
+        return f"fast max_side={OCR_MAX_SIDE} margin={MARGIN_FRACTION} {OCR_CONFIG}"
+    return mode
+
+
+def analyse_floorplan(content: bytes, mode: str = OCR_MODE) -> dict:
+    """
+    Decode a downloaded floorplan image and extract its text and internal area. This is a top level function so
+    that it can be run in a process pool.
+
+    Args:
+        content (bytes): The raw image file.
+        mode (str): "fast" for the optimised OCR mode (extract_text_fast) or "full" for full page OCR of the
+            original image (extract_text).
+
+    Returns:
+        dict: A dictionary with the OCR output under 'text' and the internal area under 'sqft' and 'sqm'.
+    """
+    if mode not in OCR_MODES:
+        raise ValueError(f"Valid options for mode are {OCR_MODES}, got: {mode}")
+
+    img = decode_img(content)
+    text = extract_text_fast(img) if mode == "fast" else extract_text(img)
+    return {"text": text, **extract_internal_area(text)}
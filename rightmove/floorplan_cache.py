@@ -0,0 +1,223 @@
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from config import DATA
+from rightmove.floorplan import ocr_extractor
+
+FLOORPLAN_CACHE_DIR = os.path.join(DATA, "floorplan_cache")
+MAX_CACHE_BYTES = 512 * 1024 * 1024
+
+
+def normalise_url(url: str) -> str:
+    """
+    Normalise a floorplan URL so that the same image is always cached under the same key, ignoring the case of the
+    scheme and host, query strings and fragments.
+
+    Args:
+        url (str): The floorplan URL.
+
+    Returns:
+        str: The normalised URL.
+    """
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, "", ""))
+
+
+def hash_content(content: bytes) -> str:
+    """
+    Content hash used as the cache key of a floorplan image.
+    """
+    return hashlib.sha256(content).hexdigest()
+
+
+class FloorplanCache:
+    """
+    Content addressed on-disk cache of floorplan OCR results.
+
+    Normalised floorplan URLs map to the SHA-256 hash of the image, and each image hash maps to its OCR text and
+    extracted area, plus optionally the raw image bytes. A floorplan which has been seen before under the same URL
+    costs no download or OCR, and one seen under a different URL costs a download but no OCR. Results are stored with
+    the OCR mode and settings which produced them (see floorplan.ocr_extractor), and results of other settings are
+    treated as misses. Entries are evicted in least recently used order once the cache is larger than max_bytes.
+    """
+
+    def __init__(
+        self,
+        directory: str = FLOORPLAN_CACHE_DIR,
+        max_bytes: int = MAX_CACHE_BYTES,
+        store_images=False,
+        extractor: str = None,
+    ):
+        """
+        Args:
+            directory (str): Directory of the cache.
+            max_bytes (int): Maximum size of the cached text and images.
+            store_images (bool): If True the raw image bytes are also cached.
+            extractor (str): The OCR mode and settings of the cached results, defaults to the current ones.
+        """
+        self.directory = Path(directory)
+        self.blob_dir = self.directory / "images"
+        self.max_bytes = max_bytes
+        self.store_images = store_images
+        self.extractor = extractor or ocr_extractor()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.conn = sqlite3.connect(self.directory / "index.sqlite")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS urls (
+                url TEXT PRIMARY KEY,
+                hash TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                hash TEXT PRIMARY KEY,
+                text TEXT,
+                sqft REAL,
+                sqm REAL,
+                has_image INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                extractor TEXT
+            );
+            CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access);
+        """)
+        # Caches created before the extractor was stored have no extractor, so their results are all misses:
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(results)")]
+        if "extractor" not in columns:
+            self.conn.execute("ALTER TABLE results ADD COLUMN extractor TEXT")
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def blob_path(self, content_hash: str) -> Path:
+        return self.blob_dir / content_hash[:2] / content_hash
+
+    def get(self, url: str) -> Optional[Dict]:
+        """
+        Get the cached result of a floorplan URL.
+
+        Args:
+            url (str): The floorplan URL.
+
+        Returns:
+            Dict: A dictionary with 'text', 'sqft' and 'sqm' keys, or None if the URL is not cached.
+        """
+        row = self.conn.execute("SELECT hash FROM urls WHERE url = ?", (normalise_url(url),)).fetchone()
+        if row is None:
+            return None
+
+        return self.get_by_hash(row[0])
+
+    def get_by_hash(self, content_hash: str, url: str = None) -> Optional[Dict]:
+        """
+        Get the cached result of a floorplan image.
+
+        Args:
+            content_hash (str): The hash of the image, see hash_content.
+            url (str): Optional URL the image was downloaded from, which is linked to the image if it is cached.
+
+        Returns:
+            Dict: A dictionary with 'text', 'sqft' and 'sqm' keys, or None if the image is not cached with the current
+                extractor.
+        """
+        row = self.conn.execute(
+            "SELECT text, sqft, sqm FROM results WHERE hash = ? AND extractor = ?",
+            (content_hash, self.extractor),
+        ).fetchone()
+        if row is None:
+            return None
+
+        self.conn.execute("UPDATE results SET last_access = ? WHERE hash = ?", (time.time(), content_hash))
+        if url is not None:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO urls (url, hash) VALUES (?, ?)",
+                (normalise_url(url), content_hash),
+            )
+        self.conn.commit()
+
+        return {"text": row[0], "sqft": row[1], "sqm": row[2]}
+
+    def put(self, url: str, content: bytes, result: Dict) -> str:
+        """
+        Cache the result of a floorplan image.
+
+        Args:
+            url (str): The URL the image was downloaded from.
+            content (bytes): The raw image.
+            result (Dict): A dictionary with 'text', 'sqft' and 'sqm' keys.
+
+        Returns:
+            str: The hash of the image.
+        """
+        content_hash = hash_content(content)
+        text = result.get("text") or ""
+        size = len(text.encode())
+
+        if self.store_images:
+            path = self.blob_path(content_hash)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+            size += len(content)
+
+        self.conn.execute(
+            """
+            INSERT OR REPLACE INTO results (hash, text, sqft, sqm, has_image, size, last_access, extractor)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                content_hash,
+                text,
+                result.get("sqft"),
+                result.get("sqm"),
+                int(self.store_images),
+                size,
+                time.time(),
+                self.extractor,
+            ),
+        )
+        self.conn.execute("INSERT OR REPLACE INTO urls (url, hash) VALUES (?, ?)", (normalise_url(url), content_hash))
+        self.conn.commit()
+        self.evict()
+
+        return content_hash
+
+    def size(self) -> int:
+        """
+        Total size in bytes of the cached text and images.
+        """
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries until the cache is no larger than max_bytes.
+        """
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+
+        evicted = []
+        for content_hash, has_image, size in self.conn.execute(
+            "SELECT hash, has_image, size FROM results ORDER BY last_access"
+        ):
+            evicted.append((content_hash, has_image))
+            excess -= size
+            if excess <= 0:
+                break
+
+        for content_hash, has_image in evicted:
+            self.conn.execute("DELETE FROM results WHERE hash = ?", (content_hash,))
+            self.conn.execute("DELETE FROM urls WHERE hash = ?", (content_hash,))
+            if has_image:
+                self.blob_path(content_hash).unlink(missing_ok=True)
+        self.conn.commit()
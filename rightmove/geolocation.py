@@ -1,7 +1,9 @@
+import asyncio
 import json
 import logging
 from os import path
 from pathlib import Path
+from typing import Dict, List, NamedTuple, Tuple
 
 import numba
 import numpy as np
@@ -9,39 +11,74 @@ import pandas as pd
 from numba import njit
 
 from config.logging import logging_setup
-from rightmove.database import (
-    model_executemany,
-    get_location_dataframe,
-    get_database_connection,
-)
-from rightmove.models import PropertyLocationExcluded, TravelTimePrecise
+from rightmove import statements
+from rightmove.async_database import stream_locations
+from rightmove.database import copy_upsert_dataframe, get_database_connection, refresh_alert_properties
 
 # Setting up logger
 logger = logging.getLogger(__name__)
 logger = logging_setup(logger)
 
+SHAPES_DIR = Path(path.dirname(path.dirname(__file__)), "shapes")
+DEFAULT_DESTINATION = "default"
+COMPILED_SHAPES_FILE = "isochrones.npz"
 
-@njit()
-def point_in_polygon(x: float | np.ndarray, y: float | np.ndarray, polygon: np.ndarray):
+RING_SHELL = 0
+RING_HOLE = 1
+RING_EXCLUDE = 2
+NO_TRAVEL_TIME = 999
+
+# How the commutes to each destination are combined into the travel_time used by the alert filters:
+COMMUTE_AGGREGATES = {"max": np.max, "sum": np.sum, "min": np.min}
+COMMUTE_AGGREGATE = "max"
+COMMUTE_PREFIX = "commute_"
+
+
+class CompiledShapes(NamedTuple):
+    """
+    All rings of all shape files flattened into ragged arrays, so they can be passed to numba in a single call.
+
+    Ring r has the vertices vertices[offsets[r]:offsets[r + 1]], a role (RING_SHELL, RING_HOLE or RING_EXCLUDE),
+    the travel time band of the file it came from (-1 for exclusion rings), a bounding box of
+    (min_x, min_y, max_x, max_y) and the index of the destination it belongs to in names (-1 for exclusion rings).
+    Exclusion rings come first, followed by the rings of each destination in turn. Holes directly follow the shell
+    they belong to and shells are sorted by band, destination_ends[r] is the index of the first ring after the
+    destination of ring r.
     """
-    Check if a given point is inside a polygon
+
+    vertices: np.ndarray
+    offsets: np.ndarray
+    roles: np.ndarray
+    bands: np.ndarray
+    bboxes: np.ndarray
+    destinations: np.ndarray
+    destination_ends: np.ndarray
+    names: Tuple[str, ...]
+
+
+@njit(cache=True)
+def point_in_ring(x: float, y: float, vertices: np.ndarray, start: int, end: int) -> bool:
+    """
+    Check if a given point is inside a ring stored in a ragged vertex array
 
     Args:
         x (float): x-coordinate of the point
         y (float): y-coordinate of the point
-        polygon (list): list of tuples representing the vertices of the polygon
+        vertices (numpy.ndarray): array of the vertices of all rings
+        start (int): index of the first vertex of the ring
+        end (int): index after the last vertex of the ring
 
     Returns:
-        bool: True if the point is inside the polygon, False otherwise
+        bool: True if the point is inside the ring, False otherwise
     """
-    n = len(polygon)
+    n = end - start
     inside = False
-    p2x = 0.0
-    p2y = 0.0
     xints = 0.0
-    p1x, p1y = polygon[0]
-    for i in numba.prange(n + 1):
-        p2x, p2y = polygon[i % n]
+    p1x = vertices[start, 0]
+    p1y = vertices[start, 1]
+    for i in range(n + 1):
+        p2x = vertices[start + i % n, 0]
+        p2y = vertices[start + i % n, 1]
         if y > min(p1y, p2y):
             if y <= max(p1y, p2y):
                 if x <= max(p1x, p2x):
@@ -54,23 +91,77 @@ def point_in_polygon(x: float | np.ndarray, y: float | np.ndarray, polygon: np.n
     return inside
 
 
-@njit(parallel=True)
-def points_in_polygon_parallel(points: np.ndarray, polygon: np.ndarray):
+@njit(cache=True)
+def point_in_ring_bbox(
+    x: float, y: float, vertices: np.ndarray, offsets: np.ndarray, bboxes: np.ndarray, ring: int
+) -> bool:
+    """
+    Check if a given point is inside a ring, rejecting points outside of the ring's bounding box without walking
+    its edges.
+    """
+    if x < bboxes[ring, 0] or y < bboxes[ring, 1] or x > bboxes[ring, 2] or y > bboxes[ring, 3]:
+        return False
+
+    return point_in_ring(x, y, vertices, offsets[ring], offsets[ring + 1])
+
+
+@njit(parallel=True, cache=True)
+def classify_points(
+    points: np.ndarray,
+    vertices: np.ndarray,
+    offsets: np.ndarray,
+    roles: np.ndarray,
+    bands: np.ndarray,
+    bboxes: np.ndarray,
+    destinations: np.ndarray,
+    destination_ends: np.ndarray,
+    n_destinations: int,
+):
     """
-    Check an array of points and return an array representing whether each point is inside the given polygon.
+    Check an array of points against every ring of every shape file, for every destination, in a single parallel
+    pass.
 
     Args:
-        points (numpy.ndarray): array of points where each point is represented as a tuple of x and y coordinates
-        polygon (list): list of tuples representing the vertices of the polygon
+        points (numpy.ndarray): array of points where each point is represented as a pair of x and y coordinates
+        vertices, offsets, roles, bands, bboxes, destinations, destination_ends (numpy.ndarray): the arrays of a
+            CompiledShapes tuple
+        n_destinations (int): the number of destinations
 
     Returns:
-        numpy.ndarray: array of booleans representing whether each point is inside the polygon
+        numpy.ndarray: (points, destinations) array of the smallest travel time band containing each point, or
+            NO_TRAVEL_TIME
+        numpy.ndarray: array of booleans representing whether each point is inside an exclusion ring
     """
-    D = np.empty(len(points), dtype=numba.boolean)
-    for i in numba.prange(0, len(D)):
-        D[i] = point_in_polygon(points[i, 0], points[i, 1], polygon)
-
-    return D
+    n_rings = len(roles)
+    travel_time = np.full((len(points), n_destinations), NO_TRAVEL_TIME, dtype=np.int32)
+    excluded = np.zeros(len(points), dtype=np.bool_)
+
+    for i in numba.prange(len(points)):
+        x = points[i, 0]
+        y = points[i, 1]
+        r = 0
+        while r < n_rings:
+            if roles[r] == RING_EXCLUDE:
+                if not excluded[i]:
+                    excluded[i] = point_in_ring_bbox(x, y, vertices, offsets, bboxes, r)
+                r += 1
+                continue
+
+            # A shell, followed by its holes:
+            shell = r
+            inside = point_in_ring_bbox(x, y, vertices, offsets, bboxes, r)
+            r += 1
+            while r < n_rings and roles[r] == RING_HOLE:
+                if inside and point_in_ring_bbox(x, y, vertices, offsets, bboxes, r):
+                    inside = False
+                r += 1
+
+            # Shells are sorted by band, so the first match is the smallest travel time for this destination:
+            if inside:
+                travel_time[i, destinations[shell]] = bands[shell]
+                r = destination_ends[shell]
+
+    return travel_time, excluded
 
 
 def get_shape(filepath: Path):
@@ -104,80 +195,310 @@ def get_shape(filepath: Path):
     return data["shapes"]
 
 
-def check_points(df: pd.DataFrame) -> pd.DataFrame:
+def ring_to_array(ring: List[dict]) -> np.ndarray:
+    """
+    Convert a list of {"lat": ..., "lng": ...} vertices into an (n, 2) array of (lat, lng) pairs. Exclusion files
+    created by convert_geojson.py use "lon" rather than "lng".
+    """
+    return np.array([(v["lat"], v["lng"] if "lng" in v else v["lon"]) for v in ring], dtype=np.float64)
+
+
+def get_destination_dirs(shapes_dir: Path = SHAPES_DIR) -> Dict[str, Path]:
+    """
+    Find the isochrone set of each commute destination. Each destination has its own directory of sub_*m.json
+    files in shapes/destinations/<name>/, if there are none then the sub_*m.json files in the shapes directory are
+    used as a single destination named DEFAULT_DESTINATION.
 
-    df = df.sort_values("property_id")
-    points = df[["latitude", "longitude"]].values
-    keep_cols = []
-    parent_dir = Path(path.dirname(path.dirname(__file__)))
-
-    # Loop through all of the travel time polygons:
-    files = sorted(list(parent_dir.glob("shapes/sub_*.json")))
-    for file in files:
-        result = np.zeros(len(points), dtype=bool)
-        for polygon_data in get_shape(file):
-            polygon = pd.DataFrame(polygon_data["shell"]).values
-            result = np.logical_or(result, points_in_polygon_parallel(points, polygon))
-            for hole in polygon_data["holes"]:
-                polygon = pd.DataFrame(hole).values
-                result = np.logical_and(
-                    result, ~points_in_polygon_parallel(points, polygon)
-                )
-
-        col = int(file.stem.replace("sub_", "").replace("m", ""))
-        keep_cols.append(col)
-        df[col] = result
-        df[int(file.stem.replace("sub_", "").replace("m", ""))] = result
-
-    files = sorted(list(parent_dir.glob("shapes/exclude_*.json")))
-    exclude_location = np.zeros(len(points), dtype=bool)
-    for file in files:
+    Args:
+        shapes_dir (Path): directory containing the shape files
+
+    Returns:
+        Dict[str, Path]: the directory of each destination, by name
+    """
+    destinations_dir = shapes_dir / "destinations"
+    destinations = {}
+    if destinations_dir.is_dir():
+        destinations = {d.name: d for d in sorted(destinations_dir.iterdir()) if d.is_dir()}
+
+    if not destinations:
+        destinations = {DEFAULT_DESTINATION: shapes_dir}
+
+    return destinations
+
+
+def get_band_files(directory: Path) -> List[Tuple[int, Path]]:
+    """
+    Return the travel time band (in minutes) and path of each sub_*m.json file in a directory, sorted by band.
+    """
+    files = [(int(f.stem.replace("sub_", "").replace("m", "")), f) for f in directory.glob("sub_*.json")]
+    return sorted(files)
+
+
+def read_destination_rings(directory: Path) -> List[Tuple[int, int, np.ndarray]]:
+    """
+    Read the rings of one destination's isochrone set, from the compiled COMPILED_SHAPES_FILE if there is one, or
+    otherwise from its sub_*m.json files.
+
+    Args:
+        directory (Path): the directory of the destination
+
+    Returns:
+        List[Tuple[int, int, np.ndarray]]: the role, band and vertices of each ring, sorted by band with holes
+            directly following their shell
+    """
+    compiled = directory / COMPILED_SHAPES_FILE
+    if compiled.exists():
+        with np.load(compiled) as data:
+            vertices = data["vertices"]
+            offsets = data["offsets"]
+            return [
+                (int(role), int(band), vertices[offsets[r] : offsets[r + 1]])
+                for r, (role, band) in enumerate(zip(data["roles"], data["bands"]))
+            ]
+
+    return isochrone_rings({band: get_shape(file) for band, file in get_band_files(directory)})
+
+
+def isochrone_rings(isochrones: Dict[int, List[dict]]) -> List[Tuple[int, int, np.ndarray]]:
+    """
+    Flatten the shapes of each travel time band into a list of (role, band, vertices) rings, sorted by band with
+    holes directly following their shell.
+
+    Args:
+        isochrones (Dict[int, List[dict]]): the shapes of each travel time band (in minutes), in the format
+            returned by get_shape
+    """
+    rings = []
+    for band in sorted(isochrones):
+        for polygon_data in isochrones[band]:
+            if not polygon_data["shell"]:
+                continue
+            rings.append((RING_SHELL, band, ring_to_array(polygon_data["shell"])))
+            for hole in polygon_data.get("holes", []):
+                if hole:
+                    rings.append((RING_HOLE, band, ring_to_array(hole)))
+
+    return rings
+
+
+def write_compiled_shapes(filepath: Path, isochrones: Dict[int, List[dict]]) -> None:
+    """
+    Write a destination's isochrone set in the compiled format read by read_destination_rings.
+
+    Args:
+        filepath (Path): path of the .npz file to write
+        isochrones (Dict[int, List[dict]]): the shapes of each travel time band (in minutes), in the format
+            returned by get_shape
+    """
+    rings = isochrone_rings(isochrones)
+    arrays = [ring[2] for ring in rings]
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(
+        filepath,
+        vertices=np.concatenate(arrays) if arrays else np.empty((0, 2), dtype=np.float64),
+        offsets=np.concatenate([[0], np.cumsum([len(a) for a in arrays], dtype=np.int64)]).astype(np.int64),
+        roles=np.array([ring[0] for ring in rings], dtype=np.int8),
+        bands=np.array([ring[1] for ring in rings], dtype=np.int32),
+    )
+
+
+def compile_shapes(shapes_dir: Path = SHAPES_DIR) -> CompiledShapes:
+    """
+    Read the isochrone sets of every destination and the exclusion (exclude_*.json) shape files, and flatten them
+    into the ragged arrays used by classify_points.
+
+    Args:
+        shapes_dir (Path): directory containing the shape files
+
+    Returns:
+        CompiledShapes: the rings of every shape file
+    """
+    rings = []
+
+    for file in sorted(shapes_dir.glob("exclude_*.json")):
         for polygon_data in get_shape(file):
-            polygon = pd.DataFrame(polygon_data["shell"]).values
-            result = points_in_polygon_parallel(points, polygon)
-            exclude_location = np.logical_or(exclude_location, result)
+            if polygon_data["shell"]:
+                rings.append((RING_EXCLUDE, -1, -1, ring_to_array(polygon_data["shell"])))
+
+    destination_dirs = get_destination_dirs(shapes_dir)
+    for destination, directory in enumerate(destination_dirs.values()):
+        for role, band, vertices in read_destination_rings(directory):
+            rings.append((role, band, destination, vertices))
+    names = tuple(destination_dirs.keys())
+    if not rings:
+        return CompiledShapes(
+            vertices=np.empty((0, 2), dtype=np.float64),
+            offsets=np.zeros(1, dtype=np.int64),
+            roles=np.empty(0, dtype=np.int8),
+            bands=np.empty(0, dtype=np.int32),
+            bboxes=np.empty((0, 4), dtype=np.float64),
+            destinations=np.empty(0, dtype=np.int32),
+            destination_ends=np.empty(0, dtype=np.int64),
+            names=names,
+        )
+
+    arrays = [ring[3] for ring in rings]
+    destinations = np.array([ring[2] for ring in rings], dtype=np.int32)
+
+    # Rings are grouped by destination, so the end of each group is the first ring of a later destination:
+    destination_ends = np.searchsorted(destinations, destinations, side="right").astype(np.int64)
+
+    return CompiledShapes(
+        vertices=np.concatenate(arrays),
+        offsets=np.concatenate([[0], np.cumsum([len(a) for a in arrays])]).astype(np.int64),
+        roles=np.array([ring[0] for ring in rings], dtype=np.int8),
+        bands=np.array([ring[1] for ring in rings], dtype=np.int32),
+        bboxes=np.array([(*a.min(axis=0), *a.max(axis=0)) for a in arrays], dtype=np.float64),
+        destinations=destinations,
+        destination_ends=destination_ends,
+        names=names,
+    )
+
 
-    df["exclude_location"] = exclude_location
+def classify_locations(
+    property_ids: np.ndarray,
+    points: np.ndarray,
+    shapes: CompiledShapes,
+    aggregate: str = COMMUTE_AGGREGATE,
+) -> pd.DataFrame:
+    """
+    Calculate the travel time to each destination and the excluded flag for arrays of property IDs and
+    (latitude, longitude) points.
+
+    Args:
+        property_ids (np.ndarray): array of property IDs
+        points (np.ndarray): (n, 2) array of latitude, longitude points
+        shapes (CompiledShapes): the compiled shape files
+        aggregate (str): how the commutes are combined into travel_time, one of COMMUTE_AGGREGATES
 
-    df = df.melt(
-        id_vars=["property_id"],
-        value_vars=keep_cols,
-        var_name="travel_time",
-        value_name="in_polygon",
+    Returns:
+        pd.DataFrame: DataFrame with property_id, travel_time and excluded columns, and a commute_<name> column
+            with the travel time to each destination
+    """
+    if aggregate not in COMMUTE_AGGREGATES:
+        raise ValueError(f"Valid options for aggregate are {list(COMMUTE_AGGREGATES)}, got: {aggregate}")
+
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    commutes, excluded = classify_points(
+        points,
+        shapes.vertices,
+        shapes.offsets,
+        shapes.roles,
+        shapes.bands,
+        shapes.bboxes,
+        shapes.destinations,
+        shapes.destination_ends,
+        len(shapes.names),
     )
-    df["travel_time"] = df.travel_time.where(df.in_polygon, 999)
-    df = df.groupby("property_id").agg({"travel_time": "min"}).reset_index()
-    df = df.sort_values("property_id")
-    df["excluded"] = exclude_location
+
+    df = pd.DataFrame({
+        "property_id": np.array(property_ids, dtype=np.int64),
+        "travel_time": COMMUTE_AGGREGATES[aggregate](commutes, axis=1),
+        "excluded": excluded,
+    })
+    for i, name in enumerate(shapes.names):
+        df[f"{COMMUTE_PREFIX}{name}"] = commutes[:, i]
 
     return df
 
 
-def update_locations():
+def check_points(df: pd.DataFrame, shapes: CompiledShapes = None, aggregate: str = COMMUTE_AGGREGATE) -> pd.DataFrame:
+    """
+    Calculate the travel time band and excluded flag for each property location.
+
+    Args:
+        df (pd.DataFrame): DataFrame with property_id, latitude and longitude columns
+        shapes (CompiledShapes): the compiled shape files, these are read from the shapes directory if not given
+        aggregate (str): how the commutes are combined into travel_time, one of COMMUTE_AGGREGATES
+
+    Returns:
+        pd.DataFrame: the output of classify_locations, sorted by property_id
+    """
+    if shapes is None:
+        shapes = compile_shapes()
+
+    df = df.sort_values("property_id")
+
+    return classify_locations(df["property_id"].values, df[["latitude", "longitude"]].values, shapes, aggregate)
+
+
+def update_locations(ids: List[int] = None, chunk_size: int = 100_000, aggregate: str = COMMUTE_AGGREGATE):
     """
     Add time travel data for properties which have not been updated yet.
+
+    Locations are streamed from the database in chunks of chunk_size, each chunk is classified and written back
+    before the next is read.
+
+    Args:
+        ids (List[int]): Optional list of property IDs to update instead of those not yet reviewed.
+        chunk_size (int): Number of locations to classify at a time.
+        aggregate (str): how the commutes are combined into travel_time, one of COMMUTE_AGGREGATES
     """
-    df = get_location_dataframe()
+    shapes = compile_shapes()
+
+    with get_database_connection() as conn:
 
-    if len(df) == 0:
+        def process_chunk(property_ids: np.ndarray, points: np.ndarray) -> None:
+            logger.info(f"Updating {len(property_ids)} properties...")
+            save_locations(classify_locations(property_ids, points, shapes, aggregate), conn)
+
+        count = asyncio.run(stream_locations(process_chunk, ids=ids, chunk_size=chunk_size))
+        conn.commit()
+
+    refresh_alert_properties()
+
+    if count == 0:
         logger.info("No new properties found.")
+
+
+def save_locations(df: pd.DataFrame, conn=None) -> None:
+    """
+    Write the output of classify_locations to the travel_time_precise, property_location_excluded and
+    travel_time_matrix tables.
+
+    Args:
+        df (pd.DataFrame): DataFrame with property_id, travel_time, excluded and commute_<name> columns
+        conn: An open database connection, if not given a new connection is opened and committed
+    """
+    if conn is None:
+        with get_database_connection() as conn:
+            save_locations(df, conn)
+            conn.commit()
         return
 
-    logger.info(f"Updating {len(df)} properties...")
+    commute_columns = [col for col in df.columns if col.startswith(COMMUTE_PREFIX)]
+    names = [col[len(COMMUTE_PREFIX) :] for col in commute_columns]
 
-    df = check_points(df)
+    with conn.cursor() as cursor:
+        copy_upsert_dataframe(cursor, "travel_time_precise", df[["property_id", "travel_time"]], ["property_id"])
+        copy_upsert_dataframe(cursor, "property_location_excluded", df[["property_id", "excluded"]], ["property_id"])
 
-    travel_time_values = []
-    excluded_values = []
-    for index, row in df.iterrows():
-        travel_time_values.append(TravelTimePrecise(**row.to_dict()))
-        excluded_values.append(PropertyLocationExcluded(**row.to_dict()))
+        if commute_columns:
+            destination_ids = get_destination_ids(cursor, names)
+            matrix = pd.DataFrame({
+                "property_id": np.repeat(df["property_id"].values, len(names)),
+                "destination_id": np.tile([destination_ids[name] for name in names], len(df)),
+                "travel_time": df[commute_columns].values.ravel(),
+            })
+            copy_upsert_dataframe(cursor, "travel_time_matrix", matrix, ["property_id", "destination_id"])
 
-    with get_database_connection() as conn:
-        with conn.cursor() as cursor:
-            model_executemany(cursor, "travel_time_precise", travel_time_values)
-            model_executemany(cursor, "property_location_excluded", excluded_values)
-            conn.commit()
+
+def get_destination_ids(cursor, names: List[str]) -> Dict[str, int]:
+    """
+    Get the ID of each commute destination, adding any new destinations to the commute_destinations table. The
+    destinations which aren't in names are marked inactive and their travel times are deleted, so they no longer
+    count towards the commute aggregates of any property.
+
+    Args:
+        cursor: The database cursor.
+        names (List[str]): The names of the destinations.
+
+    Returns:
+        Dict[str, int]: The ID of each destination, by name.
+    """
+    statements.execute(cursor, "insert_destinations", names)
+    statements.execute(cursor, "deactivate_destinations", names)
+    return dict(statements.execute(cursor, "destination_ids", names).fetchall())
 
 
 if __name__ == "__main__":
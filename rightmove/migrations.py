@@ -0,0 +1,122 @@
+import argparse
+import hashlib
+import logging
+import os
+import re
+from pathlib import Path
+from typing import List, NamedTuple
+
+from config import BASE_DIR
+from config.logging import logging_setup
+from rightmove.database import get_database_connection
+
+logger = logging.getLogger(__name__)
+logger = logging_setup(logger)
+
+MIGRATIONS_DIR = os.path.join(BASE_DIR, "migrations")
+VIEWS_FILE = os.path.join(BASE_DIR, "views.sql")
+MIGRATION_FILE_REGEX = re.compile(r"^(\d{4})_(\w+)\.sql$")
+
+# Arbitrary key of the advisory lock held while migrating, so that two processes never apply the same migration:
+MIGRATION_LOCK_KEY = 7_294_301
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    sql: str
+
+    @property
+    def checksum(self) -> str:
+        return hashlib.sha256(self.sql.encode()).hexdigest()
+
+
+def get_migrations(directory: str = MIGRATIONS_DIR) -> List[Migration]:
+    """
+    Read the migrations from the migrations directory, where each migration is a file named <version>_<name>.sql,
+    e.g. 0003_query_indexes.sql.
+
+    Args:
+        directory (str): The directory of the migration files.
+
+    Returns:
+        List[Migration]: The migrations in version order.
+    """
+    migrations = []
+    for file in sorted(Path(directory).glob("*.sql")):
+        match = MIGRATION_FILE_REGEX.match(file.name)
+        if match is None:
+            raise ValueError(f"Migration file name must be <version>_<name>.sql: {file.name}")
+        migrations.append(Migration(int(match.group(1)), match.group(2), file.read_text()))
+
+    versions = [migration.version for migration in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f"Duplicate migration versions in {directory}")
+
+    return migrations
+
+
+def migrate(directory: str = MIGRATIONS_DIR, views_file: str = VIEWS_FILE, apply_views: bool = True) -> List[int]:
+    """
+    Apply the migrations which haven't been applied to the database yet, each in its own transaction, then recreate
+    the views from views.sql. Applied migrations are recorded in schema_migrations, and a warning is logged if one
+    has been edited since it was applied.
+
+    Args:
+        directory (str): The directory of the migration files.
+        views_file (str): The SQL file of the views, functions and triggers, which is reapplied on every run.
+        apply_views (bool): If False only the migrations are applied.
+
+    Returns:
+        List[int]: The versions of the migrations which were applied.
+    """
+    migrations = get_migrations(directory)
+    applied = []
+
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations
+                (
+                    version    integer      NOT NULL PRIMARY KEY,
+                    name       varchar(100) NOT NULL,
+                    checksum   char(64)     NOT NULL,
+                    applied_at timestamp    NOT NULL DEFAULT now()
+                )
+            """)
+            conn.commit()
+
+            for migration in migrations:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+                cursor.execute("SELECT checksum FROM schema_migrations WHERE version = %s", (migration.version,))
+                row = cursor.fetchone()
+                if row is not None:
+                    if row[0] != migration.checksum:
+                        logger.warning(f"Migration {migration.version} ({migration.name}) changed since it was applied")
+                    conn.commit()
+                    continue
+
+                logger.info(f"Applying migration {migration.version} ({migration.name})")
+                cursor.execute(migration.sql)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                    (migration.version, migration.name, migration.checksum),
+                )
+                conn.commit()
+                applied.append(migration.version)
+
+            if apply_views:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+                cursor.execute(Path(views_file).read_text())
+                conn.commit()
+
+    return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply the database migrations and recreate the views.")
+    parser.add_argument("--no-views", action="store_true", help="Only apply the migrations")
+    args = parser.parse_args()
+
+    versions = migrate(apply_views=not args.no_views)
+    logger.info(f"Applied {len(versions)} migrations")
@@ -120,6 +120,7 @@ class PropertyFloorplan(BaseModel):
     floorplan_url: Optional[str] = Field(default=None)
     area_sqft: Optional[float] = Field(default=None)
     area_sqm: Optional[float] = Field(default=None)
+    area_source: Optional[str] = Field(default=None)
 
 
 class PropertyDescription(BaseModel):
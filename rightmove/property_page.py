@@ -0,0 +1,154 @@
+import html
+import json
+import re
+from typing import Dict, List, Optional
+
+import lxml.etree
+import lxml.html
+
+FLOORPAN_REGEX = re.compile("_FLP_00_")
+RESIZED_IMAGE_REGEX = re.compile(r"(_\d{2}_\d{4})(.+)(.gif|.jpeg|.png)")
+PAGE_MODEL_REGEX = re.compile(r"window\.PAGE_MODEL\s*=\s*")
+LINE_BREAK_REGEX = re.compile(r"<br\s*/?>|</?(?:p|div|li|ul)\b[^>]*>", re.IGNORECASE)
+TAG_REGEX = re.compile(r"<[^>]+>")
+
+# Class names of the key features and description on the rendered page, these change whenever Rightmove rebuilds
+# their front end, so they are only used when the page model is missing:
+KEY_FEATURES_CLASS = "_1uI3IvdF5sIuBtRIvKrreQ"
+DESCRIPTION_CLASS = "_1a8kqJPMw6HOD9SDZq61E8"
+
+JSON_DECODER = json.JSONDecoder()
+
+
+def original_image_url(url: str) -> str:
+    """
+    Remove the resizing suffix from a Rightmove image URL, e.g. ..._FLP_00_0000_max_296x197.gif -> ..._FLP_00_0000.gif
+    """
+    return RESIZED_IMAGE_REGEX.sub(r"\1\3", url)
+
+
+def make_summary(key_features: List[str], description: str) -> str:
+    """
+    Format the key features and description of a property as the summary text used by analyse_summary.
+    """
+    summary = ""
+    if key_features:
+        summary += "## KEY FEATURES:\n" + "\n".join(key_features) + "\n"
+    if description:
+        summary += f"## DESCRIPTION:\n{description}"
+
+    return summary
+
+
+def html_to_text(fragment: str) -> str:
+    """
+    Convert a HTML fragment to text with one line per text block, like BeautifulSoup's stripped_strings.
+    """
+    text = html.unescape(TAG_REGEX.sub("", LINE_BREAK_REGEX.sub("\n", fragment)))
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+
+def get_page_model(content: bytes) -> Optional[Dict]:
+    """
+    Get the page model JSON which Rightmove embeds in a script on each property page (window.PAGE_MODEL = {...}).
+    Only the JSON object is decoded, the rest of the page isn't parsed.
+
+    Args:
+        content (bytes): The HTML of the property page.
+
+    Returns:
+        Dict: The page model, or None if the page doesn't have one.
+    """
+    text = content.decode("utf-8", errors="replace")
+    match = PAGE_MODEL_REGEX.search(text)
+    if match is None:
+        return None
+
+    try:
+        model, _ = JSON_DECODER.raw_decode(text, match.end())
+    except json.JSONDecodeError:
+        return None
+
+    return model if isinstance(model, dict) else None
+
+
+def parse_page_model(model: Dict) -> Optional[Dict]:
+    """
+    Get the floorplan URLs and summary text from the page model of a property page.
+
+    Args:
+        model (Dict): The output of get_page_model.
+
+    Returns:
+        Dict: The same output as parse_property_page, or None if the page model has no property data.
+    """
+    property_data = model.get("propertyData")
+    if not isinstance(property_data, dict):
+        return None
+
+    floorplans = [
+        original_image_url(floorplan["url"])
+        for floorplan in property_data.get("floorplans") or []
+        if floorplan.get("url")
+    ]
+    key_features = [feature.strip() for feature in property_data.get("keyFeatures") or [] if feature.strip()]
+    description = html_to_text((property_data.get("text") or {}).get("description") or "")
+    sizings = [sizing for sizing in property_data.get("sizings") or [] if isinstance(sizing, dict)]
+
+    return {"floorplans": floorplans, "summary": make_summary(key_features, description), "sizings": sizings}
+
+
+def parse_html(content: bytes) -> Dict:
+    """
+    Get the floorplan URLs and summary text from the rendered HTML of a property page, used when the page model is
+    missing.
+
+    Args:
+        content (bytes): The HTML of the property page.
+
+    Returns:
+        Dict: The same output as parse_property_page.
+    """
+    empty = {"floorplans": [], "summary": "", "sizings": []}
+    if not content.strip():
+        return empty
+    try:
+        tree = lxml.html.fromstring(content)
+    except lxml.etree.ParserError:
+        # e.g. a page with only comments or processing instructions is an empty document too:
+        return empty
+
+    floorplans = [original_image_url(src) for src in tree.xpath("//img/@src") if FLOORPAN_REGEX.search(src)]
+
+    def stripped_strings(tag: str, class_name: str) -> List[str]:
+        elements = tree.xpath(f"(//{tag}[contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')])[1]")
+        if not elements:
+            return []
+        return [text.strip() for text in elements[0].itertext() if text.strip()]
+
+    key_features = stripped_strings("ul", KEY_FEATURES_CLASS)
+    description = "\n".join(stripped_strings("div", DESCRIPTION_CLASS))
+
+    return {"floorplans": floorplans, "summary": make_summary(key_features, description), "sizings": []}
+
+
+def parse_property_page(content: bytes) -> Dict:
+    """
+    Get the floorplan URLs and summary text from a Rightmove property page, from the embedded page model if there is
+    one, otherwise from the rendered HTML.
+
+    Args:
+        content (bytes): The HTML of the property page.
+
+    Returns:
+        Dict: A dictionary with a list of floorplan URLs under "floorplans", the summary text under "summary" and the
+            structured sizes of the property under "sizings" (e.g. {"unit": "sqft", "minimumSize": 850,
+            "maximumSize": 850}), which are only available from the page model.
+    """
+    model = get_page_model(content)
+    if model is not None:
+        data = parse_page_model(model)
+        if data is not None:
+            return data
+
+    return parse_html(content)
@@ -2,35 +2,38 @@ import asyncio
 
 from rightmove.api_wrapper import Rightmove
 from rightmove.async_database import RightmoveDatabase
+from rightmove.database import refresh_alert_properties
 from rightmove.search_algorithm import RightmoveSearcher
 
 
 async def download_properties(channel):
     # Initialise objects
-    database = RightmoveDatabase()
-    async with Rightmove(database=database) as rightmove_api:
-        searcher = RightmoveSearcher(rightmove_api=rightmove_api, database=database)
-        task = searcher.get_all_properties(
-            region_search="LONDON",
-            lat1=51.313447,
-            lat2=51.720223,
-            lon1=-0.5245971,
-            lon2=0.36117554,
-            channel=channel,
-            exclude=["newHome", "sharedOwnership", "retirement"],
-            include=["garden"],
-            load_sql=True,
-        )
-        await task
-
-        while True:
-            await asyncio.gather(*asyncio.all_tasks() - {asyncio.current_task()})
-            if len(asyncio.all_tasks()) == 1:
-                break
-            await asyncio.sleep(1)
-
-        searcher.progress.close()
-        await searcher.rm.save_property_data(channel)
+    async with RightmoveDatabase() as database:
+        async with Rightmove(database=database) as rightmove_api:
+            searcher = RightmoveSearcher(rightmove_api=rightmove_api, database=database)
+            task = searcher.get_all_properties(
+                region_search="LONDON",
+                lat1=51.313447,
+                lat2=51.720223,
+                lon1=-0.5245971,
+                lon2=0.36117554,
+                channel=channel,
+                exclude=["newHome", "sharedOwnership", "retirement"],
+                include=["garden"],
+                load_sql=True,
+            )
+            await task
+
+            while True:
+                await asyncio.gather(*asyncio.all_tasks() - {asyncio.current_task()})
+                if len(asyncio.all_tasks()) == 1:
+                    break
+                await asyncio.sleep(1)
+
+            searcher.progress.close()
+            await searcher.rm.save_property_data(channel)
+
+    refresh_alert_properties()
 
 
 async def download_property_data(update, cutoff=None):
@@ -46,3 +49,5 @@ async def download_property_data(update, cutoff=None):
                 if len(asyncio.all_tasks()) == 1:
                     break
                 await asyncio.sleep(1)
+
+    refresh_alert_properties()
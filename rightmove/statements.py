@@ -0,0 +1,440 @@
+import re
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, NamedTuple
+
+import pandas as pd
+
+PARAMETER_REGEX = re.compile(r"\$(\d+)")
+
+
+class Statement(NamedTuple):
+    """
+    A named, parameterised SQL statement, with asyncpg style $1, $2, ... parameters. Sets of IDs are passed as a
+    single array parameter (= ANY($1::int[])), so the text of a statement never depends on its arguments.
+    """
+
+    name: str
+    sql: str
+
+    @property
+    def parameter_count(self) -> int:
+        return max((int(n) for n in PARAMETER_REGEX.findall(self.sql)), default=0)
+
+    @property
+    def execute_sql(self) -> str:
+        """
+        The EXECUTE of the statement once it's prepared on a psycopg2 connection, with %s placeholders.
+        """
+        if self.parameter_count == 0:
+            return f"EXECUTE {self.name}"
+        return f"EXECUTE {self.name} ({', '.join(['%s'] * self.parameter_count)})"
+
+
+class StatementStats:
+    """
+    Number of calls and latency of a statement in this process.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.calls += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+
+STATEMENTS: Dict[str, Statement] = {}
+STATS: Dict[str, StatementStats] = {}
+_stats_lock = threading.Lock()
+
+# Names of the statements prepared on each psycopg2 connection, prepared statements last as long as the connection:
+_prepared: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+
+def statement(name: str, sql: str) -> Statement:
+    """
+    Add a statement to the catalogue.
+
+    Args:
+        name (str): Unique name of the statement, which is also its prepared statement name.
+        sql (str): The SQL, with $1, $2, ... parameters.
+
+    Returns:
+        Statement: The statement.
+    """
+    if name in STATEMENTS:
+        raise ValueError(f"Duplicate statement name: {name}")
+
+    STATEMENTS[name] = Statement(name, sql)
+    STATS[name] = StatementStats()
+    return STATEMENTS[name]
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """
+    Record a call of a statement and its latency, for statements which aren't run through execute, fetch etc. (e.g.
+    a COPY, which is recorded under its own name if it isn't in the catalogue).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _stats_lock:
+            STATS.setdefault(name, StatementStats()).record(elapsed)
+
+
+def prepare(cursor, name: str) -> Statement:
+    """
+    Prepare a statement on the connection of a psycopg2 cursor, unless it's already prepared on that connection.
+
+    Args:
+        cursor: The psycopg2 cursor.
+        name (str): The name of the statement.
+
+    Returns:
+        Statement: The statement.
+    """
+    stmt = STATEMENTS[name]
+    with _prepared_lock:
+        prepared = _prepared.setdefault(cursor.connection, set())
+        is_prepared = name in prepared
+
+    if not is_prepared:
+        cursor.execute(f"PREPARE {name} AS {stmt.sql}")
+        with _prepared_lock:
+            prepared.add(name)
+
+    return stmt
+
+
+def execute(cursor, name: str, *args):
+    """
+    Execute a statement with a psycopg2 cursor, preparing it on the cursor's connection the first time.
+
+    Args:
+        cursor: The psycopg2 cursor.
+        name (str): The name of the statement.
+        *args: The statement arguments, in parameter order.
+
+    Returns:
+        The cursor, to fetch the results from.
+    """
+    stmt = prepare(cursor, name)
+    with timed(name):
+        cursor.execute(stmt.execute_sql, args)
+    return cursor
+
+
+async def fetch(conn, name: str, *args) -> List:
+    """
+    Fetch the rows of a statement with an asyncpg connection or pool, which prepares the statement once per
+    connection and keeps it in its statement cache.
+    """
+    with timed(name):
+        return await conn.fetch(STATEMENTS[name].sql, *args)
+
+
+async def fetchval(conn, name: str, *args):
+    """
+    Fetch the first value of a statement with an asyncpg connection or pool.
+    """
+    with timed(name):
+        return await conn.fetchval(STATEMENTS[name].sql, *args)
+
+
+async def execute_async(conn, name: str, *args) -> str:
+    """
+    Execute a statement with an asyncpg connection or pool.
+    """
+    with timed(name):
+        return await conn.execute(STATEMENTS[name].sql, *args)
+
+
+def statement_stats() -> pd.DataFrame:
+    """
+    Call counts and latency of the statements which have been called in this process.
+
+    Returns:
+        pd.DataFrame: calls, total_ms, mean_ms and max_ms by statement name, in descending order of total time.
+    """
+    with _stats_lock:
+        rows = [
+            (name, stats.calls, stats.total_seconds * 1000, stats.max_seconds * 1000)
+            for name, stats in STATS.items()
+            if stats.calls
+        ]
+
+    df = pd.DataFrame(rows, columns=["statement", "calls", "total_ms", "max_ms"]).set_index("statement")
+    df.insert(2, "mean_ms", df["total_ms"] / df["calls"])
+    return df.sort_values("total_ms", ascending=False).round(2)
+
+
+def reset_statement_stats() -> None:
+    with _stats_lock:
+        for name in STATS:
+            STATS[name] = StatementStats()
+
+
+# Pipeline: IDs which need data from the searchByIds API (see RightmoveDatabase.get_id_list)
+ID_LIST_SQL = """
+    SELECT DISTINCT pl.property_id
+    FROM property_location pl
+    LEFT JOIN property_data pd ON pl.property_id = pd.property_id
+    WHERE pl.property_channel = $1
+"""
+NEW_IDS_FILTER = "AND pd.property_id IS NULL"
+OUTDATED_IDS_FILTER = """
+    AND (
+        (pd.last_update < $2 OR pd.last_update IS NULL)
+        AND pd.property_validto = '9999-12-31'
+        OR pd.property_id IS NULL
+    )
+"""
+
+for _name, _sql in {
+    "all_property_ids": ID_LIST_SQL,
+    "new_property_ids": f"{ID_LIST_SQL} {NEW_IDS_FILTER}",
+    "outdated_property_ids": f"{ID_LIST_SQL} {OUTDATED_IDS_FILTER}",
+}.items():
+    statement(_name, _sql)
+    statement(f"count_{_name}", f"SELECT COUNT(*) FROM ({_sql}) AS ids")
+
+statement(
+    "insert_locations",
+    """
+    INSERT INTO property_location (
+        property_id,
+        property_asatdt,
+        property_channel,
+        property_latitude,
+        property_longitude
+    )
+    SELECT property_id, $4, $5, latitude, longitude
+    FROM UNNEST($1::int[], $2::float8[], $3::float8[]) AS l (property_id, latitude, longitude)
+    ON CONFLICT (property_id) DO NOTHING
+    """,
+)
+
+statement(
+    "current_property_data",
+    """
+    SELECT * FROM property_data
+    WHERE property_id = ANY($1::int[]) AND property_validto = '9999-12-31'
+    """,
+)
+
+statement(
+    "close_property_data",
+    """
+    UPDATE property_data
+    SET property_validto = $2
+    WHERE property_id = ANY($1::int[]) AND property_validto = '9999-12-31'
+    """,
+)
+
+statement(
+    "insert_property_images",
+    """
+    INSERT INTO property_images (property_id, image_url, image_caption)
+    SELECT * FROM UNNEST($1::int[], $2::varchar[], $3::varchar[])
+    ON CONFLICT (property_id, image_url) DO NOTHING
+    """,
+)
+
+statement(
+    "insert_price_history",
+    """
+    INSERT INTO price_history (property_id, ts, price_amount, price_qualifier)
+    SELECT * FROM UNNEST($1::int[], $2::timestamp[], $3::float8[], $4::varchar[])
+    ON CONFLICT (property_id, ts) DO NOTHING
+    """,
+)
+
+# Price history
+statement(
+    "reduced_properties",
+    """
+    SELECT
+        property_id,
+        ts,
+        previous_price,
+        price_amount AS price,
+        previous_price - price_amount AS reduction
+    FROM (
+        SELECT
+            property_id,
+            ts,
+            price_amount,
+            LAG(price_amount) OVER (PARTITION BY property_id ORDER BY ts) AS previous_price
+        FROM price_history
+        WHERE property_id IN (SELECT property_id FROM price_history WHERE ts >= now() - $1::int * INTERVAL '1 day')
+    ) AS changes
+    WHERE ts >= now() - $1::int * INTERVAL '1 day'
+      AND price_amount < previous_price
+    ORDER BY ts DESC
+    """,
+)
+statement(
+    "price_trajectories",
+    """
+    SELECT property_id, ts, price_amount, price_qualifier
+    FROM price_history
+    WHERE property_id = ANY($1::int[])
+    ORDER BY property_id, ts
+    """,
+)
+
+# Geolocation
+ALERT_LOCATIONS_SQL = """
+    SELECT property_id::int4, latitude::float8, longitude::float8
+    FROM alert_properties
+    WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+"""
+statement("unreviewed_alert_locations", f"{ALERT_LOCATIONS_SQL} AND travel_reviewed = 0")
+statement("alert_locations", f"{ALERT_LOCATIONS_SQL} AND property_id = ANY($1::int[])")
+
+statement(
+    "insert_destinations",
+    """
+    INSERT INTO commute_destinations (destination_name)
+    SELECT UNNEST($1::varchar[])
+    ON CONFLICT (destination_name) DO UPDATE SET active = TRUE WHERE NOT commute_destinations.active
+    """,
+)
+statement(
+    "deactivate_destinations",
+    """
+    WITH deactivated AS (
+        UPDATE commute_destinations SET active = FALSE
+        WHERE active AND destination_name <> ALL($1::varchar[])
+        RETURNING destination_id
+    )
+    DELETE FROM travel_time_matrix WHERE destination_id IN (SELECT destination_id FROM deactivated)
+    """,
+)
+statement(
+    "destination_ids",
+    "SELECT destination_name, destination_id FROM commute_destinations WHERE destination_name = ANY($1::varchar[])",
+)
+
+# Enhancement queue
+statement(
+    "enqueue_enhancement_ids",
+    """
+    INSERT INTO enhancement_queue (property_id)
+    SELECT UNNEST($1::int[])
+    ON CONFLICT (property_id) DO UPDATE
+    SET status = 'pending', attempts = 0, next_attempt = now(), locked_at = NULL, last_error = NULL
+    WHERE enhancement_queue.status <> 'in_progress'
+    """,
+)
+statement(
+    "enqueue_enhancement_alerts",
+    """
+    INSERT INTO enhancement_queue (property_id)
+    SELECT DISTINCT ap.property_id
+    FROM alert_properties ap
+    LEFT JOIN property_floorplan pf using (property_id)
+    WHERE pf.property_id IS NULL and ap.area is null
+    ON CONFLICT (property_id) DO NOTHING
+    """,
+)
+statement(
+    "claim_enhancements",
+    """
+    UPDATE enhancement_queue q
+    SET status = 'in_progress', locked_at = now(), attempts = q.attempts + 1
+    FROM (
+        SELECT property_id
+        FROM enhancement_queue
+        WHERE ((status IN ('pending', 'failed') AND next_attempt <= now())
+               OR (status = 'in_progress' AND locked_at < now() - $4::interval))
+          AND attempts < $3::int
+          AND ($2::int[] IS NULL OR property_id = ANY($2::int[]))
+        ORDER BY next_attempt
+        LIMIT $1::int
+        FOR UPDATE SKIP LOCKED
+    ) claimed
+    WHERE q.property_id = claimed.property_id
+    RETURNING q.property_id
+    """,
+)
+statement(
+    "complete_enhancements",
+    """
+    UPDATE enhancement_queue
+    SET status = 'done', locked_at = NULL, last_error = NULL
+    WHERE property_id = ANY($1::int[])
+    """,
+)
+statement(
+    "fail_enhancements",
+    """
+    UPDATE enhancement_queue q
+    SET status = 'failed',
+        locked_at = NULL,
+        last_error = LEFT(e.error, 1000),
+        next_attempt = now() + LEAST($3::interval * POWER(2, q.attempts - 1), $4::interval)
+    FROM UNNEST($1::int[], $2::varchar[]) AS e (property_id, error)
+    WHERE q.property_id = e.property_id
+    """,
+)
+
+# Alerts and reviews
+statement("refresh_alert_properties", "SELECT refresh_alert_properties()")
+statement(
+    "new_property_count",
+    "SELECT COALESCE(SUM(properties), 0)::int FROM alert_new_counts WHERE last_update > alert_window_start()",
+)
+statement("unreviewed_property_ids", "SELECT DISTINCT property_id FROM alert_properties WHERE property_reviewed = 0")
+statement("last_review_id", "SELECT COALESCE(MAX(email_id), 0) FROM review_dates")
+statement("property_reviews", "SELECT DISTINCT email_id, str_date FROM review_dates ORDER BY email_id DESC")
+statement(
+    "delete_reviewed_properties",
+    """
+    DELETE FROM reviewed_properties
+    WHERE reviewed_date IN (SELECT reviewed_date FROM review_dates WHERE email_id = $1::int)
+    """,
+)
+statement("delete_review", "DELETE FROM review_dates WHERE email_id = $1::int")
+
+# Alert properties formatted for the web view and the email, see database.iter_properties:
+ALERT_PROPERTIES_SQL = """
+    SELECT
+        'https://www.rightmove.co.uk/properties/' || property_id AS link,
+        property_description AS title,
+        address,
+        'Last update ' || last_update AS status,
+        summary AS description,
+        CASE WHEN garden = 'private' THEN 'Private' ELSE 'Unknown' END AS garden,
+        CASE WHEN COALESCE(area, 0) = 0 THEN 'Unavailable' ELSE TO_CHAR(area, 'FM999,999,990') || ' ft²' END AS area,
+        '£' || TO_CHAR(price_amount, 'FM999,999,999,990') AS price,
+        COALESCE('About ' || travel_time || ' minutes', 'Travel time unavailable') AS travel_time,
+        longitude,
+        latitude,
+        COALESCE(
+            (
+                SELECT JSON_AGG(
+                    JSON_BUILD_OBJECT('url', REPLACE(url, '171x162', '476x317'), 'alt', 'Property') ORDER BY n
+                )
+                FROM UNNEST(images[1:2]) WITH ORDINALITY AS i (url, n)
+            ),
+            '[]'
+        ) AS images
+    FROM alert_properties
+"""
+statement("new_alert_properties", f"{ALERT_PROPERTIES_SQL} WHERE review_id IS NULL")
+statement("reviewed_alert_properties", f"{ALERT_PROPERTIES_SQL} WHERE review_id = $1::int")
+
+# Settings
+statement("email_addresses", "SELECT email_address FROM email_details")
+statement("delete_email_addresses", "DELETE FROM email_details")
@@ -1,3 +1,6 @@
+import asyncio
+import time
+
 USER_AGENTS = [
     (
         "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML,"
@@ -85,3 +88,24 @@ USER_AGENTS = [
     ),
     "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:49.0) Gecko/20100101 Firefox/49.0",
 ]
+
+
+class AsyncRateLimiter:
+    """
+    Limits the rate of requests made by any number of coroutines sharing the limiter to a maximum number of
+    requests per second, spacing requests evenly.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_time = 0.0
+
+    async def acquire(self) -> None:
+        """
+        Wait until the next request is allowed.
+        """
+        now = time.monotonic()
+        wait = self.next_time - now
+        self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
@@ -1,48 +1,211 @@
+"""
+Builds the travel time isochrones used by rightmove.geolocation, using the TravelTime time-map API.
+
+Each destination in DESTINATIONS gets an isochrone for every band (in minutes), written to
+shapes/destinations/<name>/isochrones.npz. API responses are cached on disk so only missing bands are requested:
+
+    python -m shapes.get_shapes --bands 10 20 30 40
+"""
+
+import argparse
 import asyncio
 import datetime as dt
+import hashlib
 import json
+import logging
 import os
-from typing import Tuple
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import httpx
 
-from traveltimepy import Coordinates, PublicTransport, TravelTimeSdk
-from traveltimepy.dto.responses.time_map import TimeMapResult
+from config import BASE_DIR, DATA
+from config.logging import logging_setup
+from rightmove.geolocation import COMPILED_SHAPES_FILE, SHAPES_DIR, write_compiled_shapes
 
-from config import DATA
+logger = logging.getLogger(__name__)
+logger = logging_setup(logger)
 
-LAT = 51.5038879
-LON = -0.0182073
-ARRIVAL_TIME = dt.datetime(2023, 9, 25, 7, 30, 0)
+API_URL = "https://api.traveltimeapp.com/v4/time-map"
+CACHE_DIR = Path(BASE_DIR, "shapes", "cache")
 
-with open(os.path.join(DATA, "secrets.json"), "r") as f:
-    secrets = json.load(f)
-    sdk = TravelTimeSdk(**secrets.get("traveltimepy"))
+# Each destination gets its own set of isochrones in destinations/<name>/:
+DESTINATIONS = {
+    "canary_wharf": (51.5038879, -0.0182073),
+}
+DEPARTURE_TIME = dt.datetime(2023, 9, 25, 7, 30, 0, tzinfo=dt.timezone.utc)
+TRANSPORTATION = "public_transport"
+DEFAULT_BANDS = [10, 20, 30, 40]
+MAX_CONCURRENCY = 4
 
 
-async def get_results(minutes: int) -> Tuple[int, TimeMapResult]:
+def load_credentials() -> Dict[str, str]:
     """
-    This function returns the results of a time map request.
+    Load the TravelTime app_id and api_key from the secrets file.
     """
-    seconds = minutes * 60
-    results = await sdk.time_map_async(
-        coordinates=[Coordinates(lat=LAT, lng=LON)],
-        departure_time=ARRIVAL_TIME,
-        travel_time=seconds,
-        transportation=PublicTransport(type="public_transport"),
-    )
-    return minutes, results[0]
+    with open(os.path.join(DATA, "secrets.json"), "r") as f:
+        secrets = json.load(f)
+
+    return secrets.get("traveltimepy")
+
+
+class IsochroneBuilder:
+    def __init__(
+        self,
+        app_id: str,
+        api_key: str,
+        api_url: str = API_URL,
+        cache_dir: Path = CACHE_DIR,
+        max_concurrency: int = MAX_CONCURRENCY,
+        departure_time: dt.datetime = DEPARTURE_TIME,
+        transportation: str = TRANSPORTATION,
+        transport: httpx.AsyncBaseTransport = None,
+    ):
+        """
+        Args:
+            app_id (str): TravelTime application ID
+            api_key (str): TravelTime API key
+            api_url (str): URL of the time-map endpoint, this can point at a local stub for testing
+            cache_dir (Path): directory of cached API responses
+            max_concurrency (int): maximum number of requests in flight at once
+            departure_time (dt.datetime): departure time used for every isochrone
+            transportation (str): TravelTime transportation type
+            transport (httpx.AsyncBaseTransport): optional httpx transport, e.g. httpx.MockTransport
+        """
+        self.headers = {"X-Application-Id": app_id, "X-Api-Key": api_key}
+        self.api_url = api_url
+        self.cache_dir = Path(cache_dir)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.departure_time = departure_time
+        self.transportation = transportation
+        self.transport = transport
+        self.requests = 0
+
+    async def __aenter__(self):
+        """
+        Asynchronous enter function which assigns the async httpx client
+        """
+        self.client = httpx.AsyncClient(transport=self.transport, timeout=60)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """
+        Asynchronous exit function which closes the async httpx client
+        """
+        await self.client.aclose()
+
+    def cache_path(self, lat: float, lon: float, minutes: int) -> Path:
+        """
+        Path of the cached response for an isochrone, keyed by origin, departure time, mode and minutes.
+        """
+        key = f"{lat:.7f},{lon:.7f}|{self.departure_time.isoformat()}|{self.transportation}|{minutes}"
+        return self.cache_dir / f"{hashlib.sha1(key.encode()).hexdigest()}.json"
+
+    async def get_isochrone(self, lat: float, lon: float, minutes: int) -> List[dict]:
+        """
+        Get the shapes of an isochrone, from the cache if it has already been requested.
+
+        Args:
+            lat (float): latitude of the origin
+            lon (float): longitude of the origin
+            minutes (int): travel time in minutes
+
+        Returns:
+            List[dict]: the shapes of the isochrone, each with a "shell" and "holes"
+        """
+        cache_path = self.cache_path(lat, lon, minutes)
+        if cache_path.exists():
+            with open(cache_path) as f:
+                return json.load(f)["shapes"]
 
+        body = {
+            "departure_searches": [{
+                "id": f"{minutes}m",
+                "coords": {"lat": lat, "lng": lon},
+                "departure_time": self.departure_time.isoformat(),
+                "travel_time": minutes * 60,
+                "transportation": {"type": self.transportation},
+            }]
+        }
 
-async def main():
+        async with self.semaphore:
+            r = await self.client.post(self.api_url, json=body, headers=self.headers)
+            self.requests += 1
+
+        r.raise_for_status()
+        result = r.json()["results"][0]
+
+        # Write to a temporary file first so an interrupted run never leaves a partial cache entry:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(result, f)
+        os.replace(tmp_path, cache_path)
+
+        return result["shapes"]
+
+    async def build(self, destination: str, lat: float, lon: float, bands: List[int], shapes_dir: Path) -> Path:
+        """
+        Build the compiled isochrone set of a destination.
+
+        Args:
+            destination (str): name of the destination
+            lat (float): latitude of the destination
+            lon (float): longitude of the destination
+            bands (List[int]): travel time bands in minutes
+            shapes_dir (Path): the shapes directory
+
+        Returns:
+            Path: path of the compiled shapes file
+        """
+        results = await asyncio.gather(*[self.get_isochrone(lat, lon, minutes) for minutes in bands])
+
+        filepath = Path(shapes_dir, "destinations", destination, COMPILED_SHAPES_FILE)
+        write_compiled_shapes(filepath, dict(zip(bands, results)))
+        logger.info(f"Saved {len(bands)} isochrones for {destination} to {filepath}")
+
+        return filepath
+
+
+async def build_isochrones(
+    bands: List[int] = None,
+    destinations: Dict[str, Tuple[float, float]] = None,
+    shapes_dir: Path = SHAPES_DIR,
+    **builder_args,
+) -> List[Path]:
     """
-    This example shows how to use the SDK asynchronously.
+    Build the compiled isochrone sets of every destination concurrently.
+
+    Args:
+        bands (List[int]): travel time bands in minutes, defaults to DEFAULT_BANDS
+        destinations (Dict[str, Tuple[float, float]]): latitude and longitude of each destination by name, defaults
+            to DESTINATIONS
+        shapes_dir (Path): the shapes directory
+        **builder_args: arguments passed to IsochroneBuilder, app_id and api_key are loaded from the secrets file
+            if not given
+
+    Returns:
+        List[Path]: paths of the compiled shapes files
     """
+    bands = sorted(set(bands or DEFAULT_BANDS))
+    destinations = destinations or DESTINATIONS
+    if "app_id" not in builder_args:
+        builder_args.update(load_credentials())
+
+    async with IsochroneBuilder(**builder_args) as builder:
+        paths = await asyncio.gather(*[
+            builder.build(name, lat, lon, bands, shapes_dir) for name, (lat, lon) in destinations.items()
+        ])
+        logger.info(f"Made {builder.requests} TravelTime requests")
 
-    results = await asyncio.gather(*[get_results(m) for m in range(1, 5, 1)])
+    return paths
 
-    for minutes, result in results:
-        with open(f"sub_{minutes}m.json", "w") as f:
-            data = json.loads(result.json())
-            json.dump(data, f, indent=4)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build travel time isochrones for each destination.")
+    parser.add_argument("--bands", type=int, nargs="+", default=DEFAULT_BANDS, help="Travel time bands in minutes")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY)
+    parser.add_argument("--api-url", default=API_URL)
+    args = parser.parse_args()
 
-asyncio.run(main())
+    asyncio.run(build_isochrones(bands=args.bands, max_concurrency=args.max_concurrency, api_url=args.api_url))
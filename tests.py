@@ -1,7 +1,37 @@
 import asyncio
+import datetime as dt
+import json
+import re
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
 
+import httpx
+import pandas as pd
+import psycopg2
+
+from config import DATABASE_URI
+from rightmove import statements
 from rightmove.api_wrapper import Rightmove
-from rightmove.database import RightmoveDatabase
+from rightmove.archive import archive_history, create_history_partitions, get_history_partitions, read_archive
+from rightmove.database import (
+    ConnectionPool,
+    RightmoveDatabase,
+    claim_enhancement_properties,
+    enqueue_enhancement_properties,
+    get_database_connection,
+    get_new_property_count,
+    get_price_trajectories,
+    get_reduced_properties,
+)
+from rightmove.description import SummaryCache, SummaryClassifier, classify_gardens
+from rightmove.enhancements import EnhancementPipeline, EnhancementResult
+from rightmove.floorplan import extract_internal_areas
+from rightmove.geolocation import COMMUTE_PREFIX, compile_shapes, save_locations
+from rightmove.models import PropertyFloorplan
+from rightmove.property_page import parse_property_page
+from shapes.get_shapes import build_isochrones
 
 
 async def test_get_region():
@@ -37,16 +67,438 @@ async def test_get_property_data():
 
 
 def test_database():
-    database = RightmoveDatabase()
+    data = {00000000: {"id": 00000000, "location": {"latitude": 51.0000, "longitude": 0.0000}}}
 
-    data = {
-        "properties": [
-            {"id": 00000000, "location": {"latitude": 51.0000, "longitude": 0.0000}}
-        ]
+    with RightmoveDatabase() as database:
+        database.load_map_properties(properties=data, channel="BUY")
+        assert any(00000000 in ids for ids in database.get_id_list(update=False, channel="BUY"))
+    print("Test 'test_database' passed.")
+
+
+def make_property(property_id: int, price: float) -> dict:
+    # A property in the format of the searchByIds endpoint:
+    return {
+        "id": property_id,
+        "bedrooms": 2,
+        "bathrooms": 1,
+        "displaySize": "850 sq. ft.",
+        "summary": "Flat with a private garden",
+        "displayAddress": "1 Test Road",
+        "propertySubType": "Flat",
+        "propertyTypeFullDescription": "2 bedroom flat for sale",
+        "premiumListing": False,
+        "price": {"amount": price, "frequency": "not specified", "displayPrices": [{"displayPriceQualifier": ""}]},
+        "customer": {"brandTradingName": "Agent", "branchName": "Branch"},
+        "development": False,
+        "commercial": False,
+        "enhancedListing": False,
+        "students": False,
+        "auction": False,
+        "firstVisibleDate": "2024-01-01T10:00:00Z",
+        "addedOrReduced": "Added on 01/01/2024",
+        "propertyImages": {"images": [{"srcUrl": f"https://example.com/{property_id}.jpeg", "caption": None}]},
     }
-    database.load_map_properties(properties=data, channel="BUY")
 
 
+def test_price_history():
+    data = {99999999: {"id": 99999999, "location": {"latitude": 51.0000, "longitude": 0.0000}}}
+
+    with RightmoveDatabase() as database:
+        database.load_map_properties(properties=data, channel="BUY")
+        database.load_property_data([make_property(99999999, 700000)])
+        database.load_property_data([make_property(99999999, 650000)])
+
+    reductions = get_reduced_properties(1)
+    reduction = reductions[reductions["property_id"] == 99999999].iloc[0]
+    assert (reduction["previous_price"], reduction["price"], reduction["reduction"]) == (700000, 650000, 50000)
+
+    prices = get_price_trajectories([99999999])[99999999]
+    assert list(prices["price_amount"].tail(2)) == [700000, 650000]
+    assert prices["ts"].is_monotonic_increasing
+    print("Test 'test_price_history' passed.")
+
+
+def test_history_partitions():
+    def partition(cursor) -> str:
+        cursor.execute(
+            """
+            SELECT tableoid::regclass::text FROM property_data
+            WHERE property_id = %s AND property_validto < '9999-12-31'
+            """,
+            (99999998,),
+        )
+        return cursor.fetchone()[0]
+
+    data = {99999998: {"id": 99999998, "location": {"latitude": 51.0000, "longitude": 0.0000}}}
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM property_data WHERE property_id = %s", (99999998,))
+
+    # A row closed by a new version goes to the partition of the month it was closed, not the default partition:
+    create_history_partitions()
+    with RightmoveDatabase() as database:
+        database.load_map_properties(properties=data, channel="BUY")
+        database.load_property_data([make_property(99999998, 700000)])
+        database.load_property_data([make_property(99999998, 650000)])
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            assert partition(cursor) == f"property_data_{dt.datetime.now():%Y_%m}"
+
+            # Rows closed in a month without a partition are in the default partition until it's created:
+            cursor.execute(
+                """
+                UPDATE property_data SET property_validfrom = '2000-01-01', property_validto = '2000-01-15'
+                WHERE property_id = %s AND property_validto < '9999-12-31'
+                """,
+                (99999998,),
+            )
+            assert partition(cursor) == "property_data_history"
+    create_history_partitions()
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            assert partition(cursor) == "property_data_2000_01"
+
+    # Only January 2000 is past retention, so no real history is archived:
+    retention_days = (dt.datetime.now() - dt.datetime(2000, 2, 1)).days
+    with tempfile.TemporaryDirectory() as tmp:
+        files = archive_history(retention_days=retention_days, directory=tmp)
+        assert files == [str(Path(tmp, "property_data_2000_01.parquet"))]
+        archive = read_archive(tmp)
+        assert list(archive["property_id"]) == [99999998] and list(archive["price_amount"]) == [700000]
+
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            assert dt.datetime(2000, 1, 1) not in get_history_partitions(cursor)
+            cursor.execute("SELECT to_regclass('property_data_2000_01')")
+            assert cursor.fetchone()[0] is None
+    print("Test 'test_history_partitions' passed.")
+
+
+def test_commute_destinations():
+    def commute_summary(cursor) -> tuple:
+        cursor.execute(
+            "SELECT max_travel_time, sum_travel_time FROM commute_summary WHERE property_id = %s", (99999997,)
+        )
+        return cursor.fetchone()
+
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT destination_name FROM commute_destinations WHERE active")
+            current = [row[0] for row in cursor.fetchall()]
+
+    def locations(commutes: dict) -> pd.DataFrame:
+        df = pd.DataFrame({"property_id": [99999997], "travel_time": [max(commutes.values())], "excluded": [False]})
+        for name in current:
+            df[f"{COMMUTE_PREFIX}{name}"] = 0
+        for name, travel_time in commutes.items():
+            df[f"{COMMUTE_PREFIX}{name}"] = travel_time
+        return df
+
+    save_locations(locations({"test_a": 30, "test_b": 50}))
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            assert commute_summary(cursor) == (50, 80)
+
+    # A destination which is no longer classified doesn't count towards the summary, and its travel times are deleted:
+    save_locations(locations({"test_a": 40}))
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            assert commute_summary(cursor) == (40, 40)
+            cursor.execute(
+                """
+                SELECT COUNT(*) FROM travel_time_matrix m JOIN commute_destinations d USING (destination_id)
+                WHERE d.destination_name = 'test_b'
+                """
+            )
+            assert cursor.fetchone()[0] == 0
+
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            statements.execute(cursor, "deactivate_destinations", current)
+    print("Test 'test_commute_destinations' passed.")
+
+
+async def test_build_isochrones():
+    requests = []
+
+    def stub_time_map(request: httpx.Request) -> httpx.Response:
+        search = json.loads(request.content)["departure_searches"][0]
+        requests.append(search["travel_time"])
+        size = search["travel_time"] / 60 / 1000
+        lat, lng = search["coords"]["lat"], search["coords"]["lng"]
+        shell = [
+            {"lat": lat - size, "lng": lng - size},
+            {"lat": lat - size, "lng": lng + size},
+            {"lat": lat + size, "lng": lng + size},
+            {"lat": lat + size, "lng": lng - size},
+        ]
+        return httpx.Response(200, json={"results": [{"search_id": search["id"], "shapes": [{"shell": shell, "holes": []}]}]})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        args = dict(
+            destinations={"a": (51.5, 0.0), "b": (51.4, -0.1)},
+            shapes_dir=Path(tmp),
+            cache_dir=Path(tmp, "cache"),
+            app_id="id",
+            api_key="key",
+            transport=httpx.MockTransport(stub_time_map),
+        )
+        await build_isochrones(bands=[10, 20], **args)
+        assert len(requests) == 4
+
+        # Only the new band should be requested:
+        await build_isochrones(bands=[10, 20, 30], **args)
+        assert len(requests) == 6
+
+        shapes = compile_shapes(Path(tmp))
+        assert shapes.names == ("a", "b")
+        assert list(shapes.bands) == [10, 20, 30, 10, 20, 30]
+        print("Test 'test_build_isochrones' passed.")
+
+
+def test_extract_internal_area():
+    with open(Path(__file__).parent / "benchmarks" / "data" / "ocr_corpus.json") as f:
+        corpus = json.load(f)
+
+    results = extract_internal_areas([item["text"] for item in corpus])
+    for item, result in zip(corpus, results):
+        assert result == item["expected"], f"{item['text']!r}: {result} != {item['expected']}"
+    print("Test 'test_extract_internal_area' passed.")
+
+
+def test_parse_property_page():
+    empty = {"floorplans": [], "summary": "", "sizings": []}
+    for content in (b"", b"   ", b"<!-- -->"):
+        assert parse_property_page(content) == empty, content
+
+    content = b'<html><img src="https://media.rightmove.co.uk/1k/1234/567/1234_FLP_00_0000_max_296x197.png"></html>'
+    assert len(parse_property_page(content)["floorplans"]) == 1
+    print("Test 'test_parse_property_page' passed.")
+
+
+class StubChatCompletions(BaseHTTPRequestHandler):
+    """
+    Local stub of the OpenAI chat completions endpoint, which classifies every summary mentioning a garden as private.
+    """
+
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = body["messages"][-1]["content"]
+        summaries = re.split(r"## SUMMARY \d+:", prompt)[1:]
+        self.requests.append(len(summaries))
+
+        properties = [
+            {"id": i, "garden": "private" if "garden" in summary else "unknown"} for i, summary in enumerate(summaries)
+        ]
+        tool_call = {
+            "id": "call_0",
+            "type": "function",
+            "function": {"name": "property_assessment", "arguments": json.dumps({"properties": properties})},
+        }
+        response = json.dumps({
+            "id": "chatcmpl-0",
+            "object": "chat.completion",
+            "created": 0,
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "finish_reason": "tool_calls",
+                "message": {"role": "assistant", "content": None, "tool_calls": [tool_call]},
+            }],
+        }).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+async def test_summary_classifier():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubChatCompletions)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    summaries = [f"Flat {i} with a private garden" if i % 2 else f"Flat {i}" for i in range(20)]
+    summaries += summaries[:5] + ["", "Flat  1 with a private   garden"]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        args = dict(
+            cache=SummaryCache(Path(tmp, "cache.sqlite")),
+            batch_size=8,
+            rule_cutoff=None,
+            base_url=f"http://127.0.0.1:{server.server_port}/v1",
+            api_key="key",
+        )
+        async with SummaryClassifier(**args) as classifier:
+            results = await classifier.classify(summaries)
+        assert sorted(StubChatCompletions.requests) == [4, 8, 8]
+        assert [r["garden"] for r in results[:4]] == ["unknown", "private", "unknown", "private"]
+        assert results[25] is None and results[26] == results[1]
+
+        # Summaries which have been seen before are never sent again:
+        async with SummaryClassifier(**args) as classifier:
+            assert await classifier.classify(summaries) == results
+        assert len(StubChatCompletions.requests) == 3
+
+        # Only summaries the rules are unsure about are sent to the model:
+        summaries = ["Private rear garden", "Communal gardens", "Juliet balcony", "Near Kew gardens", "Gas central heating"]
+        async with SummaryClassifier(**{**args, "rule_cutoff": 0.8}) as classifier:
+            results = await classifier.classify(summaries)
+        assert [r["garden"] for r in results] == ["private", "communal", "unknown", "private", "unknown"]
+        assert classifier.rule_hits == 3 and StubChatCompletions.requests[3:] == [2]
+
+    server.shutdown()
+    print("Test 'test_summary_classifier' passed.")
+
+
+class StubFailingChatCompletions(BaseHTTPRequestHandler):
+    """
+    Local stub of the OpenAI chat completions endpoint which is always down.
+    """
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(500)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+async def test_classification_failure():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubFailingChatCompletions)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT property_id FROM property_data_hot ORDER BY property_id LIMIT 2")
+            ids = [row[0] for row in cursor.fetchall()]
+    enqueue_enhancement_properties(ids)
+    assert sorted(claim_enhancement_properties(len(ids), ids)) == ids
+
+    with tempfile.TemporaryDirectory() as tmp:
+        classifier = SummaryClassifier(
+            cache=SummaryCache(Path(tmp, "cache.sqlite")),
+            rule_cutoff=None,
+            base_url=f"http://127.0.0.1:{server.server_port}/v1",
+            api_key="key",
+            max_retries=0,
+        )
+        # The first property has a summary which can't be classified, the second has none:
+        summaries = ["Flat with a private garden", ""]
+        async with classifier:
+            gardens = await classifier.classify(summaries)
+        assert gardens == [None, None]
+
+        pipeline = EnhancementPipeline(classifier=classifier)
+        batch = [EnhancementResult(i, PropertyFloorplan(property_id=i), {"summary": s}) for i, s in zip(ids, summaries)]
+        pipeline.insert_batch(batch, summaries, gardens)
+
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT status, last_error FROM enhancement_queue WHERE property_id = ANY(%s) ORDER BY property_id",
+                (ids,),
+            )
+            assert cursor.fetchall() == [("failed", "summary classification failed"), ("done", None)]
+
+    server.shutdown()
+    print("Test 'test_classification_failure' passed.")
+
+
+def test_classify_gardens():
+    results = classify_gardens([
+        "Two bedroom flat with a private rear garden",
+        "Shared rear garden",
+        "Private balcony with views",
+        "Juliet balcony to the lounge",
+        "Gas central heating",
+        "Private garden and communal roof terrace",
+    ])
+    assert list(results["garden"]) == ["private", "communal", "balcony", None, "unknown", None]
+    assert (results["confidence"][results["garden"].isna()] == 0).all()
+    print("Test 'test_classify_gardens' passed.")
+
+
+def test_connection_pool():
+    connection_pool = ConnectionPool(min_connections=1, max_connections=3, timeout=5)
+
+    def query():
+        with connection_pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_sleep(0.05)")
+
+    threads = [threading.Thread(target=query) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    metrics = connection_pool.metrics()
+    assert metrics["checkouts"] == 12 and metrics["in_use"] == 0
+    assert metrics["peak_in_use"] == 3 and metrics["wait_seconds"] > 0
+
+    # A connection which the server closed while it was idle is replaced when it's next borrowed:
+    connection_pool.health_check_after = 0
+    with connection_pool.connection() as conn:
+        pid = conn.get_backend_pid()
+    admin = psycopg2.connect(DATABASE_URI)
+    with admin.cursor() as cursor:
+        cursor.execute("SELECT pg_terminate_backend(%s)", (pid,))
+    admin.close()
+    with connection_pool.connection() as conn:
+        assert conn.get_backend_pid() != pid
+    assert connection_pool.metrics()["health_check_failures"] == 1
+
+    connection_pool.close()
+    print("Test 'test_connection_pool' passed.")
+
+
+def test_statement_catalogue():
+    # Every statement in the catalogue is valid SQL against the current schema:
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            for name in statements.STATEMENTS:
+                statements.prepare(cursor, name)
+
+            statements.reset_statement_stats()
+            for _ in range(3):
+                assert statements.execute(cursor, "new_property_count").fetchone()[0] >= 0
+
+    stats = statements.statement_stats()
+    assert list(stats.index) == ["new_property_count"] and stats.loc["new_property_count", "calls"] == 3
+    print("Test 'test_statement_catalogue' passed.")
+
+
+def test_new_property_count():
+    # The trigger maintained count agrees with the alert_properties view:
+    with get_database_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM alert_properties WHERE review_id IS NULL")
+            count = cursor.fetchone()[0]
+
+    assert get_new_property_count() == count
+    print("Test 'test_new_property_count' passed.")
+
+
+# asyncio.run(test_summary_classifier())
+# asyncio.run(test_classification_failure())
+# test_new_property_count()
+# test_statement_catalogue()
+# test_connection_pool()
+# test_classify_gardens()
+# test_parse_property_page()
+# test_extract_internal_area()
+# test_history_partitions()
+# test_price_history()
+# test_commute_destinations()
+# asyncio.run(test_build_isochrones())
 # asyncio.run(test_get_region())
 # asyncio.run(test_get_properties())
 asyncio.run(test_get_property_data())
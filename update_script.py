@@ -4,16 +4,22 @@ import logging
 from app import count_new_properties
 from config.logging import logging_setup
 from email_data.send_email import prepare_email_html, send_email
+from rightmove.archive import maintain_history
 from rightmove.database import mark_properties_reviewed
 from rightmove.enhancements import update_enhanced_data
 from rightmove.geolocation import update_locations
 from rightmove.run import download_properties, download_property_data
+from rightmove.statements import statement_stats
 
 logger = logging.getLogger(__name__)
 logger = logging_setup(logger)
 
 
 def main():
+    # Partition and archive the property history:
+    logger.info("Archiving property history...")
+    maintain_history()
+
     # Download the latest properties and data:
     logger.info("Downloading properties and data...")
     asyncio.run(download_properties("BUY"))
@@ -48,4 +54,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        logger.info(f"Database statements:\n{statement_stats().to_string()}")
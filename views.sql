@@ -1,101 +1,9 @@
-CREATE TABLE IF NOT EXISTS email_details
-(
-    email_address varchar(100) NOT NULL PRIMARY KEY
-);
-
-CREATE TABLE IF NOT EXISTS property_floorplan
-(
-    property_id   integer NOT NULL PRIMARY KEY,
-    floorplan_url varchar(1000),
-    area_sqft     double precision,
-    area_sqm      double precision
-);
-
-CREATE TABLE IF NOT EXISTS property_summary
-(
-    property_id integer NOT NULL PRIMARY KEY,
-    summary     varchar(10000),
-    garden      varchar(50)
-);
-
-CREATE TABLE IF NOT EXISTS property_location_excluded
-(
-    property_id integer NOT NULL PRIMARY KEY,
-    excluded    boolean
-);
-
-CREATE TABLE IF NOT EXISTS property_data
-(
-    property_id           integer          NOT NULL,
-    property_validfrom    timestamp        NOT NULL,
-    property_validto      timestamp        NOT NULL,
-    bedrooms              integer,
-    bathrooms             integer,
-    area                  double precision,
-    summary               varchar          NOT NULL,
-    address               varchar          NOT NULL,
-    property_subtype      varchar,
-    property_description  varchar          NOT NULL,
-    premium_listing       boolean          NOT NULL,
-    price_amount          double precision NOT NULL,
-    price_frequency       varchar          NOT NULL,
-    price_qualifier       varchar,
-    lettings_agent        varchar          NOT NULL,
-    lettings_agent_branch varchar          NOT NULL,
-    development           boolean          NOT NULL,
-    commercial            boolean          NOT NULL,
-    enhanced_listing      boolean          NOT NULL,
-    students              boolean          NOT NULL,
-    auction               boolean          NOT NULL,
-    first_visible         timestamp,
-    last_update           timestamp,
-    last_displayed_update timestamp,
-    PRIMARY KEY (property_id, property_validfrom)
-);
-
-CREATE TABLE IF NOT EXISTS property_images
-(
-    property_id   integer NOT NULL,
-    image_url     varchar NOT NULL,
-    image_caption varchar,
-    PRIMARY KEY (property_id, image_url)
-);
-
-CREATE TABLE IF NOT EXISTS property_location
-(
-    property_id        serial
-        PRIMARY KEY,
-    property_asatdt    timestamp,
-    property_channel   varchar          NOT NULL,
-    property_longitude double precision NOT NULL,
-    property_latitude  double precision NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS review_dates
-(
-    reviewed_date timestamp NOT NULL
-        PRIMARY KEY,
-    email_id      integer,
-    str_date      varchar
-);
-
-CREATE TABLE IF NOT EXISTS reviewed_properties
-(
-    property_id   serial
-        PRIMARY KEY,
-    reviewed_date timestamp NOT NULL,
-    emailed       boolean   NOT NULL
-);
-
-CREATE TABLE IF NOT EXISTS travel_time_precise
-(
-    property_id serial
-        PRIMARY KEY,
-    travel_time integer
-);
-
+DROP VIEW IF EXISTS commute_summary;
 DROP VIEW IF EXISTS properties_review;
 DROP VIEW IF EXISTS alert_properties;
+DROP VIEW IF EXISTS alert_candidates;
+DROP TABLE IF EXISTS alert_new_counts;
+DROP TABLE IF EXISTS alert_snapshot;
 DROP VIEW IF EXISTS properties_enhanced;
 DROP VIEW IF EXISTS properties_current;
 DROP VIEW IF EXISTS start_date;
@@ -122,7 +30,7 @@ FROM
         LEFT JOIN property_location AS pl USING (property_id)
         FULL JOIN start_date AS sd ON 1 = 1
 WHERE
-    CURRENT_TIMESTAMP BETWEEN pd.property_validfrom AND pd.property_validto;
+    pd.property_validto = '9999-12-31';
 
 
 CREATE VIEW properties_enhanced AS
@@ -144,15 +52,14 @@ SELECT
     ap.latitude,
     r.emailed,
     r.reviewed_date,
-    CASE
-        WHEN r.reviewed_date = (SELECT MAX(reviewed_date) FROM reviewed_properties) THEN 1
-        ELSE 0 END AS latest_reviewed,
     CASE WHEN ap.property_id = r.property_id THEN 1 ELSE 0 END AS property_reviewed,
     CASE WHEN ap.property_id = tp.property_id THEN 1 ELSE 0 END AS travel_reviewed,
     ple.excluded AS location_excluded,
     tp.travel_time,
     rp.email_id AS review_id,
-    (SELECT STRING_AGG(DISTINCT image_url, ',') FROM property_images pi WHERE pi.property_id = ap.property_id) AS images
+    (SELECT ARRAY_AGG(DISTINCT image_url ORDER BY image_url)
+     FROM property_images pi
+     WHERE pi.property_id = ap.property_id) AS images
 FROM
     properties_current ap
         LEFT JOIN travel_time_precise tp USING (property_id)
@@ -165,11 +72,10 @@ WHERE
       NOT ap.development
   AND NOT ap.commercial
   AND NOT ap.auction
-  AND ap.last_rightmove_update > TO_CHAR(CURRENT_DATE - INTERVAL '30 days', 'YYYY-MM-DD')
 ;
 
 
-CREATE VIEW alert_properties AS
+CREATE VIEW alert_candidates AS
 SELECT
     *
 FROM
@@ -189,6 +95,106 @@ WHERE
   AND (garden IN ('private', 'unknown') OR garden IS NULL)
 ;
 
+-- Snapshot of alert_candidates, which is only refreshed for the properties touched since the last refresh (see
+-- refresh_alert_properties), so reading alert properties never has to run the full chain of views:
+CREATE TABLE alert_snapshot AS
+SELECT
+    *
+FROM
+    alert_candidates;
+
+CREATE INDEX alert_snapshot_property_id ON alert_snapshot (property_id);
+TRUNCATE alert_properties_dirty;
+
+-- Start of the 30 day window of alert_properties, as a last_update:
+CREATE OR REPLACE FUNCTION alert_window_start() RETURNS text AS
+$$
+SELECT TO_CHAR(CURRENT_DATE - INTERVAL '30 days', 'YYYY-MM-DD')
+$$ LANGUAGE sql STABLE;
+
+-- Number of new (not reviewed) properties in the snapshot by last_update, kept up to date by the triggers below, so
+-- the new property count is a lookup of the last 30 rows rather than a read of the snapshot:
+CREATE TABLE alert_new_counts
+(
+    last_update text    NOT NULL PRIMARY KEY,
+    properties  integer NOT NULL
+);
+
+INSERT INTO alert_new_counts
+SELECT last_update, COUNT(*)
+FROM alert_snapshot
+WHERE review_id IS NULL AND last_update IS NOT NULL
+GROUP BY last_update;
+
+CREATE OR REPLACE FUNCTION count_new_alert_properties() RETURNS trigger AS
+$$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO alert_new_counts (last_update, properties)
+        SELECT last_update, COUNT(*)
+        FROM changed_rows
+        WHERE review_id IS NULL AND last_update IS NOT NULL
+        GROUP BY last_update
+        ON CONFLICT (last_update) DO UPDATE SET properties = alert_new_counts.properties + EXCLUDED.properties;
+    ELSE
+        UPDATE alert_new_counts c
+        SET properties = c.properties - d.properties
+        FROM (
+            SELECT last_update, COUNT(*) AS properties
+            FROM changed_rows
+            WHERE review_id IS NULL AND last_update IS NOT NULL
+            GROUP BY last_update
+        ) d
+        WHERE c.last_update = d.last_update;
+
+        DELETE FROM alert_new_counts WHERE properties = 0;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- refresh_alert_properties only deletes and inserts snapshot rows:
+CREATE TRIGGER alert_snapshot_count_insert AFTER INSERT ON alert_snapshot REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION count_new_alert_properties();
+CREATE TRIGGER alert_snapshot_count_delete AFTER DELETE ON alert_snapshot REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION count_new_alert_properties();
+
+-- The 30 day window and the latest review depend on the current date and every review, so they are applied when
+-- the snapshot is read:
+CREATE VIEW alert_properties AS
+SELECT
+    s.property_id,
+    s.bedrooms,
+    s.bathrooms,
+    s.area,
+    s.garden,
+    s.summary,
+    s.address,
+    s.property_subtype,
+    s.property_description,
+    s.price_amount,
+    s.lettings_agent,
+    s.lettings_agent_branch,
+    s.last_update,
+    s.longitude,
+    s.latitude,
+    s.emailed,
+    s.reviewed_date,
+    CASE
+        WHEN s.reviewed_date = (SELECT MAX(reviewed_date) FROM reviewed_properties) THEN 1
+        ELSE 0 END AS latest_reviewed,
+    s.property_reviewed,
+    s.travel_reviewed,
+    s.location_excluded,
+    s.travel_time,
+    s.review_id,
+    s.images
+FROM
+    alert_snapshot s
+WHERE
+    s.last_update > alert_window_start()
+;
+
 CREATE VIEW properties_review AS
 SELECT
     *
@@ -197,3 +203,82 @@ FROM
 ORDER BY
     review_id DESC
 ;
+
+CREATE VIEW commute_summary AS
+SELECT
+    m.property_id,
+    MAX(m.travel_time) AS max_travel_time,
+    SUM(m.travel_time) AS sum_travel_time,
+    MIN(m.travel_time) AS min_travel_time
+FROM
+    travel_time_matrix m
+    JOIN commute_destinations d ON d.destination_id = m.destination_id
+WHERE
+    d.active
+GROUP BY
+    m.property_id
+;
+
+-- Statement level triggers on every table used by alert_candidates record the touched properties:
+CREATE OR REPLACE FUNCTION mark_alert_properties_dirty() RETURNS trigger AS
+$$
+BEGIN
+    IF TG_TABLE_NAME = 'review_dates' THEN
+        INSERT INTO alert_properties_dirty (property_id)
+        SELECT DISTINCT rp.property_id FROM changed_rows JOIN reviewed_properties rp USING (reviewed_date)
+        ON CONFLICT DO NOTHING;
+    ELSE
+        INSERT INTO alert_properties_dirty (property_id)
+        SELECT DISTINCT property_id FROM changed_rows
+        ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO
+$$
+    DECLARE
+        source_table text;
+    BEGIN
+        FOREACH source_table IN ARRAY ARRAY ['property_data', 'property_location', 'property_images',
+            'travel_time_precise', 'property_location_excluded', 'reviewed_properties', 'review_dates',
+            'property_floorplan', 'property_summary']
+            LOOP
+                EXECUTE FORMAT('DROP TRIGGER IF EXISTS %I ON %I', source_table || '_alert_insert', source_table);
+                EXECUTE FORMAT('DROP TRIGGER IF EXISTS %I ON %I', source_table || '_alert_update', source_table);
+                EXECUTE FORMAT('DROP TRIGGER IF EXISTS %I ON %I', source_table || '_alert_delete', source_table);
+                EXECUTE FORMAT(
+                        'CREATE TRIGGER %I AFTER INSERT ON %I REFERENCING NEW TABLE AS changed_rows '
+                            'FOR EACH STATEMENT EXECUTE FUNCTION mark_alert_properties_dirty()',
+                        source_table || '_alert_insert', source_table);
+                EXECUTE FORMAT(
+                        'CREATE TRIGGER %I AFTER UPDATE ON %I REFERENCING NEW TABLE AS changed_rows '
+                            'FOR EACH STATEMENT EXECUTE FUNCTION mark_alert_properties_dirty()',
+                        source_table || '_alert_update', source_table);
+                EXECUTE FORMAT(
+                        'CREATE TRIGGER %I AFTER DELETE ON %I REFERENCING OLD TABLE AS changed_rows '
+                            'FOR EACH STATEMENT EXECUTE FUNCTION mark_alert_properties_dirty()',
+                        source_table || '_alert_delete', source_table);
+            END LOOP;
+    END
+$$;
+
+-- Refresh the snapshot rows of the touched properties, returns the number of properties refreshed:
+CREATE OR REPLACE FUNCTION refresh_alert_properties() RETURNS integer AS
+$$
+DECLARE
+    touched integer[];
+BEGIN
+    WITH dirty AS (DELETE FROM alert_properties_dirty RETURNING property_id)
+    SELECT ARRAY_AGG(property_id) INTO touched FROM dirty;
+
+    IF touched IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    DELETE FROM alert_snapshot WHERE property_id = ANY (touched);
+    INSERT INTO alert_snapshot SELECT * FROM alert_candidates WHERE property_id = ANY (touched);
+    RETURN CARDINALITY(touched);
+END;
+$$ LANGUAGE plpgsql;